@@ -0,0 +1,96 @@
+"""
+Database administration commands.
+Run from the repo root, e.g.:
+    python -m data.admin ensure-indexes
+    python -m data.admin index-report
+    python -m data.admin query-audit [--update]
+    python -m data.admin migrate [--dry-run]
+    python -m data.admin migration-status
+"""
+import argparse
+import json
+import sys
+
+import data.db_connect as dbc
+# Importing the data modules registers their indexes and migrations.
+import data.users  # noqa: F401
+import data.journals  # noqa: F401
+import data.categories  # noqa: F401
+import data.migrations as mgr
+import data.query_audit as qa
+
+ENSURE_INDEXES = 'ensure-indexes'
+INDEX_REPORT = 'index-report'
+QUERY_AUDIT = 'query-audit'
+MIGRATE = 'migrate'
+MIGRATION_STATUS = 'migration-status'
+REPORT = 'report'
+REGRESSIONS = 'regressions'
+
+
+def ensure_indexes():
+    dbc.connect_db()
+    dbc.ensure_indexes()
+    return dbc.index_report()
+
+
+def index_report():
+    dbc.connect_db()
+    return dbc.index_report()
+
+
+def query_audit(update=False):
+    """
+    Explain the data layer's queries and list the bad plans that have
+    not been accepted; update accepts the current ones.
+    """
+    dbc.connect_db()
+    report = qa.audit()
+    if update:
+        qa.save_plans(report, dbc.engine_name())
+    accepted = qa.load_plans().get(dbc.engine_name(), {})
+    return {REPORT: report, REGRESSIONS: qa.regressions(report, accepted)}
+
+
+def migrate(dry_run=False):
+    """
+    Apply the pending data migrations; a dry run only counts the docs
+    each would change.
+    """
+    return mgr.run(dry_run)
+
+
+def migration_status():
+    return mgr.get_status()
+
+
+COMMANDS = {
+    ENSURE_INDEXES: ensure_indexes,
+    INDEX_REPORT: index_report,
+    QUERY_AUDIT: query_audit,
+    MIGRATE: migrate,
+    MIGRATION_STATUS: migration_status,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    parser.add_argument('--update', action='store_true',
+                        help=f'with {QUERY_AUDIT}: accept the current plans')
+    parser.add_argument('--dry-run', action='store_true',
+                        help=f'with {MIGRATE}: change nothing')
+    args = parser.parse_args(argv)
+    if args.command == QUERY_AUDIT:
+        result = query_audit(args.update)
+    elif args.command == MIGRATE:
+        result = migrate(args.dry_run)
+    else:
+        result = COMMANDS[args.command]()
+    print(json.dumps(result, indent=4, default=str))
+    if isinstance(result, dict) and result.get(REGRESSIONS):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
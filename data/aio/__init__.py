@@ -0,0 +1,7 @@
+"""
+An asyncio version of the data layer.
+data.aio.users, data.aio.journals and data.aio.categories offer the same
+functions as data.users, data.journals and data.categories, as coroutines
+backed by pymongo's AsyncMongoClient (or the configured engine), so
+independent lookups can run concurrently.
+"""
@@ -0,0 +1,97 @@
+"""
+The asyncio counterpart of data.categories.
+Validation and the field accessors (get_journals etc.) live in
+data.categories.
+"""
+import data.aio.db_connect as dbc
+import data.categories as ctgs
+import data.ids as ids
+import data.journals as jrnls
+
+
+async def get_categories(fields: list = None) -> dict:
+    return await dbc.fetch_all_as_dict(ctgs.CATEGORY_ID,
+                                       ctgs.CATEGORIES_COLLECT, fields=fields,
+                                       read_pref=dbc.LIST_READ_PREF)
+
+
+def iter_categories(fields: list = None):
+    """
+    Asynchronously yield every category without loading them all at once.
+    """
+    return dbc.iter_docs(ctgs.CATEGORIES_COLLECT, fields=fields,
+                         read_pref=dbc.LIST_READ_PREF)
+
+
+async def get_user_categories(user_id: str, fields: list = None) -> dict:
+    return await dbc.fetch_many_as_dict(ctgs.CATEGORY_ID,
+                                        ctgs.CATEGORIES_COLLECT,
+                                        {ctgs.USER: user_id}, fields,
+                                        read_pref=dbc.LIST_READ_PREF)
+
+
+def iter_user_categories(user_id: str, fields: list = None):
+    return dbc.iter_docs(ctgs.CATEGORIES_COLLECT, {ctgs.USER: user_id},
+                         fields, read_pref=dbc.LIST_READ_PREF)
+
+
+async def add_category(category_id: str, category_name: str, user_id: str):
+    category_entry = ctgs._make_category_entry(category_id, category_name,
+                                               user_id)
+    existing_category = await dbc.fetch_one(
+        ctgs.CATEGORIES_COLLECT, ctgs._name_filter(user_id, category_name),
+        [ctgs.CATEGORY_ID])
+    if existing_category:
+        raise ValueError("Duplicate category_name.")
+    try:
+        _id = await dbc.insert_one(ctgs.CATEGORIES_COLLECT, category_entry)
+    except dbc.DuplicateKeyError as err:
+        raise ids.IdTaken("Duplicate category.") from err
+    return _id is not None
+
+
+async def get_category(category_id: str, fields: list = None) -> dict:
+    return await dbc.fetch_one(ctgs.CATEGORIES_COLLECT,
+                               {ctgs.CATEGORY_ID: category_id}, fields)
+
+
+async def exists(category_id: str) -> bool:
+    return await get_category(category_id, [ctgs.CATEGORY_ID]) is not None
+
+
+async def del_category(category_id: str):
+    # See data.categories.del_category for the order.
+    await dbc.delete_many(jrnls.JOURNALS_COLLECT,
+                          {jrnls.CATEGORY: category_id})
+    result = await dbc.del_one(ctgs.CATEGORIES_COLLECT,
+                               {ctgs.CATEGORY_ID: category_id})
+    if not result.deleted_count:
+        raise ValueError(f'Delete failure: {category_id} not in database.')
+    return result
+
+
+async def expand_journals(categories: dict) -> dict:
+    """
+    See data.categories.expand_journals.
+    """
+    if not categories:
+        return categories
+    journals = await dbc.fetch_many(
+        jrnls.JOURNALS_COLLECT, {jrnls.CATEGORY: {'$in': list(categories)}},
+        [jrnls.JOURNAL_ID, jrnls.TITLE, jrnls.CATEGORY],
+        read_pref=dbc.LIST_READ_PREF)
+    return ctgs._add_journal_titles(categories, journals)
+
+
+async def update_category(category_id: str, category_data: dict) -> bool:
+    """
+    Updates a category's information.
+    See data.categories.update_category.
+    """
+    update_data = ctgs._get_update_data(category_data)
+    result = await dbc.update_doc(ctgs.CATEGORIES_COLLECT,
+                                  {ctgs.CATEGORY_ID: category_id},
+                                  update_data)
+    if not result.matched_count:
+        raise ValueError(f"Update failure: {category_id} not in database.")
+    return True
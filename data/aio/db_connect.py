@@ -0,0 +1,411 @@
+"""
+The asyncio counterpart of data.db_connect.
+It shares its settings, constants and helpers; only the round trips
+are different.
+Every operation connects (via connect_db) to the running event loop's
+engine, so callers do not need to. An event loop that connected to a
+mongod should await close_db() before it ends; if it does not, the next
+connect_db() after it has closed closes its client.
+"""
+import asyncio
+import copy
+import logging
+import os
+import threading
+import time
+import weakref
+
+import pymongo as pm
+
+import data.db_connect as dbc
+import data.engines.base as base
+import data.engines.mongo as mongo
+import data.engines.sharded as sharded
+
+JOURNALS_DB = dbc.JOURNALS_DB
+MONGO_ID = dbc.MONGO_ID
+LIST_READ_PREF = dbc.LIST_READ_PREF
+text_filter = dbc.text_filter
+DuplicateKeyError = dbc.DuplicateKeyError
+duplicate_fields = dbc.duplicate_fields
+utc_now = dbc.utc_now
+
+logger = logging.getLogger(__name__)
+
+# The engine shared with data.db_connect, when that does not talk to a
+# mongod.
+engine = None
+# {event loop: (engine, finalizer)}, for the engines that do: an
+# AsyncMongoClient belongs to the loop it was created on, so each loop
+# gets its own. When a loop that did not await close_db() is collected,
+# or found closed (a client keeps its loop alive), its finalizer moves
+# its engine to _orphans, for the next connect_db() to close.
+_loop_engines = weakref.WeakKeyDictionary()
+_orphans = []
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+
+async def _sync_engine():
+    """
+    The synchronous engine to share, if the configured one does not talk
+    to a mongod, so the async layer sees the same data as data.db_connect.
+    """
+    if dbc.engine is None or dbc._client_pid != os.getpid():
+        # The sync layer creates the declared indexes, which the writes
+        # here rely on to turn away duplicates; that blocks, so it is
+        # kept off the event loop.
+        await asyncio.to_thread(dbc.connect_db)
+    if dbc.engine.name not in dbc.NETWORK_ENGINES:
+        return dbc.engine
+    return None
+
+
+def _create_engine():
+    if dbc.engine_name() == dbc.SHARDED_ENGINE:
+        return dbc._create_sharded_engine(mongo.AsyncMongoEngine,
+                                          sharded.AsyncShardedEngine,
+                                          pm.AsyncMongoClient)
+    return mongo.AsyncMongoEngine(dbc._create_client(pm.AsyncMongoClient),
+                                  mongo.clock_for(None))
+
+
+async def connect_db():
+    """
+    Return the running event loop's engine, setting it up the first
+    time the loop (or process) calls.
+    For Mongo that wraps an AsyncMongoClient (one per shard when
+    sharded). The clients of loops that have closed without close_db()
+    are closed here, from this loop.
+    """
+    global engine
+    shared = await _sync_engine()
+    if shared is not None:
+        if engine is None or getattr(engine, 'engine', None) is not shared:
+            # Only the in-memory engine never blocks; SQLite calls go to
+            # a worker thread.
+            adapter = (base.AsyncAdapter if shared.name == dbc.MEMORY_ENGINE
+                       else base.ThreadAdapter)
+            engine = adapter(shared)
+        return engine
+    loop = asyncio.get_running_loop()
+    with _engine_lock:
+        _own_loop_engines()
+        # A closed loop whose client keeps it alive: orphan its engine
+        # now, rather than when the loop is collected.
+        for other in [other for other in _loop_engines if other.is_closed()]:
+            _loop_engines.pop(other)[1]()
+        orphans = []
+        while _orphans:
+            orphans.append(_orphans.pop())
+        if loop in _loop_engines:
+            current = _loop_engines[loop][0]
+        else:
+            current = _create_engine()
+            _loop_engines[loop] = (current, weakref.finalize(
+                loop, _orphans.append, current))
+    for orphan in orphans:
+        await _close(orphan)
+    return current
+
+
+def _own_loop_engines():
+    """
+    Forget the engines a forked child inherited: they are its parent's
+    to close. Call with _engine_lock held.
+    """
+    global _engine_pid
+    if _engine_pid != os.getpid():
+        for _, finalizer in _loop_engines.values():
+            finalizer.detach()
+        _loop_engines.clear()
+        _orphans.clear()
+        _engine_pid = os.getpid()
+
+
+async def _close(orphan):
+    try:
+        await orphan.close()
+    except Exception:
+        logger.warning('Could not close the engine of an ended event loop.',
+                       exc_info=True)
+
+
+async def close_db():
+    """
+    Close the running event loop's engine; the next connect_db() in the
+    loop sets up a new one.
+    """
+    global engine
+    engine = None
+    with _engine_lock:
+        _own_loop_engines()
+        entry = _loop_engines.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        current, finalizer = entry
+        finalizer.detach()
+        await current.close()
+
+
+async def insert_one(collection, doc, db=JOURNALS_DB):
+    """
+    Insert a single doc into collection.
+    """
+    with dbc.writing('insert_one', collection, db=db):
+        return await (await connect_db()).insert_one(db, collection, doc)
+
+
+async def _read(name, collection, db, args, read, read_pref=dbc.PRIMARY):
+    """
+    The async version of dbc._read: await read(), or an identical read
+    already running in this loop, retrying it if it fails to reach the
+    database.
+    """
+    key = (db, collection, name, repr(args), read_pref)
+    try:
+        if dbc.SINGLE_FLIGHT:
+            return await _single_flight(key, read)
+        return await _read_fresh(key, read)
+    except (pm.errors.ConnectionFailure, dbc.CircuitOpenError,
+            dbc.DeadlineExceeded) as err:
+        return dbc.stale_fallback(key, err)
+
+
+async def _read_fresh(key, read):
+    attempt = 0
+    while True:
+        try:
+            result = await read()
+            break
+        except pm.errors.ConnectionFailure:
+            attempt += 1
+            delay = dbc.retry_delay(attempt)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+    dbc._stale_put(key, result)
+    return result
+
+
+# The reads in flight, as for dbc.SINGLE_FLIGHT, each with the number
+# of reads waiting on it: {(key, generation, loop): [future, waiters]}.
+_flights = {}
+
+
+async def _single_flight(key, read):
+    db, collection, name = key[:3]
+    flight_key = key + (dbc._cache_generation(db, collection),
+                        asyncio.get_running_loop())
+    flight = _flights.get(flight_key)
+    if flight is None:
+        return await _lead(flight_key, key, read)
+    flight[1] += 1
+    with dbc._flights_lock:
+        dbc._flight_stats[dbc.COALESCED] += 1
+    try:
+        result = await asyncio.wait_for(asyncio.shield(flight[0]),
+                                        dbc.remaining_time())
+    except asyncio.TimeoutError:
+        raise dbc.DeadlineExceeded(f'No time left waiting on {name} '
+                                   f'on {collection}.')
+    except asyncio.CancelledError:
+        if not flight[0].cancelled():
+            raise
+        # The leader was cancelled, not us.
+        return await _read_fresh(key, read)
+    except dbc.DeadlineExceeded:
+        # That was the leader's deadline, not ours.
+        return await _read_fresh(key, read)
+    return copy.deepcopy(result)
+
+
+async def _lead(flight_key, key, read):
+    """
+    Make the read for every task waiting on it.
+    """
+    future = asyncio.get_running_loop().create_future()
+    flight = _flights[flight_key] = [future, 0]
+    with dbc._flights_lock:
+        dbc._flight_stats[dbc.LEADERS] += 1
+    try:
+        result = await _read_fresh(key, read)
+    except BaseException as err:
+        del _flights[flight_key]
+        if flight[1] and not isinstance(err, asyncio.CancelledError):
+            future.set_exception(err)
+        else:
+            future.cancel()
+        raise
+    del _flights[flight_key]
+    # The caller may change its result; the waiters get a copy.
+    future.set_result(copy.deepcopy(result) if flight[1] else None)
+    return result
+
+
+async def fetch_one(collection, filt, fields=None, db=JOURNALS_DB):
+    """
+    Find with a filter and return on the first doc found.
+    If fields is given only those fields are returned.
+    Served from the read cache when it is on.
+    """
+    if dbc.CACHE_SIZE:
+        key = dbc._cache_key(db, collection, filt, fields)
+        hit, doc = dbc._cache_get(key)
+        if hit:
+            return doc
+        generation = dbc._cache_generation(db, collection)
+    doc = await _read('fetch_one', collection, db, (filt, fields),
+                      lambda: _fetch_one(collection, filt, fields, db))
+    if dbc.CACHE_SIZE:
+        dbc._cache_put(key, generation, doc)
+    return doc
+
+
+async def _fetch_one(collection, filt, fields=None, db=JOURNALS_DB):
+    docs = [doc async for doc in _find(collection, filt,
+                                       dbc._projection(fields), limit=1,
+                                       db=db, op='find_one')]
+    for doc in docs:
+        if MONGO_ID in doc:
+            # Convert mongo ID to a string so it works as JSON
+            doc[MONGO_ID] = str(doc[MONGO_ID])
+        return doc
+
+
+async def del_one(collection, filt, db=JOURNALS_DB):
+    with dbc.writing('delete_one', collection, filt, db=db):
+        return await (await connect_db()).delete_one(db, collection, filt)
+
+
+async def update_doc(collection, filters, update_dict, db=JOURNALS_DB):
+    """
+    Update a single doc in collection based on filter.
+    """
+    with dbc.writing('update_one', collection, filters, db=db):
+        return await (await connect_db()).update_one(
+            db, collection, filters, {'$set': update_dict})
+
+
+async def increment(collection, filters, counts, update_dict=None,
+                    db=JOURNALS_DB):
+    """
+    See dbc.increment.
+    """
+    with dbc.writing('update_one', collection, filters, db=db):
+        return await (await connect_db()).update_one(
+            db, collection, filters, dbc._inc_update(counts, update_dict))
+
+
+async def unset_fields(collection, filters, fields, db=JOURNALS_DB):
+    """
+    Remove fields (dot paths allowed) from a single doc in collection.
+    """
+    with dbc.writing('update_one', collection, filters, db=db):
+        return await (await connect_db()).update_one(
+            db, collection, filters,
+            {'$unset': {field: '' for field in fields}})
+
+
+async def delete_many(collection, filt, db=JOURNALS_DB):
+    with dbc.writing('delete_many', collection, filt, db=db):
+        return await (await connect_db()).delete_many(db, collection, filt)
+
+
+async def _timed_aiter(op, collection, filt, find):
+    """
+    The async version of dbc._timed_iter.
+    """
+    elapsed = 0.0
+    failed = False
+    iterator = None
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                with dbc.guarded(op, collection):
+                    if iterator is None:
+                        dbc.log_op(op, collection)
+                        iterator = (await find()).__aiter__()
+                    doc = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield doc
+    except Exception:
+        failed = True
+        raise
+    finally:
+        dbc._record_op(op, collection, filt, elapsed * 1000, failed)
+
+
+def _find(collection, filt=None, projection=None, sort=None, limit=0,
+          skip=0, batch_size=0, db=JOURNALS_DB, read_pref=dbc.PRIMARY,
+          op='find'):
+    if read_pref not in dbc.READ_PREFERENCES:
+        raise ValueError(f'Unknown read preference: {read_pref}; '
+                         + f'pick one of {dbc.READ_PREFERENCES}.')
+
+    async def find():
+        return (await connect_db()).find(db, collection, filt or {},
+                                         projection, sort, limit, skip,
+                                         batch_size, read_pref)
+    return _timed_aiter(op, collection, filt, find)
+
+
+async def iter_docs(collection, filt=None, fields=None,
+                    batch_size=dbc.BATCH_SIZE, sort=None, limit=0, skip=0,
+                    db=JOURNALS_DB, read_pref=dbc.PRIMARY):
+    """
+    Yield the docs matching filt as the cursor streams them in.
+    """
+    async for doc in _find(collection, filt, dbc._projection(fields), sort,
+                           limit, skip, batch_size, db, read_pref):
+        if MONGO_ID in doc:
+            doc[MONGO_ID] = str(doc[MONGO_ID])
+        yield doc
+
+
+async def fetch_many(collection, filt=None, fields=None, sort=None, limit=0,
+                     skip=0, db=JOURNALS_DB, read_pref=dbc.PRIMARY):
+    async def read():
+        return [doc async for doc in iter_docs(collection, filt, fields, 0,
+                                               sort, limit, skip, db,
+                                               read_pref)]
+    return await _read('fetch_many', collection, db,
+                       (filt, fields, sort, limit, skip), read, read_pref)
+
+
+async def fetch_many_as_dict(key, collection, filt=None, fields=None,
+                             sort=None, limit=0, skip=0, db=JOURNALS_DB,
+                             read_pref=dbc.PRIMARY):
+    async def read():
+        ret = {}
+        async for doc in _find(collection, filt,
+                               dbc._projection(fields, key), sort, limit,
+                               skip, db=db, read_pref=read_pref):
+            doc.pop(MONGO_ID, None)
+            ret[doc[key]] = doc
+        return ret
+    return await _read('fetch_many_as_dict', collection, db,
+                       (key, filt, fields, sort, limit, skip), read,
+                       read_pref)
+
+
+async def fetch_all_as_dict(key, collection, fields=None, db=JOURNALS_DB,
+                            read_pref=dbc.PRIMARY):
+    return await fetch_many_as_dict(key, collection, fields=fields, db=db,
+                                    read_pref=read_pref)
+
+
+async def bulk_write(collection, ops, ordered=True, db=JOURNALS_DB) -> dict:
+    """
+    Send dbc.insert_op/update_op/delete_op operations together.
+    Returns the same report as dbc.bulk_write.
+    """
+    if not ops:
+        return dbc._bulk_report()
+    with dbc.writing('bulk_write', collection, db=db):
+        details = await (await connect_db()).bulk_write(db, collection, ops,
+                                                        ordered)
+    return dbc._bulk_report(details)
@@ -0,0 +1,156 @@
+"""
+The asyncio counterpart of data.journals.
+Validation and the field accessors (get_title etc.) live in
+data.journals.
+"""
+import asyncio
+
+import data.aio.categories as ctgs
+import data.aio.db_connect as dbc
+import data.categories as sync_ctgs
+import data.ids as ids
+import data.journals as jrnls
+
+
+async def get_journals(fields: list = None) -> dict:
+    return await dbc.fetch_all_as_dict(jrnls.JOURNAL_ID,
+                                       jrnls.JOURNALS_COLLECT, fields=fields,
+                                       read_pref=dbc.LIST_READ_PREF)
+
+
+async def get_user_journals(user_id: str, fields: list = None) -> dict:
+    return await dbc.fetch_many_as_dict(jrnls.JOURNAL_ID,
+                                        jrnls.JOURNALS_COLLECT,
+                                        {jrnls.USER: user_id}, fields,
+                                        read_pref=dbc.LIST_READ_PREF)
+
+
+async def get_user_journals_between(user_id: str, start=None, end=None,
+                                    fields: list = None,
+                                    field: str = jrnls.MODIFIED,
+                                    limit: int = 0) -> dict:
+    """
+    See data.journals.get_user_journals_between.
+    """
+    return await dbc.fetch_many_as_dict(
+        jrnls.JOURNAL_ID, jrnls.JOURNALS_COLLECT,
+        jrnls._between_filter(user_id, start, end, field), fields,
+        sort=[(field, -1)], limit=limit, read_pref=dbc.LIST_READ_PREF)
+
+
+async def get_category_journals(category_id: str,
+                                fields: list = None) -> dict:
+    return await dbc.fetch_many_as_dict(jrnls.JOURNAL_ID,
+                                        jrnls.JOURNALS_COLLECT,
+                                        {jrnls.CATEGORY: category_id},
+                                        fields, read_pref=dbc.LIST_READ_PREF)
+
+
+async def search_journals(query: str, user_id: str = None,
+                          fields: list = None) -> dict:
+    filt = dbc.text_filter(query)
+    if user_id is not None:
+        filt[jrnls.USER] = user_id
+    return await dbc.fetch_many_as_dict(jrnls.JOURNAL_ID,
+                                        jrnls.JOURNALS_COLLECT, filt, fields)
+
+
+def iter_journals(fields: list = None):
+    return dbc.iter_docs(jrnls.JOURNALS_COLLECT, fields=fields,
+                         read_pref=dbc.LIST_READ_PREF)
+
+
+def iter_user_journals(user_id: str, fields: list = None):
+    return dbc.iter_docs(jrnls.JOURNALS_COLLECT, {jrnls.USER: user_id},
+                         fields, read_pref=dbc.LIST_READ_PREF)
+
+
+def iter_category_journals(category_id: str, fields: list = None):
+    return dbc.iter_docs(jrnls.JOURNALS_COLLECT,
+                         {jrnls.CATEGORY: category_id}, fields,
+                         read_pref=dbc.LIST_READ_PREF)
+
+
+async def get_journal(journal_id: str, fields: list = None) -> dict:
+    return await dbc.fetch_one(jrnls.JOURNALS_COLLECT,
+                               {jrnls.JOURNAL_ID: journal_id}, fields)
+
+
+async def exists(journal_id: str) -> bool:
+    return await get_journal(journal_id, [jrnls.JOURNAL_ID]) is not None
+
+
+async def add_journal(journal_id: str, title: str, prompt: str,
+                      content: str, user_id: str, category_id: str):
+    journal_entry = jrnls._make_journal_entry(journal_id, title, prompt,
+                                              content, user_id, category_id)
+    try:
+        _id = await dbc.insert_one(jrnls.JOURNALS_COLLECT, journal_entry)
+    except dbc.DuplicateKeyError as err:
+        raise ids.IdTaken("Duplicate journal") from err
+    await dbc.increment(sync_ctgs.CATEGORIES_COLLECT,
+                        {sync_ctgs.CATEGORY_ID: category_id},
+                        {sync_ctgs.JOURNAL_COUNT: 1},
+                        {sync_ctgs.LAST_MODIFIED:
+                         journal_entry[jrnls.TIMESTAMP]})
+    return _id is not None
+
+
+async def del_journal(journal_id: str):
+    journal_entry = await get_journal(journal_id, [jrnls.CATEGORY])
+    if journal_entry is None:
+        raise ValueError(f"Delete failure: {journal_id} not in database.")
+
+    result = await dbc.del_one(jrnls.JOURNALS_COLLECT,
+                               {jrnls.JOURNAL_ID: journal_id})
+    if result.deleted_count:
+        await dbc.increment(sync_ctgs.CATEGORIES_COLLECT,
+                            {sync_ctgs.CATEGORY_ID:
+                             jrnls.get_category(journal_entry)},
+                            {sync_ctgs.JOURNAL_COUNT: -1},
+                            {sync_ctgs.LAST_MODIFIED: dbc.utc_now()})
+    return True
+
+
+async def update_journal(journal_id: str, journal_data: dict) -> bool:
+    """
+    Updates a journal's information.
+    See data.journals.update_journal.
+    """
+    if not journal_data:
+        raise ValueError("Update failure: No valid fields to update.")
+
+    update_data = {}
+    for key in [jrnls.TITLE, jrnls.PROMPT, jrnls.CONTENT, jrnls.CATEGORY]:
+        if key in journal_data and (len(journal_data[key]) != 0):
+            update_data[key] = journal_data[key]
+    update_data[jrnls.MODIFIED] = dbc.utc_now()
+
+    if jrnls.CATEGORY not in update_data:
+        # The categories' counts do not change, so there is nothing to read.
+        result = await dbc.update_doc(jrnls.JOURNALS_COLLECT,
+                                      {jrnls.JOURNAL_ID: journal_id},
+                                      update_data)
+        if not result.matched_count:
+            raise ValueError(f"Update failure: {journal_id} not in database.")
+        return True
+
+    new_cat_id = update_data[jrnls.CATEGORY]
+    journal_entry, category_found = await asyncio.gather(
+        get_journal(journal_id, [jrnls.CATEGORY]), ctgs.exists(new_cat_id))
+    if journal_entry is None:
+        raise ValueError(f"Update failure: {journal_id} not in database.")
+    prev_cat_id = jrnls.get_category(journal_entry)
+    if new_cat_id != prev_cat_id and not category_found:
+        raise ValueError("Please input a category ID that exists.")
+
+    result = await dbc.update_doc(jrnls.JOURNALS_COLLECT,
+                                  jrnls._move_filter(journal_id, prev_cat_id),
+                                  update_data)
+    if not result.matched_count:
+        raise ValueError(f"Update failure: {journal_id} was changed at "
+                         "the same time; please try again.")
+    await dbc.bulk_write(sync_ctgs.CATEGORIES_COLLECT,
+                         jrnls._move_ops(prev_cat_id, new_cat_id,
+                                         update_data[jrnls.MODIFIED]))
+    return True
@@ -0,0 +1,76 @@
+"""
+The asyncio counterpart of data.users.
+Validation and the field accessors (get_email etc.) live in data.users.
+"""
+import data.aio.db_connect as dbc
+import data.ids as ids
+import data.users as usrs
+
+
+async def get_users(fields: list = None) -> dict:
+    return await dbc.fetch_all_as_dict(usrs.USER_ID, usrs.USERS_COLLECT,
+                                       fields=fields,
+                                       read_pref=dbc.LIST_READ_PREF)
+
+
+def iter_users(fields: list = None):
+    """
+    Asynchronously yield every user without loading them all at once.
+    """
+    return dbc.iter_docs(usrs.USERS_COLLECT, fields=fields,
+                         read_pref=dbc.LIST_READ_PREF)
+
+
+async def get_user(identifier: str, fields: list = None) -> dict:
+    return await dbc.fetch_one(usrs.USERS_COLLECT,
+                               usrs._identifier_filter(identifier), fields)
+
+
+async def exists(user_id: str) -> bool:
+    return await get_user(user_id, [usrs.USER_ID]) is not None
+
+
+async def _duplicate_user(err, user_id: str) -> ValueError:
+    """
+    See data.users._duplicate_user.
+    """
+    fields = dbc.duplicate_fields(err)
+    if usrs.EMAIL in fields or (not fields and not await exists(user_id)):
+        return ValueError("A user is already registered under this email.")
+    return ids.IdTaken("This user is already registered.")
+
+
+async def add_user(user_id: str, first_name: str, last_name: str,
+                   dob: str, email: str, password: str):
+    user_entry = usrs._make_user_entry(user_id, first_name, last_name,
+                                       dob, email, password)
+    try:
+        _id = await dbc.insert_one(usrs.USERS_COLLECT, user_entry)
+    except dbc.DuplicateKeyError as err:
+        raise await _duplicate_user(err, user_id) from err
+    return _id is not None
+
+
+async def del_user(user_id: str):
+    result = await dbc.del_one(usrs.USERS_COLLECT, {usrs.USER_ID: user_id})
+    if not result.deleted_count:
+        raise ValueError(f'Delete failure: {user_id} not in database.')
+    return result
+
+
+async def update_user(user_id: str, user_data: dict) -> bool:
+    """
+    Updates a user's information.
+    See data.users.update_user.
+    """
+    update_data = usrs._get_update_data(user_data)
+    try:
+        result = await dbc.update_doc(usrs.USERS_COLLECT,
+                                      {usrs.USER_ID: user_id}, update_data)
+    except dbc.DuplicateKeyError as err:
+        # The email is the only unique field an update can change.
+        raise ValueError("A user is already registered "
+                         "under this email.") from err
+    if not result.matched_count:
+        raise ValueError(f"Update failure: {user_id} not in database.")
+    return True
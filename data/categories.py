@@ -4,29 +4,53 @@ This module interfaces to our categories data.
 
 # import data.users as usrs
 import data.db_connect as dbc
+import data.ids as ids
+import data.migrations as mgr
 import random
 import data.journals as jrnls
 
 from datetime import datetime
 
-FORMAT = "%Y-%m-%d %H:%M:%S"
+# DATE_TIME is stored as a datetime (see dbc.utc_now()); this is how
+# the API shows it.
+FORMAT = dbc.DATETIME_FORMAT
 CATEGORIES_COLLECT = 'categories'
 CATEGORY_ID = 'category_id'
 CATEGORY_NAME = 'category_name'
 USER = 'user'
 DATE_TIME = 'created'
+# How many journals the category holds, and when one was last added to
+# or taken out of it. The journals' CATEGORY field is the membership
+# itself; these are kept in step with it by data.journals.
+JOURNAL_COUNT = 'journal_count'
+LAST_MODIFIED = 'last_modified'
+# The {journal_id: title} map expand_journals() adds on request.
 JOURNALS = 'Journals'
 
 categories = {}
 
-CATEGORY_ID_LEN = 8
-USER_ID_LEN = 10
-CATEGORY_BIG_NUM = 10000000
-USER_BIG_NUM = 1000000000
+CATEGORY_ID_LEN = ids.ID_LEN
+USER_ID_LEN = ids.ID_LEN
 BIG_NUM = 100_000_000_000_000_000_000
 
 MOCK_ID = '0' * CATEGORY_ID_LEN
 
+# Fields for list views.
+SUMMARY_FIELDS = [CATEGORY_ID, CATEGORY_NAME, USER, DATE_TIME,
+                  JOURNAL_COUNT, LAST_MODIFIED]
+
+# CATEGORY_ID is unique, so the insert itself turns away one in use.
+INDEXES = [
+    dbc.index(CATEGORY_ID, unique=True),
+    dbc.index(USER, CATEGORY_NAME),
+]
+dbc.register_indexes(CATEGORIES_COLLECT, INDEXES)
+dbc.register_shard_key(CATEGORIES_COLLECT, USER)
+dbc.register_id_key(CATEGORIES_COLLECT, CATEGORY_ID)
+
+NATIVE_DATES = 3
+JOURNAL_COUNTS = 4
+
 # categories = [
 #     {
 #         CATEGORY_ID:  75638475,
@@ -44,10 +68,7 @@ MOCK_ID = '0' * CATEGORY_ID_LEN
 
 
 def _get_category_id():
-    _id = random.randint(0, CATEGORY_BIG_NUM)
-    _id = str(_id)
-    _id = _id.rjust(CATEGORY_ID_LEN, '0')
-    return _id
+    return ids.new_id()
 
 
 def get_test_category():
@@ -55,16 +76,65 @@ def get_test_category():
     test_category[CATEGORY_ID] = _get_category_id()
     test_category[CATEGORY_NAME] = "unnamed"
     test_category[USER] = "1234567890"
-    test_category[DATE_TIME] = "2002-11-20 12:00:00"
-    test_category[JOURNALS] = {}
+    test_category[DATE_TIME] = datetime(2002, 11, 20, 12)
+    test_category[JOURNAL_COUNT] = 0
+    test_category[LAST_MODIFIED] = test_category[DATE_TIME]
     return test_category
 
 
 def _get_user_id():
-    _id = random.randint(0, USER_BIG_NUM)
-    _id = str(_id)
-    _id = _id.rjust(USER_ID_LEN, '0')
-    return _id
+    return ids.new_id()
+
+
+def _native_dates_update(category: dict) -> dict:
+    return mgr.native_dates_update(category, [DATE_TIME])
+
+
+mgr.register_migration(NATIVE_DATES, 'native_category_dates',
+                       CATEGORIES_COLLECT, CATEGORY_ID, _native_dates_update)
+
+
+def _journal_counts_updates(categories: list) -> list:
+    """
+    Swap the old Journals maps of a batch of categories for
+    JOURNAL_COUNT and LAST_MODIFIED, counted from the journals
+    themselves with one read for the whole batch.
+    """
+    old_ids = [category[CATEGORY_ID] for category in categories
+               if JOURNALS in category]
+    counts = {category_id: 0 for category_id in old_ids}
+    added = {}
+    if old_ids:
+        found = dbc.fetch_many(jrnls.JOURNALS_COLLECT,
+                               {jrnls.CATEGORY: {'$in': old_ids}},
+                               [jrnls.CATEGORY, jrnls.TIMESTAMP])
+        for journal in found:
+            category_id = journal[jrnls.CATEGORY]
+            counts[category_id] += 1
+            timestamp = journal.get(jrnls.TIMESTAMP)
+            if isinstance(timestamp, datetime):
+                added[category_id] = max(added.get(category_id, timestamp),
+                                         timestamp)
+    ret = []
+    for category in categories:
+        if JOURNALS not in category:
+            ret.append(None)
+            continue
+        category_id = category[CATEGORY_ID]
+        ret.append({'$set': {JOURNAL_COUNT: counts[category_id],
+                             LAST_MODIFIED: added.get(
+                                 category_id, category.get(DATE_TIME))},
+                    '$unset': {JOURNALS: ''}})
+    return ret
+
+
+# Guarded only on the old map: journals added, moved or deleted while
+# this runs $inc JOURNAL_COUNT, which must not turn the category into a
+# conflict that keeps its map.
+mgr.register_migration(JOURNAL_COUNTS, 'category_journal_counts',
+                       CATEGORIES_COLLECT, CATEGORY_ID,
+                       _journal_counts_updates, batch=True,
+                       guard=[JOURNALS])
 
 
 def _get_category_name():
@@ -74,40 +144,89 @@ def _get_category_name():
 
 
 # return all categories
-def get_categories() -> dict:
+def get_categories(fields: list = None) -> dict:
     dbc.connect_db()
-    return dbc.fetch_all_as_dict(CATEGORY_ID, CATEGORIES_COLLECT)
+    return dbc.fetch_all_as_dict(CATEGORY_ID, CATEGORIES_COLLECT,
+                                 fields=fields, read_pref=dbc.LIST_READ_PREF)
 
 
 # return categories with a specific user_id - Cody updated in 10/29
-def get_user_categories(user_id: str) -> dict:
+def get_user_categories(user_id: str, fields: list = None) -> dict:
     dbc.connect_db()
-    all_categories = dbc.fetch_all_as_dict(CATEGORY_ID, CATEGORIES_COLLECT)
-    user_specific_categories = {}
-    for category_id, category in all_categories.items():
-        if category[USER] == user_id:
-            user_specific_categories[category_id] = category
-    return user_specific_categories
+    return dbc.fetch_many_as_dict(CATEGORY_ID, CATEGORIES_COLLECT,
+                                  {USER: user_id}, fields,
+                                  read_pref=dbc.LIST_READ_PREF)
 
 
-# category ids are currently a parameter but should later be uniquely generated
-def add_category(category_id: str, category_name: str, user_id: str):
-    if exists(category_id):
-        raise ValueError("Duplicate category.")
+def iter_categories(fields: list = None):
+    """
+    Yield every category without loading them all at once.
+    """
+    dbc.connect_db()
+    return dbc.iter_docs(CATEGORIES_COLLECT, fields=fields,
+                         read_pref=dbc.LIST_READ_PREF)
+
+
+def iter_categories_json(fields: list = None):
+    """
+    Yield get_categories() as JSON object members, straight from the BSON.
+    """
+    dbc.connect_db()
+    return dbc.iter_json_items(CATEGORY_ID, CATEGORIES_COLLECT,
+                               fields=fields, read_pref=dbc.LIST_READ_PREF)
+
+
+def iter_user_categories(user_id: str, fields: list = None):
+    """
+    Yield a user's categories without loading them all at once.
+    """
+    dbc.connect_db()
+    return dbc.iter_docs(CATEGORIES_COLLECT, {USER: user_id}, fields,
+                         read_pref=dbc.LIST_READ_PREF)
+
+
+def _make_category_entry(category_id: str, category_name: str,
+                         user_id: str) -> dict:
+    """
+    Validate a new category's fields and build the doc to store.
+    """
     if not category_name:
         raise ValueError("Please input a category_name.")
 
+    date_time = dbc.utc_now()
+    category_entry = {}
+    category_entry[CATEGORY_ID] = category_id
+    category_entry[CATEGORY_NAME] = category_name
+    category_entry[USER] = user_id
+    category_entry[DATE_TIME] = date_time
+    category_entry[JOURNAL_COUNT] = 0
+    category_entry[LAST_MODIFIED] = date_time
+    return category_entry
+
+
+def _name_filter(user_id: str, category_name: str) -> dict:
+    """
+    Case-insensitive match on one of a user's category names.
+    """
     lowercase_category_name = category_name.lower()
+    return {
+        USER: user_id,
+        CATEGORY_NAME: {"$regex": f"^{lowercase_category_name}$",
+                        "$options": "i"},
+    }
 
-    # Check for duplicate category_name (user-specific)
+
+# category ids are currently a parameter but should later be uniquely generated
+def add_category(category_id: str, category_name: str, user_id: str):
+    category_entry = _make_category_entry(category_id, category_name,
+                                          user_id)
+    dbc.connect_db()
+
+    # Check for duplicate category_name (user-specific). Names match
+    # case-insensitively, which an index can not enforce.
     existing_category = dbc.fetch_one(
-        CATEGORIES_COLLECT,
-        {
-            USER: user_id,
-            CATEGORY_NAME: {"$regex": f"^{lowercase_category_name}$",
-                            "$options": "i"},
-        },
-    )
+        CATEGORIES_COLLECT, _name_filter(user_id, category_name),
+        [CATEGORY_ID])
     if existing_category:
         raise ValueError("Duplicate category_name.")
 
@@ -115,39 +234,72 @@ def add_category(category_id: str, category_name: str, user_id: str):
     # if not usrs.exists(user_id):
     #     raise wz.NotAcceptable("Please input a user ID that exists.")
 
-    date_time = datetime.now().strftime(FORMAT)
-    category_entry = {}
-    category_entry[CATEGORY_ID] = category_id
-    category_entry[CATEGORY_NAME] = category_name
-    category_entry[USER] = user_id
-    category_entry[DATE_TIME] = date_time
-    category_entry[JOURNALS] = {}
-    dbc.connect_db()
-    _id = dbc.insert_one(CATEGORIES_COLLECT, category_entry)
+    try:
+        _id = dbc.insert_one(CATEGORIES_COLLECT, category_entry)
+    except dbc.DuplicateKeyError as err:
+        raise ids.IdTaken("Duplicate category.") from err
     return _id is not None
 
 
-def exists(category_id: str) -> bool:
-    return get_category(category_id) is not None
+def add_categories(categories: list) -> dict:
+    """
+    Add many categories with one duplicate lookup and one insert round trip.
+
+    Args:
+    categories (list): Dicts with CATEGORY_ID, CATEGORY_NAME and USER.
 
+    Returns:
+    dict: A dbc bulk write report; ERRORS holds an entry for every
+          category that was not added, with ITEM_INDEX its position
+          in categories.
+    """
+    dbc.connect_db()
+    category_ids = [category.get(CATEGORY_ID) for category in categories]
+    user_ids = list({category.get(USER) for category in categories})
+    existing = dbc.fetch_many(CATEGORIES_COLLECT,
+                              {'$or': [{CATEGORY_ID: {'$in': category_ids}},
+                                       {USER: {'$in': user_ids}}]},
+                              [CATEGORY_ID, CATEGORY_NAME, USER])
+    taken_ids = {category[CATEGORY_ID] for category in existing}
+    taken_names = {(category[USER], category[CATEGORY_NAME].lower())
+                   for category in existing}
+
+    def make_entry(category):
+        if category.get(CATEGORY_ID) in taken_ids:
+            raise ValueError("Duplicate category.")
+        entry = _make_category_entry(category[CATEGORY_ID],
+                                     category[CATEGORY_NAME],
+                                     category[USER])
+        name_key = (entry[USER], entry[CATEGORY_NAME].lower())
+        if name_key in taken_names:
+            raise ValueError("Duplicate category_name.")
+        taken_ids.add(entry[CATEGORY_ID])
+        taken_names.add(name_key)
+        return entry
+
+    return dbc.insert_many_checked(CATEGORIES_COLLECT, categories,
+                                   make_entry)
 
-def del_category(category_id: str):
-    if exists(category_id):
-        category_entry = get_category(category_id)
-        journals_entry = get_journals(category_entry)
 
-        if len(journals_entry) != 0:
-            for key in journals_entry:
-                jrnls.del_journal(key)
+def exists(category_id: str) -> bool:
+    return get_category(category_id, [CATEGORY_ID]) is not None
 
-        return dbc.del_one(CATEGORIES_COLLECT, {CATEGORY_ID: category_id})
-    else:
+
+def del_category(category_id: str):
+    dbc.connect_db()
+    # Its journals go first, found on their indexed CATEGORY, so a
+    # failure part way leaves no journals without a category.
+    dbc.delete_many(jrnls.JOURNALS_COLLECT, {jrnls.CATEGORY: category_id})
+    result = dbc.del_one(CATEGORIES_COLLECT, {CATEGORY_ID: category_id})
+    if not result.deleted_count:
         raise ValueError(f'Delete failure: {category_id} not in database.')
+    return result
 
 
-def get_category(category_id: str) -> dict:
+def get_category(category_id: str, fields: list = None) -> dict:
     dbc.connect_db()
-    return dbc.fetch_one(CATEGORIES_COLLECT, {CATEGORY_ID: category_id})
+    return dbc.fetch_one(CATEGORIES_COLLECT, {CATEGORY_ID: category_id},
+                         fields)
 
 
 def get_category_name(category: dict):
@@ -162,6 +314,65 @@ def get_journals(category: dict):
     return category.get(JOURNALS)
 
 
+def get_journal_count(category: dict):
+    return category.get(JOURNAL_COUNT)
+
+
+def get_last_modified(category: dict):
+    return category.get(LAST_MODIFIED)
+
+
+def _add_journal_titles(categories: dict, journals) -> dict:
+    for category in categories.values():
+        category[JOURNALS] = {}
+    for journal in journals:
+        category = categories.get(journal[jrnls.CATEGORY])
+        if category is not None:
+            category[JOURNALS][journal[jrnls.JOURNAL_ID]] = \
+                journal.get(jrnls.TITLE)
+    return categories
+
+
+def expand_journals(categories: dict) -> dict:
+    """
+    Add the JOURNALS {journal_id: title} map to each of categories
+    ({category_id: category}, as get_categories() returns), with one
+    read of the journals for all of them.
+    """
+    if not categories:
+        return categories
+    dbc.connect_db()
+    journals = dbc.fetch_many(jrnls.JOURNALS_COLLECT,
+                              {jrnls.CATEGORY: {'$in': list(categories)}},
+                              [jrnls.JOURNAL_ID, jrnls.TITLE, jrnls.CATEGORY],
+                              read_pref=dbc.LIST_READ_PREF)
+    return _add_journal_titles(categories, journals)
+
+
+def _membership_op(category_id: str, change: int, when) -> dict:
+    """
+    The bulk write op that moves a category's JOURNAL_COUNT on by change
+    and sets its LAST_MODIFIED to when.
+    """
+    return dbc.inc_op({CATEGORY_ID: category_id}, {JOURNAL_COUNT: change},
+                      {LAST_MODIFIED: when})
+
+
+def _get_update_data(category_data: dict) -> dict:
+    """
+    Pick out the fields of category_data that may be updated.
+    """
+    if not category_data:
+        raise ValueError("Update failure: No valid fields to update.")
+
+    update_data = {}
+    # JOURNAL_COUNT and LAST_MODIFIED follow the journals, so only the
+    # name may be set here.
+    if len(category_data.get(CATEGORY_NAME, '')) != 0:
+        update_data[CATEGORY_NAME] = category_data[CATEGORY_NAME]
+    return update_data
+
+
 def update_category(category_id: str, category_data: dict) -> bool:
     """
     Updates a category's information.
@@ -173,20 +384,10 @@ def update_category(category_id: str, category_data: dict) -> bool:
     Returns:
     bool: True if the update was successful, False otherwise.
     """
-    if not exists(category_id):
-        raise ValueError(f"Update failure: {category_id} not in database.")
-
-    if not category_data:
-        raise ValueError("Update failure: No valid fields to update.")
-
-    update_data = {}
-    for key in [CATEGORY_NAME, JOURNALS]:
-        if key in category_data:
-            if key == CATEGORY_NAME and (len(category_data[key]) != 0):
-                update_data[key] = category_data[key]
-            elif key == JOURNALS:  # Journals dictionary can be empty
-                update_data[key] = category_data[key]
-
+    update_data = _get_update_data(category_data)
     dbc.connect_db()
-    dbc.update_doc(CATEGORIES_COLLECT, {CATEGORY_ID: category_id}, update_data)
+    result = dbc.update_doc(CATEGORIES_COLLECT, {CATEGORY_ID: category_id},
+                            update_data)
+    if not result.matched_count:
+        raise ValueError(f"Update failure: {category_id} not in database.")
     return True
@@ -1,62 +1,1280 @@
+import atexit
+import collections
+import contextlib
+import contextvars
+import copy
+import json
+import logging
 import os
+import random
+import struct
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 
+import bson
+import bson.json_util as json_util
 import pymongo as pm
 
+try:
+    # Optional: turns BSON into JSON in C, without building dicts.
+    import bsonjs
+except ImportError:
+    bsonjs = None
+
+import data.engines.base as base
+import data.engines.memory as memory
+import data.engines.mongo as mongo
+import data.engines.sharded as sharded
+import data.engines.sqlite as sqlite
+
+logger = logging.getLogger(__name__)
+
 LOCAL = "0"
 CLOUD = "1"
 
 JOURNALS_DB = 'journals_db'
 
+# The storage engine everything here goes through, picked by the
+# DB_ENGINE environment variable (see ENGINES), and the pymongo client
+# when that engine is Mongo.
+engine = None
 client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+# Connection pool options, read from the environment when the client
+# is created: {environment variable: MongoClient option}.
+POOL_SETTINGS = {
+    'MONGO_MAX_POOL_SIZE': 'maxPoolSize',
+    'MONGO_MIN_POOL_SIZE': 'minPoolSize',
+    'MONGO_MAX_IDLE_TIME_MS': 'maxIdleTimeMS',
+    'MONGO_MAX_CONNECTING': 'maxConnecting',
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS',
+    'MONGO_CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'MONGO_SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS',
+}
 
 MONGO_ID = '_id'
+MONGO_ID_INDEX = '_id_'
+
+# How many docs a streaming cursor pulls from the server per round trip.
+BATCH_SIZE = int(os.environ.get('MONGO_BATCH_SIZE', 500))
+
+ASCENDING = pm.ASCENDING
+DESCENDING = pm.DESCENDING
+
+MONGO_ENGINE = mongo.MONGO
+MEMORY_ENGINE = memory.MEMORY
+SQLITE_ENGINE = sqlite.SQLITE
+SHARDED_ENGINE = sharded.SHARDED
+# The database file of the SQLite engine.
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'ease_journal.sqlite3')
+
+# Bulk write operations and reports.
+OP = base.OP
+INSERT = base.INSERT
+UPDATE = base.UPDATE
+DELETE = base.DELETE
+DOC = base.DOC
+FILTER = base.FILTER
+INSERTED = 'inserted'
+MATCHED = 'matched'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+ERRORS = 'errors'
+ITEM_INDEX = 'index'
+CODE = 'code'
+MESSAGE = 'message'
+
+# Dates are stored as naive UTC datetimes, to the second; the API shows
+# them as DATETIME_FORMAT text.
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+BSON_EPOCH = datetime(1970, 1, 1)
+
+# Where reads may go: PRIMARY, or SECONDARY_PREFERRED and NEAREST to
+# take load off the primary. Reads that do not go to the primary still
+# see every write this process made before them.
+PRIMARY = base.PRIMARY
+SECONDARY_PREFERRED = base.SECONDARY_PREFERRED
+NEAREST = base.NEAREST
+READ_PREFERENCES = base.READ_PREFERENCES
+# The read preference of the list reads in the data modules. PRIMARY
+# unless MONGO_LIST_READ_PREF opts in to secondaries: read-your-writes
+# only holds within one process, and with several workers a client's
+# GET may land on another process than its POST.
+LIST_READ_PREF = os.environ.get('MONGO_LIST_READ_PREF', PRIMARY)
+
+INDEX_NAME = base.INDEX_NAME
+INDEX_KEYS = base.INDEX_KEYS
+INDEX_UNIQUE = base.INDEX_UNIQUE
+# The direction of a key in a full text index; see text_filter().
+TEXT = base.TEXT
+MISSING = 'missing'
+EXTRA = 'extra'
+# The codes Mongo refuses to create an index with when one of the same
+# name or keys exists with other options (say, no longer unique).
+INDEX_CONFLICTS = [85, 86]
+DuplicateKeyError = pm.errors.DuplicateKeyError
+
+# Operation counters, per (collection, operation); see get_op_stats().
+COUNT = 'count'
+TOTAL_MS = 'total_ms'
+MAX_MS = 'max_ms'
+SLOW = 'slow'
+FAILED = 'failed'
+
+# Operations taking at least this long are logged as slow queries.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+
+_op_stats = {}
+_op_stats_lock = threading.Lock()
+
+# The read cache in front of fetch_one, off unless QUERY_CACHE_SIZE is
+# set: at most CACHE_SIZE docs, each kept for its collection's TTL in
+# CACHE_TTLS (seconds, set with QUERY_CACHE_TTLS="users=30,journals=5")
+# or CACHE_TTL. Any write to a collection invalidates its entries.
+CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 0))
+CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', 30))
+HITS = 'hits'
+MISSES = 'misses'
+EVICTIONS = 'evictions'
+EXPIRATIONS = 'expirations'
+INVALIDATIONS = 'invalidations'
+SIZE = 'size'
+HIT_RATIO = 'hit_ratio'
+
+
+def parse_durations(setting) -> dict:
+    """
+    Parse a setting like "users=30,journals=2.5" into {name: seconds}.
+    """
+    durations = {}
+    for item in filter(None, setting.split(',')):
+        name, seconds = item.split('=')
+        durations[name.strip()] = float(seconds)
+    return durations
+
+
+CACHE_TTLS = parse_durations(os.environ.get('QUERY_CACHE_TTLS', ''))
+
+# {(db, collection, filter, projection): (expiry, generation, doc)}
+_cache = collections.OrderedDict()
+# Bumped on every write to a collection: {(db, collection): n}.
+# Per collection, not per cached filter: a write's filter does not say
+# which cached reads it changes. An update by user_id changes the read
+# by email of the same doc, an update can make another doc match a
+# cached filter, and an insert can turn a cached miss into a hit. The
+# cache is for read-mostly collections, where a write that empties one
+# costs few hits; give a collection written about as often as it is
+# read a TTL of 0 in CACHE_TTLS instead.
+_cache_generations = {}
+_cache_stats = dict.fromkeys([HITS, MISSES, EVICTIONS, EXPIRATIONS,
+                              INVALIDATIONS], 0)
+_cache_lock = threading.Lock()
+
+# When the current request must be done by (time.monotonic()), or None.
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+# The (collection, operation) pairs the current request has run, while
+# start_op_log() has it noting them; see get_op_log().
+_op_log = contextvars.ContextVar('op_log', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """
+    A database operation ran out of the time left before the deadline.
+    """
+
+
+# The circuit breaker: after BREAKER_THRESHOLD operations in a row fail
+# to reach the database it opens, and operations fail at once with
+# CircuitOpenError. After BREAKER_RESET_S one operation is let through
+# as a probe (half open); it closes the breaker if it gets an answer.
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+STATE = 'state'
+FAILURES = 'failures'
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', 5))
+BREAKER_RESET_S = float(os.environ.get('BREAKER_RESET_S', 30))
+
+# Reads that fail to reach the database are retried up to READ_RETRIES
+# times, after a random wait of up to READ_RETRY_BACKOFF_MS, doubled
+# on each attempt.
+READ_RETRIES = int(os.environ.get('READ_RETRIES', 2))
+READ_RETRY_BACKOFF_MS = float(os.environ.get('READ_RETRY_BACKOFF_MS', 50))
+
+# The last good result of up to STALE_CACHE_SIZE reads, served in place
+# of an error while the database is out to contexts that allow it (see
+# set_allow_stale()). Off unless STALE_CACHE_SIZE is set.
+STALE_CACHE_SIZE = int(os.environ.get('STALE_CACHE_SIZE', 0))
+_stale = collections.OrderedDict()
+_stale_lock = threading.Lock()
+_allow_stale = contextvars.ContextVar('allow_stale', default=False)
+
+# Single flight: a read that arrives while an identical one is waiting
+# on the database, with no write to the collection in between, waits
+# for that one's result instead of making its own trip. On unless
+# SINGLE_FLIGHT is "0".
+SINGLE_FLIGHT = os.environ.get('SINGLE_FLIGHT', '1') == '1'
+LEADERS = 'leaders'
+COALESCED = 'coalesced'
+# {(db, collection, read, args, cache generation): _Flight}
+_flights = {}
+_flight_stats = dict.fromkeys([LEADERS, COALESCED], 0)
+_flights_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """
+    The database has been failing, so we are not trying it for now.
+    """
+
+
+class _Flight:
+    """
+    A read on its way to the database, and its outcome for the identical
+    reads waiting on it.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class _Breaker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def before(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if (self.state == OPEN
+                    and time.monotonic() - self.opened_at >= BREAKER_RESET_S):
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return
+            raise CircuitOpenError('The database is unavailable.')
+
+    def succeeded(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def undecided(self):
+        """
+        The operation ended without telling whether the database is up:
+        let another one probe it.
+        """
+        with self.lock:
+            self.probing = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= BREAKER_THRESHOLD:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+breaker = _Breaker()
+
+
+# Indexes declared by the data modules, keyed on (db, collection).
+# They are created by ensure_indexes(), which connect_db() runs
+# unless ENSURE_INDEXES is set to "0".
+indexes = {}
+
+# The field holding the user that owns each doc, keyed on
+# (db, collection); the sharded engine routes on it.
+shard_keys = {}
+
+# The field holding each doc's id, keyed on (db, collection); the
+# sharded engine keeps where each id lives so it can route on it.
+id_keys = {}
+
+
+def parse_shards(setting) -> dict:
+    """
+    Parse a setting like "a=mongodb://host1;b=mongodb://host2" into
+    {shard name: connection string}, in order.
+    """
+    shards = {}
+    for item in filter(None, setting.split(';')):
+        name, _, host = item.partition('=')
+        if not host:
+            raise ValueError(f'Bad shard {item!r}: expected name=host.')
+        shards[name.strip()] = host.strip()
+    return shards
+
+
+def _pool_settings() -> dict:
+    """
+    Read the MongoClient pool options set in the environment.
+    Options that are not set keep pymongo's defaults.
+    """
+    settings = {}
+    for env_var, option in POOL_SETTINGS.items():
+        value = os.environ.get(env_var)
+        if value:
+            settings[option] = int(value)
+    return settings
+
+
+def _create_client(client_class=None, host=None):
+    """
+    Build a client for the configured server, or for host.
+    client_class defaults to pymongo's MongoClient; the async data layer
+    passes its own.
+    """
+    client_class = client_class or pm.MongoClient
+    settings = _pool_settings()
+    if host is not None:
+        return client_class(host, **settings)
+    if os.environ.get("CLOUD_MONGO", LOCAL) == CLOUD:
+        password = os.environ.get("MONGODB_PASSWORD")
+        if not password:
+            raise ValueError(
+                'You must set your password '
+                + 'to use Mongo in the cloud.')
+        logger.info('Connecting to Mongo in the cloud.')
+        return client_class(f'mongodb+srv://mirnaashour:{password}'
+                            + '@cluster0.o5mxzdg.mongodb.net/'
+                            + '?retryWrites=true', **settings)
+    logger.info('Connecting to Mongo locally.')
+    return client_class(**settings)
+
+
+def _create_mongo_engine():
+    return mongo.MongoEngine(_create_client(), mongo.clock_for(None))
+
+
+def _create_sqlite_engine():
+    return sqlite.SqliteEngine(SQLITE_PATH)
+
+
+def _create_sharded_engine(engine_class=mongo.MongoEngine,
+                           sharded_class=sharded.ShardedEngine,
+                           client_class=None):
+    """
+    A sharded engine over the mongods in MONGO_SHARDS.
+    The async data layer passes its own classes.
+    """
+    hosts = parse_shards(os.environ.get('MONGO_SHARDS', ''))
+    if not hosts:
+        raise ValueError('You must set MONGO_SHARDS to shard the data.')
+    vnodes = int(os.environ.get('SHARD_VNODES', sharded.VNODES))
+    # Each shard is its own replica set, with its own causal clock.
+    return sharded_class({name: engine_class(_create_client(client_class,
+                                                            host),
+                                             mongo.clock_for(host))
+                          for name, host in hosts.items()},
+                         shard_keys, vnodes, id_keys, indexes)
+
+
+# The engines DB_ENGINE can pick: {name: factory}.
+ENGINES = {
+    MONGO_ENGINE: _create_mongo_engine,
+    MEMORY_ENGINE: memory.MemoryEngine,
+    SQLITE_ENGINE: _create_sqlite_engine,
+    SHARDED_ENGINE: _create_sharded_engine,
+}
+# The engines that talk to mongods, which the async layer does not share.
+NETWORK_ENGINES = [MONGO_ENGINE, SHARDED_ENGINE]
+
+
+def engine_name() -> str:
+    """
+    The name of the configured engine.
+    """
+    name = os.environ.get("DB_ENGINE", MONGO_ENGINE)
+    if name not in ENGINES:
+        raise ValueError(f'Unknown DB_ENGINE: {name}; '
+                         + f'pick one of {sorted(ENGINES)}.')
+    return name
+
+
+def _set_engine(new_engine):
+    global engine, client, _client_pid
+    clear_cache()
+    engine = new_engine
+    client = getattr(new_engine, 'client', None)
+    _client_pid = os.getpid()
+
+
+def _prepare(new_engine):
+    """
+    Create the declared indexes on new_engine before it is published:
+    writes rely on the unique ones to turn away duplicates, so an engine
+    they could not be built on must not be used.
+    """
+    if os.environ.get("ENSURE_INDEXES", "1") != "0":
+        ensure_indexes(new_engine)
 
 
 def connect_db():
     """
     This provides a uniform way to connect to the DB across all uses.
-    Returns a mongo client object... maybe we shouldn't?
-    Also set global client variable.
-    We should probably either return a client OR set a
-    client global.
-    """
-    global client
-    if client is None:  # not connected yet!
-        print("Setting client because it is None.")
-        if os.environ.get("CLOUD_MONGO", LOCAL) == CLOUD:
-            password = os.environ.get("MONGODB_PASSWORD")
-            if not password:
-                raise ValueError(
-                    'You must set your password '
-                    + 'to use Mongo in the cloud.')
-            print("Connecting to Mongo in the cloud.")
-            client = pm.MongoClient(f'mongodb+srv://mirnaashour:{password}'
-                                    + '@cluster0.o5mxzdg.mongodb.net/'
-                                    + '?retryWrites=true')
-            # PA recommends these settings:
-            # + 'connectTimeoutMS=30000&'
-            # + 'socketTimeoutMS=None
-            # + '&connect=false'
-            # + 'maxPoolsize=1')
-            # but they don't seem necessary
+    Sets the global engine (and, for Mongo, the client) the first time it
+    is called in a process and returns the engine.
+    It is safe to call from several threads at once, and a process forked
+    from a connected one (e.g. a gunicorn worker) gets its own client
+    instead of sharing the parent's sockets.
+    """
+    global engine, client
+    if engine is not None and _client_pid == os.getpid():
+        return engine
+    with _client_lock:
+        if engine is not None and _client_pid != os.getpid():
+            # Inherited across a fork: the parent owns those sockets.
+            engine = None
+            client = None
+        if engine is None:  # not connected yet!
+            logger.info('Setting client because it is None.')
+            new_engine = ENGINES[engine_name()]()
+            try:
+                _prepare(new_engine)
+            except Exception:
+                new_engine.close()
+                raise
+            _set_engine(new_engine)
+    return engine
+
+
+def use_engine(new_engine):
+    """
+    Swap in new_engine (e.g. a fresh MemoryEngine in a test) and create
+    the declared indexes on it; if they can not be, the current engine
+    stays.
+    Returns the engine it replaced (or None), so it can be put back.
+    """
+    with _client_lock:
+        old = engine if _client_pid == os.getpid() else None
+        _prepare(new_engine)
+        _set_engine(new_engine)
+    return old
+
+
+def close_db():
+    """
+    Close the engine and its pool.
+    Registered to run at exit; the next connect_db() reconnects.
+    """
+    global engine, client, _client_pid
+    with _client_lock:
+        if engine is not None and _client_pid == os.getpid():
+            engine.close()
+        engine = None
+        client = None
+        _client_pid = None
+
+
+def _reset_after_fork():
+    global engine, client, _client_pid, _client_lock
+    # The lock may have been held by another thread at fork time.
+    _client_lock = threading.Lock()
+    engine = None
+    client = None
+    _client_pid = None
+
+
+atexit.register(close_db)
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def filter_shape(filt):
+    """
+    filt with its values blanked out, so it can be logged without the
+    data in it; e.g. {'user': {'$in': ['?']}}.
+    """
+    if isinstance(filt, dict):
+        return {key: filter_shape(value) for key, value in filt.items()}
+    if isinstance(filt, (list, tuple)):
+        shapes = []
+        for value in filt:
+            shape = filter_shape(value)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return '?'
+
+
+def _record_op(op, collection, filt, elapsed_ms, failed=False):
+    with _op_stats_lock:
+        stats = _op_stats.setdefault((collection, op), {
+            COUNT: 0, TOTAL_MS: 0.0, MAX_MS: 0.0, SLOW: 0, FAILED: 0})
+        stats[COUNT] += 1
+        stats[TOTAL_MS] += elapsed_ms
+        stats[MAX_MS] = max(stats[MAX_MS], elapsed_ms)
+        slow = elapsed_ms >= SLOW_QUERY_MS
+        if slow:
+            stats[SLOW] += 1
+        if failed:
+            stats[FAILED] += 1
+    if slow:
+        logger.warning('Slow %s on %s: %.1f ms, filter %s', op, collection,
+                       elapsed_ms, filter_shape(filt))
+
+
+def start_op_log():
+    """
+    Note every database operation from here on in this context (a
+    request's thread or task).
+    """
+    _op_log.set([])
+
+
+def stop_op_log():
+    _op_log.set(None)
+
+
+def get_op_log() -> list:
+    """
+    (collection, operation) for each operation started in this context
+    since start_op_log(), in order. Reads answered from the cache are
+    not operations.
+    """
+    log = _op_log.get()
+    return [] if log is None else list(log)
+
+
+def log_op(op, collection):
+    log = _op_log.get()
+    if log is not None:
+        log.append((collection, op))
+
+
+def set_deadline(seconds):
+    """
+    Give everything from here on in this context (a request's thread or
+    task) seconds to finish; None removes the deadline.
+    Returns a token for reset_deadline().
+    """
+    if seconds is None:
+        return _deadline.set(None)
+    return _deadline.set(time.monotonic() + seconds)
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    token = set_deadline(seconds)
+    try:
+        yield
+    finally:
+        reset_deadline(token)
+
+
+def remaining_time():
+    """
+    The seconds left before the deadline, or None if there is none.
+    """
+    at = _deadline.get()
+    if at is None:
+        return None
+    return at - time.monotonic()
+
+
+@contextlib.contextmanager
+def within_deadline(op, collection):
+    """
+    Run the database operation in the with block in the time left before
+    the deadline, raising DeadlineExceeded if there is none or it runs
+    out. pymongo turns the budget into maxTimeMS and socket timeouts.
+    """
+    left = remaining_time()
+    if left is None:
+        yield
+        return
+    if left <= 0:
+        raise DeadlineExceeded(f'No time left for {op} on {collection}.')
+    try:
+        with pm.timeout(left):
+            yield
+    except pm.errors.PyMongoError as err:
+        if err.timeout:
+            raise DeadlineExceeded(
+                f'{op} on {collection} ran out of time.') from err
+        raise
+
+
+def is_outage(err) -> bool:
+    """
+    Did err come from failing to reach the database, rather than from
+    the database refusing the operation?
+    """
+    return (isinstance(err, pm.errors.ConnectionFailure)
+            or isinstance(err.__cause__, pm.errors.ConnectionFailure))
+
+
+@contextlib.contextmanager
+def circuit():
+    """
+    Run the database operation in the with block through the breaker.
+    """
+    breaker.before()
+    try:
+        yield
+    except DeadlineExceeded:
+        # The request ran out of time, even if pymongo saw that as a
+        # network timeout; slow queries under load are not an outage.
+        breaker.undecided()
+        raise
+    except Exception as err:
+        if is_outage(err):
+            breaker.failed()
+        else:
+            breaker.succeeded()
+        raise
+    breaker.succeeded()
+
+
+def get_breaker_state() -> dict:
+    with breaker.lock:
+        return {STATE: breaker.state, FAILURES: breaker.failures}
+
+
+def reset_breaker():
+    breaker.succeeded()
+
+
+@contextlib.contextmanager
+def guarded(op, collection):
+    """
+    Run the database operation in the with block through the breaker and
+    within the deadline.
+    """
+    with circuit():
+        with within_deadline(op, collection):
+            yield
+
+
+def retry_delay(attempt):
+    """
+    How long to wait before retrying a read that failed attempt times,
+    or None to give up: out of retries, or the wait would use up the
+    time left before the deadline.
+    """
+    if attempt > READ_RETRIES:
+        return None
+    delay = random.uniform(0, READ_RETRY_BACKOFF_MS * 2 ** (attempt - 1))
+    delay /= 1000
+    left = remaining_time()
+    if left is not None and delay >= left:
+        return None
+    return delay
+
+
+def set_allow_stale(allow: bool):
+    """
+    Let reads in this context (a request's thread or task) return their
+    last good result while the database is out.
+    """
+    return _allow_stale.set(allow)
+
+
+def _stale_get(key):
+    with _stale_lock:
+        if key not in _stale:
+            return False, None
+        _stale.move_to_end(key)
+        return True, copy.deepcopy(_stale[key])
+
+
+def _stale_put(key, result):
+    if not STALE_CACHE_SIZE:
+        return
+    with _stale_lock:
+        _stale[key] = copy.deepcopy(result)
+        _stale.move_to_end(key)
+        while len(_stale) > STALE_CACHE_SIZE:
+            _stale.popitem(last=False)
+
+
+def stale_fallback(key, err):
+    """
+    The last good result for key if err is an outage and stale reads are
+    allowed here; otherwise raise err.
+    """
+    if (isinstance(err, CircuitOpenError) or is_outage(err)) \
+            and _allow_stale.get():
+        hit, result = _stale_get(key)
+        if hit:
+            logger.warning('Serving a stale %s on %s: %s', key[2], key[1],
+                           err)
+            return result
+    raise err
+
+
+def _read(name, collection, db, args, read, read_pref=PRIMARY):
+    """
+    Run the idempotent read read(), or wait on an identical one already
+    running (see SINGLE_FLIGHT). Retries it if it fails to reach the
+    database, and remembers the result in case the database goes out.
+    Reads with another read_pref are never shared: a primary read must
+    see the writes before it.
+    """
+    key = (db, collection, name, repr(args), read_pref)
+    try:
+        if SINGLE_FLIGHT:
+            return _single_flight(key, read)
+        return _read_fresh(key, read)
+    except (pm.errors.ConnectionFailure, CircuitOpenError,
+            DeadlineExceeded) as err:
+        return stale_fallback(key, err)
+
+
+def _read_fresh(key, read):
+    attempt = 0
+    while True:
+        try:
+            result = read()
+            break
+        except pm.errors.ConnectionFailure:
+            attempt += 1
+            delay = retry_delay(attempt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+    _stale_put(key, result)
+    return result
+
+
+def _single_flight(key, read):
+    db, collection, name = key[:3]
+    # A read that starts after a write must not get an answer from
+    # before it, so the flights of each generation are separate.
+    flight_key = key + (_cache_generation(db, collection),)
+    with _flights_lock:
+        flight = _flights.get(flight_key)
+        if flight is None:
+            flight = _flights[flight_key] = _Flight()
+            _flight_stats[LEADERS] += 1
+            leader = True
         else:
-            print("Connecting to Mongo locally.")
-            client = pm.MongoClient()
+            flight.waiters += 1
+            _flight_stats[COALESCED] += 1
+            leader = False
+    if leader:
+        return _lead(flight_key, flight, key, read)
+    if not flight.done.wait(remaining_time()):
+        raise DeadlineExceeded(f'No time left waiting on {name} '
+                               f'on {collection}.')
+    if isinstance(flight.error, DeadlineExceeded):
+        # That was the leader's deadline, not ours.
+        return _read_fresh(key, read)
+    if flight.error is not None:
+        raise flight.error
+    return copy.deepcopy(flight.result)
+
+
+def _lead(flight_key, flight, key, read):
+    """
+    Make the read for everyone waiting on flight.
+    """
+    try:
+        result = _read_fresh(key, read)
+    except BaseException as err:
+        flight.error = err
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[flight_key]
+            waiters = flight.waiters
+        if flight.error is None and waiters:
+            # The caller may change its result; the waiters get a copy.
+            flight.result = copy.deepcopy(result)
+        flight.done.set()
+    return result
+
+
+def get_single_flight_stats() -> dict:
+    """
+    {LEADERS: reads that went to the database,
+     COALESCED: reads that waited on one of them instead}
+    """
+    with _flights_lock:
+        return dict(_flight_stats)
+
+
+@contextlib.contextmanager
+def timed(op, collection, filt=None):
+    """
+    Time and count the operation run in the with block, through the
+    breaker and within the deadline.
+    """
+    log_op(op, collection)
+    start = time.perf_counter()
+    failed = False
+    try:
+        with guarded(op, collection):
+            yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        _record_op(op, collection, filt,
+                   (time.perf_counter() - start) * 1000, failed)
+
+
+def _timed_iter(op, collection, filt, find):
+    """
+    Iterate over the docs find() returns, counting only the time spent
+    waiting on the database as the operation's duration.
+    """
+    elapsed = 0.0
+    failed = False
+    iterator = None
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                with guarded(op, collection):
+                    if iterator is None:
+                        log_op(op, collection)
+                        iterator = iter(find())
+                    doc = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield doc
+    except Exception:
+        failed = True
+        raise
+    finally:
+        _record_op(op, collection, filt, elapsed * 1000, failed)
+
+
+def get_op_stats() -> dict:
+    """
+    The counters for every operation run since the process started (or
+    reset_op_stats() was called):
+        {collection: {operation: {COUNT: n, TOTAL_MS: ms, MAX_MS: ms,
+                                  SLOW: n, FAILED: n}}}
+    """
+    ret = {}
+    with _op_stats_lock:
+        for (collection, op), stats in _op_stats.items():
+            ret.setdefault(collection, {})[op] = dict(stats)
+    return ret
+
+
+def reset_op_stats():
+    with _op_stats_lock:
+        _op_stats.clear()
+
+
+def set_cache_ttl(collection, seconds):
+    """
+    Keep collection's docs in the read cache for seconds (0 for never).
+    """
+    CACHE_TTLS[collection] = seconds
+
+
+def _cache_key(db, collection, filt, projection):
+    return (db, collection, repr(filt), repr(projection))
+
+
+def _cache_get(key):
+    """
+    Returns (hit, doc).
+    """
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            expiry, generation, doc = entry
+            if generation != _cache_generations.get(key[:2], 0):
+                del _cache[key]
+                _cache_stats[INVALIDATIONS] += 1
+            elif expiry <= time.monotonic():
+                del _cache[key]
+                _cache_stats[EXPIRATIONS] += 1
+            else:
+                _cache.move_to_end(key)
+                _cache_stats[HITS] += 1
+                return True, copy.deepcopy(doc)
+        _cache_stats[MISSES] += 1
+        return False, None
+
+
+def _cache_put(key, generation, doc):
+    """
+    Cache doc, unless the collection was written to since generation was
+    read: the doc may predate the write.
+    """
+    ttl = CACHE_TTLS.get(key[1], CACHE_TTL)
+    if ttl <= 0:
+        return
+    with _cache_lock:
+        if generation != _cache_generations.get(key[:2], 0):
+            return
+        _cache[key] = (time.monotonic() + ttl, generation,
+                       copy.deepcopy(doc))
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+            _cache_stats[EVICTIONS] += 1
+
+
+def _cache_generation(db, collection):
+    with _cache_lock:
+        return _cache_generations.get((db, collection), 0)
+
+
+def invalidate_cache(collection, db=JOURNALS_DB):
+    """
+    Forget the cached reads of collection.
+    Every write through this module calls it.
+    """
+    with _cache_lock:
+        key = (db, collection)
+        _cache_generations[key] = _cache_generations.get(key, 0) + 1
+
+
+@contextlib.contextmanager
+def writing(op, collection, filt=None, db=JOURNALS_DB):
+    """
+    Time the write in the with block and invalidate the cached reads of
+    collection afterwards, whether or not it succeeded.
+    """
+    try:
+        with timed(op, collection, filt):
+            yield
+    finally:
+        invalidate_cache(collection, db)
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+        for stat in _cache_stats:
+            _cache_stats[stat] = 0
+
+
+def get_cache_stats() -> dict:
+    """
+    {HITS: n, MISSES: n, EVICTIONS: n, EXPIRATIONS: n, INVALIDATIONS: n,
+     SIZE: n, HIT_RATIO: hits / lookups}
+    """
+    with _cache_lock:
+        stats = dict(_cache_stats)
+        stats[SIZE] = len(_cache)
+    lookups = stats[HITS] + stats[MISSES]
+    stats[HIT_RATIO] = stats[HITS] / lookups if lookups else 0.0
+    return stats
+
+
+def index(*keys, unique=False):
+    """
+    Describe an index over keys, in order.
+    Each key is either a field name (ascending) or a (field, direction) pair.
+    The name is the one Mongo would generate, so reports line up with
+    indexes created by hand.
+    """
+    keys = [(key, ASCENDING) if isinstance(key, str) else tuple(key)
+            for key in keys]
+    name = '_'.join(f'{field}_{direction}' for field, direction in keys)
+    return {INDEX_NAME: name, INDEX_KEYS: keys, INDEX_UNIQUE: unique}
+
+
+def register_indexes(collection, specs, db=JOURNALS_DB):
+    """
+    Declare the indexes a collection needs.
+    Data modules call this at import time; if we are already connected
+    the indexes are created right away.
+    """
+    declared = indexes.setdefault((db, collection), {})
+    for spec in specs:
+        declared[spec[INDEX_NAME]] = spec
+    if engine is not None and os.environ.get("ENSURE_INDEXES", "1") != "0":
+        _create_indexes(collection, specs, db)
+
+
+def register_shard_key(collection, field, db=JOURNALS_DB):
+    """
+    Declare the field of collection that holds the owning user, which
+    the sharded engine puts the docs on their shard by.
+    """
+    shard_keys[(db, collection)] = field
+
+
+def register_id_key(collection, field, db=JOURNALS_DB):
+    """
+    Declare the field of collection that holds each doc's id, which
+    the sharded engine routes operations on one doc by.
+    """
+    id_keys[(db, collection)] = field
+
+
+def _create_indexes(collection, specs, db=JOURNALS_DB, target=None):
+    if not specs:
+        return
+    target = engine if target is None else target
+    try:
+        with timed('create_indexes', collection):
+            target.create_indexes(db, collection, specs)
+    except pm.errors.OperationFailure as err:
+        if err.code not in INDEX_CONFLICTS:
+            raise
+        for spec in specs:
+            _replace_index(collection, spec, db, target)
+
+
+def _replace_index(collection, spec, db=JOURNALS_DB, target=None):
+    """
+    Create spec, first dropping an index of the same name that was
+    declared with other options.
+    If spec is unique and the docs are not, the old index is put back
+    and the DuplicateKeyError raised.
+    """
+    target = engine if target is None else target
+    try:
+        with timed('create_indexes', collection):
+            target.create_indexes(db, collection, [spec])
+        return
+    except pm.errors.OperationFailure as err:
+        if err.code not in INDEX_CONFLICTS:
+            raise
+    logger.warning('Rebuilding index %s on %s with new options.',
+                   spec[INDEX_NAME], collection)
+    drop_index(collection, spec[INDEX_NAME], db, target)
+    try:
+        with timed('create_indexes', collection):
+            target.create_indexes(db, collection, [spec])
+    except DuplicateKeyError:
+        with timed('create_indexes', collection):
+            target.create_indexes(db, collection,
+                                  [{**spec, INDEX_UNIQUE: False}])
+        raise
+
+
+def drop_index(collection, name, db=JOURNALS_DB, target=None):
+    target = engine if target is None else target
+    with timed('drop_index', collection):
+        target.drop_index(db, collection, name)
+
+
+def ensure_indexes(target=None):
+    """
+    Create every declared index that does not exist yet, on target or
+    else the current engine.
+    Creating an index that already exists is a no-op, so this is safe
+    to run on every start-up.
+    """
+    for (db, collection), declared in indexes.items():
+        _create_indexes(collection, list(declared.values()), db, target)
+
+
+def index_report() -> dict:
+    """
+    Compare the declared indexes with the ones in the database.
+    Returns {collection: {MISSING: [names], EXTRA: [names]}}.
+    """
+    report = {}
+    for (db, collection), declared in indexes.items():
+        with timed('index_names', collection):
+            existing = set(engine.index_names(db, collection))
+        existing.discard(MONGO_ID_INDEX)
+        report[collection] = {
+            MISSING: sorted(set(declared) - existing),
+            EXTRA: sorted(existing - set(declared)),
+        }
+    return report
 
 
 def insert_one(collection, doc, db=JOURNALS_DB):
     """
     Insert a single doc into collection.
+    Raises DuplicateKeyError if it clashes with a unique index.
     """
-    print(f'{db=}')
-    return client[db][collection].insert_one(doc)
+    with writing('insert_one', collection, db=db):
+        return engine.insert_one(db, collection, doc)
 
 
-def fetch_one(collection, filt, db=JOURNALS_DB):
+def duplicate_fields(err) -> list:
+    """
+    The fields of the unique index a DuplicateKeyError is about, or []
+    if the error does not say.
+    """
+    return list((err.details or {}).get('keyPattern', {}))
+
+
+def _projection(fields, key=None):
+    """
+    Turn a list of field names into a Mongo projection.
+    None means the whole document.
+    If key is given it is always returned and the Mongo ID is left out.
+    """
+    if fields is None:
+        return None
+    projection = {field: 1 for field in fields}
+    if key is not None:
+        projection[key] = 1
+        projection[MONGO_ID] = 0
+    return projection
+
+
+def insert_many(collection, docs, ordered=True, db=JOURNALS_DB) -> dict:
+    """
+    Insert docs into collection in as few round trips as possible.
+    If ordered, stop at the first failure; otherwise try every doc.
+    Returns a bulk write report (see bulk_write).
+    """
+    return bulk_write(collection, [insert_op(doc) for doc in docs],
+                      ordered, db)
+
+
+def insert_many_checked(collection, items, make_doc, db=JOURNALS_DB) -> dict:
+    """
+    Build a doc from each item with make_doc and insert the good ones
+    in as few round trips as possible.
+    make_doc raises KeyError, TypeError or ValueError for a bad item.
+    Returns a bulk write report whose ERRORS cover both bad items and
+    failed inserts, with ITEM_INDEX the item's position in items.
+    """
+    errors = []
+    docs = []
+    positions = []
+    for position, item in enumerate(items):
+        try:
+            docs.append(make_doc(item))
+        except KeyError as err:
+            errors.append({ITEM_INDEX: position,
+                           MESSAGE: f'Missing field {err}.'})
+            continue
+        except (TypeError, ValueError) as err:
+            errors.append({ITEM_INDEX: position, MESSAGE: str(err)})
+            continue
+        positions.append(position)
+    report = insert_many(collection, docs, ordered=False, db=db)
+    for error in report[ERRORS]:
+        error[ITEM_INDEX] = positions[error[ITEM_INDEX]]
+    report[ERRORS] = sorted(errors + report[ERRORS],
+                            key=lambda error: error[ITEM_INDEX])
+    return report
+
+
+def update_many(collection, filt, update_dict, db=JOURNALS_DB):
+    """
+    Update every doc in collection matching filt.
+    """
+    with writing('update_many', collection, filt, db=db):
+        return engine.update_many(db, collection, filt,
+                                  {'$set': update_dict})
+
+
+def delete_many(collection, filt, db=JOURNALS_DB):
+    """
+    Delete every doc in collection matching filt.
+    """
+    with writing('delete_many', collection, filt, db=db):
+        return engine.delete_many(db, collection, filt)
+
+
+def insert_op(doc) -> dict:
+    return {OP: INSERT, DOC: doc}
+
+
+def update_op(filt, update_dict) -> dict:
+    return {OP: UPDATE, FILTER: filt, DOC: {'$set': update_dict}}
+
+
+def inc_op(filt, counts, update_dict=None) -> dict:
+    return {OP: UPDATE, FILTER: filt, DOC: _inc_update(counts, update_dict)}
+
+
+def _inc_update(counts, update_dict=None) -> dict:
+    update = {'$inc': counts}
+    if update_dict:
+        update['$set'] = update_dict
+    return update
+
+
+def unset_op(filt, fields) -> dict:
+    return {OP: UPDATE, FILTER: filt,
+            DOC: {'$unset': {field: '' for field in fields}}}
+
+
+def delete_op(filt) -> dict:
+    return {OP: DELETE, FILTER: filt}
+
+
+def bulk_write(collection, ops, ordered=True, db=JOURNALS_DB) -> dict:
+    """
+    Send a list of insert_op/update_op/delete_op operations to collection
+    together.
+    If ordered, stop at the first failure; otherwise try every operation.
+    Returns a report:
+        {INSERTED: n, MATCHED: n, MODIFIED: n, DELETED: n,
+         ERRORS: [{ITEM_INDEX: position in ops, CODE: code,
+                  MESSAGE: text}]}
+    """
+    if not ops:
+        return _bulk_report()
+    with writing('bulk_write', collection, db=db):
+        details = engine.bulk_write(db, collection, ops, ordered)
+    return _bulk_report(details)
+
+
+def _bulk_report(details=None) -> dict:
+    """
+    Turn an engine's bulk write result details into our report.
+    """
+    report = {INSERTED: 0, MATCHED: 0, MODIFIED: 0, DELETED: 0, ERRORS: []}
+    if details is None:
+        return report
+    report[INSERTED] = details['nInserted']
+    report[MATCHED] = details['nMatched']
+    report[MODIFIED] = details['nModified']
+    report[DELETED] = details['nRemoved']
+    for error in details['writeErrors']:
+        report[ERRORS].append({ITEM_INDEX: error['index'],
+                               CODE: error['code'],
+                               MESSAGE: error['errmsg']})
+    return report
+
+
+def fetch_one(collection, filt, fields=None, db=JOURNALS_DB):
     """
     Find with a filter and return on the first doc found.
+    If fields is given only those fields are returned.
+    Served from the read cache when it is on.
     """
-    for doc in client[db][collection].find(filt):
+    if CACHE_SIZE:
+        key = _cache_key(db, collection, filt, fields)
+        hit, doc = _cache_get(key)
+        if hit:
+            return doc
+        generation = _cache_generation(db, collection)
+    doc = _read('fetch_one', collection, db, (filt, fields),
+                lambda: _fetch_one(collection, filt, fields, db))
+    if CACHE_SIZE:
+        _cache_put(key, generation, doc)
+    return doc
+
+
+def _fetch_one(collection, filt, fields=None, db=JOURNALS_DB):
+    with timed('find_one', collection, filt):
+        docs = list(engine.find(db, collection, filt, _projection(fields),
+                                limit=1))
+    for doc in docs:
         if MONGO_ID in doc:
             # Convert mongo ID to a string so it works as JSON
             doc[MONGO_ID] = str(doc[MONGO_ID])
@@ -65,28 +1283,269 @@ def fetch_one(collection, filt, db=JOURNALS_DB):
 
 def del_one(collection, filt, db=JOURNALS_DB):
     """
-    Find with a filter and return on the first doc found.
+    Delete the first doc in collection matching filt.
+    The result's deleted_count says whether there was one.
     """
-    client[db][collection].delete_one(filt)
+    with writing('delete_one', collection, filt, db=db):
+        return engine.delete_one(db, collection, filt)
 
 
 def update_doc(collection, filters, update_dict, db=JOURNALS_DB):
     """
     Update a single doc in collection based on filter.
+    The result's matched_count says whether there was one.
     """
-    return client[db][collection].update_one(filters, {'$set': update_dict})
+    with writing('update_one', collection, filters, db=db):
+        return engine.update_one(db, collection, filters,
+                                 {'$set': update_dict})
 
 
-def fetch_all(collection, db=JOURNALS_DB):
-    ret = []
-    for doc in client[db][collection].find():
-        ret.append(doc)
-    return ret
+def increment(collection, filters, counts, update_dict=None,
+              db=JOURNALS_DB):
+    """
+    Add counts ({field: amount}) to the fields of a single doc in
+    collection, and set update_dict's fields in the same write.
+    """
+    with writing('update_one', collection, filters, db=db):
+        return engine.update_one(db, collection, filters,
+                                 _inc_update(counts, update_dict))
 
 
-def fetch_all_as_dict(key, collection, db=JOURNALS_DB):
-    ret = {}
-    for doc in client[db][collection].find():
-        del doc[MONGO_ID]
-        ret[doc[key]] = doc
-    return ret
+def unset_fields(collection, filters, fields, db=JOURNALS_DB):
+    """
+    Remove fields (dot paths allowed) from a single doc in collection.
+    """
+    with writing('update_one', collection, filters, db=db):
+        return engine.update_one(db, collection, filters,
+                                 {'$unset': {field: '' for field in fields}})
+
+
+def _find(collection, filt=None, projection=None, sort=None, limit=0,
+          skip=0, batch_size=0, db=JOURNALS_DB, read_pref=PRIMARY):
+    """
+    Iterate over the docs in collection matching filt.
+    sort is a list of (field, direction) pairs.
+    """
+    if read_pref not in READ_PREFERENCES:
+        raise ValueError(f'Unknown read preference: {read_pref}; '
+                         + f'pick one of {READ_PREFERENCES}.')
+    return _timed_iter('find', collection, filt,
+                       lambda: engine.find(db, collection, filt or {},
+                                           projection, sort, limit, skip,
+                                           batch_size, read_pref))
+
+
+def iter_docs(collection, filt=None, fields=None, batch_size=BATCH_SIZE,
+              sort=None, limit=0, skip=0, db=JOURNALS_DB, read_pref=PRIMARY):
+    """
+    Yield the docs matching filt as the cursor streams them in, so at most
+    batch_size docs are held in memory at a time.
+    If fields is given only those fields are returned.
+    read_pref picks the replica set members the read may go to.
+    """
+    for doc in _find(collection, filt, _projection(fields), sort, limit,
+                     skip, batch_size, db, read_pref):
+        if MONGO_ID in doc:
+            doc[MONGO_ID] = str(doc[MONGO_ID])
+        yield doc
+
+
+def fetch_many(collection, filt=None, fields=None, sort=None, limit=0,
+               skip=0, db=JOURNALS_DB, read_pref=PRIMARY):
+    """
+    Find all docs matching filt and return them as a list.
+    The filtering, sorting and paging is done by the database.
+    If fields is given only those fields are returned.
+    """
+    return _read('fetch_many', collection, db,
+                 (filt, fields, sort, limit, skip),
+                 lambda: list(iter_docs(collection, filt, fields, 0, sort,
+                                        limit, skip, db, read_pref)),
+                 read_pref)
+
+
+def fetch_many_as_dict(key, collection, filt=None, fields=None, sort=None,
+                       limit=0, skip=0, db=JOURNALS_DB, read_pref=PRIMARY):
+    """
+    Find all docs matching filt and return them as a dict keyed on key.
+    If fields is given only those fields (and key) are returned.
+    """
+    def read():
+        ret = {}
+        for doc in _find(collection, filt, _projection(fields, key), sort,
+                         limit, skip, db=db, read_pref=read_pref):
+            doc.pop(MONGO_ID, None)
+            ret[doc[key]] = doc
+        return ret
+    return _read('fetch_many_as_dict', collection, db,
+                 (key, filt, fields, sort, limit, skip), read, read_pref)
+
+
+def fetch_all(collection, fields=None, db=JOURNALS_DB, read_pref=PRIMARY):
+    return _read('fetch_all', collection, db, (fields,),
+                 lambda: list(_find(collection, {}, _projection(fields),
+                                    db=db, read_pref=read_pref)),
+                 read_pref)
+
+
+def fetch_all_as_dict(key, collection, fields=None, db=JOURNALS_DB,
+                      read_pref=PRIMARY):
+    return fetch_many_as_dict(key, collection, fields=fields, db=db,
+                              read_pref=read_pref)
+
+
+def text_filter(query) -> dict:
+    """
+    A filter for the docs that contain any word of query in a field of
+    their collection's text index (see TEXT).
+    """
+    return {'$text': {'$search': query}}
+
+
+# The size of each fixed-size BSON value, by type byte.
+BSON_VALUE_SIZES = {
+    0x01: 8,   # double
+    0x06: 0,   # undefined
+    0x07: 12,  # ObjectId
+    0x08: 1,   # bool
+    0x09: 8,   # datetime
+    0x0A: 0,   # null
+    0x10: 4,   # int32
+    0x11: 8,   # timestamp
+    0x12: 8,   # int64
+    0x13: 16,  # decimal128
+    0x7F: 0,   # max key
+    0xFF: 0,   # min key
+}
+
+
+def _bson_value_size(raw, pos, kind) -> int:
+    if kind in BSON_VALUE_SIZES:
+        return BSON_VALUE_SIZES[kind]
+    (length,) = struct.unpack_from('<i', raw, pos)
+    if kind in (0x02, 0x0D, 0x0E):  # string, code, symbol
+        return 4 + length
+    if kind in (0x03, 0x04, 0x0F):  # document, array, code with scope
+        return length
+    if kind == 0x05:  # binary
+        return 4 + 1 + length
+    if kind == 0x0C:  # DBPointer
+        return 4 + length + 12
+    if kind == 0x0B:  # regex: two C strings
+        end = raw.index(b'\x00', raw.index(b'\x00', pos) + 1)
+        return end + 1 - pos
+    raise ValueError(f'Unknown BSON type: {kind:#x}')
+
+
+def raw_field(raw: bytes, name: str, default=None):
+    """
+    Read the top-level field name of the BSON document raw, skipping
+    over the other fields rather than decoding them.
+    """
+    target = name.encode()
+    pos = 4
+    while raw[pos] != 0:
+        start = pos
+        kind = raw[pos]
+        name_end = raw.index(b'\x00', pos + 1)
+        pos = name_end + 1
+        pos += _bson_value_size(raw, pos, kind)
+        if raw[start + 1:name_end] == target:
+            element = raw[start:pos]
+            doc = struct.pack('<i', len(element) + 5) + element + b'\x00'
+            return bson.decode(doc)[name]
+    return default
+
+
+def utc_now() -> datetime:
+    """
+    The time to store for now.
+    """
+    return datetime.now(timezone.utc).replace(microsecond=0, tzinfo=None)
+
+
+def format_datetime(value: datetime) -> str:
+    return value.strftime(DATETIME_FORMAT)
+
+
+def parse_datetime(text: str) -> datetime:
+    """
+    The datetime for DATETIME_FORMAT text; raises ValueError for other text.
+    """
+    return datetime.strptime(text, DATETIME_FORMAT)
+
+
+def json_default(value):
+    """
+    json.dumps's default for the values in our docs that JSON lacks.
+    """
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _dates_as_text(raw: bytes) -> bytes:
+    """
+    raw with its top-level datetimes turned into DATETIME_FORMAT strings,
+    done on the bytes so the rest of the document is never decoded.
+    """
+    parts = []
+    last = pos = 4
+    while raw[pos] != 0:
+        start = pos
+        kind = raw[pos]
+        name_end = raw.index(b'\x00', pos + 1)
+        pos = name_end + 1
+        size = _bson_value_size(raw, pos, kind)
+        if kind == 0x09:  # UTC datetime
+            (ms,) = struct.unpack_from('<q', raw, pos)
+            text = format_datetime(
+                BSON_EPOCH + timedelta(milliseconds=ms)).encode()
+            parts.append(raw[last:start])
+            parts.append(b'\x02' + raw[start + 1:pos]
+                         + struct.pack('<i', len(text) + 1) + text + b'\x00')
+            last = pos + size
+        pos += size
+    if not parts:
+        return raw
+    body = b''.join(parts) + raw[last:]
+    return struct.pack('<i', len(body) + 4) + body
+
+
+def raw_to_json(raw: bytes) -> str:
+    """
+    The JSON for the BSON document raw, with its dates shown as the API
+    shows them.
+    """
+    raw = _dates_as_text(raw)
+    if bsonjs is not None:
+        return bsonjs.dumps(raw)
+    return json_util.dumps(bson.decode(raw),
+                           json_options=json_util.RELAXED_JSON_OPTIONS)
+
+
+def iter_raw(collection, filt=None, projection=None, sort=None, limit=0,
+             skip=0, db=JOURNALS_DB, read_pref=PRIMARY):
+    """
+    Yield the docs matching filt as BSON bytes, undecoded.
+    """
+    if read_pref not in READ_PREFERENCES:
+        raise ValueError(f'Unknown read preference: {read_pref}; '
+                         + f'pick one of {READ_PREFERENCES}.')
+    return _timed_iter('find', collection, filt,
+                       lambda: engine.find_raw(db, collection, filt or {},
+                                               projection, sort, limit,
+                                               skip, BATCH_SIZE, read_pref))
+
+
+def iter_json_items(key, collection, filt=None, fields=None, sort=None,
+                    limit=0, skip=0, db=JOURNALS_DB, read_pref=PRIMARY):
+    """
+    Yield the members of the JSON object fetch_many_as_dict would return,
+    as '"<key>": {<doc>}' strings, going straight from the BSON the
+    database sends to JSON.
+    """
+    projection = _projection(fields, key) or {MONGO_ID: 0}
+    for raw in iter_raw(collection, filt, projection, sort, limit, skip, db,
+                        read_pref):
+        yield f'{json.dumps(str(raw_field(raw, key)))}: {raw_to_json(raw)}'
@@ -0,0 +1,4 @@
+"""
+Storage engines that data.db_connect dispatches to.
+Each engine implements data.engines.base.Engine.
+"""
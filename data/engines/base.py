@@ -0,0 +1,218 @@
+"""
+The interface every storage engine implements.
+Filters, projections and updates use Mongo's syntax; engines that are
+not Mongo implement the subset in data.engines.query.
+"""
+import asyncio
+
+import bson
+
+# Bulk write operations.
+OP = 'op'
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+DOC = 'doc'
+FILTER = 'filter'
+
+# Read preferences.
+PRIMARY = 'primary'
+SECONDARY_PREFERRED = 'secondaryPreferred'
+NEAREST = 'nearest'
+READ_PREFERENCES = [PRIMARY, SECONDARY_PREFERRED, NEAREST]
+
+# Index specs.
+INDEX_NAME = 'name'
+INDEX_KEYS = 'keys'
+INDEX_UNIQUE = 'unique'
+# The direction of a key in a full text index.
+TEXT = 'text'
+
+
+# Query plans, as summarized by Engine.explain.
+STAGE = 'stage'
+COLLSCAN = 'COLLSCAN'
+IXSCAN = 'IXSCAN'
+INDEX = 'index'
+IN_MEMORY_SORT = 'in_memory_sort'
+KEYS_EXAMINED = 'keys_examined'
+DOCS_EXAMINED = 'docs_examined'
+RETURNED = 'returned'
+MONGO_ID_INDEX = '_id_'
+
+
+def text_fields(spec) -> list:
+    return [field for field, direction in spec[INDEX_KEYS]
+            if direction == TEXT]
+
+
+def options_conflict(existing, spec) -> bool:
+    """
+    Is existing, an index of the same name as spec, declared differently?
+    Mongo will not create spec over it without dropping it first.
+    """
+    return (existing is not None
+            and bool(existing.get(INDEX_UNIQUE)) != bool(spec[INDEX_UNIQUE]))
+
+
+def sort_covered(specs, pinned, sort) -> bool:
+    """
+    Could one of the indexes in specs return the docs in sort order,
+    given the filter pins the fields in pinned to one value each?
+    That takes an index on the pinned fields (in any order) followed by
+    the sort fields, all in the same or all in the opposite direction.
+    """
+    # A sort on a pinned field orders nothing.
+    sort = [(field, direction) for field, direction in sort or []
+            if field not in pinned]
+    if not sort:
+        return True
+    for spec in specs:
+        if text_fields(spec):
+            continue
+        keys = list(spec[INDEX_KEYS])
+        prefix = [field for field, _ in keys[:len(pinned)]]
+        if set(prefix) != set(pinned):
+            continue
+        rest = keys[len(pinned):len(pinned) + len(sort)]
+        if [field for field, _ in rest] != [field for field, _ in sort]:
+            continue
+        signs = {direction * index_direction
+                 for (_, direction), (_, index_direction) in zip(sort, rest)}
+        if len(signs) == 1:
+            return True
+    return False
+
+
+class Engine:
+    """
+    A storage engine.
+    Every method takes the database and collection name first.
+    find returns an iterable of docs; the single-doc writes return
+    pymongo's InsertOneResult/UpdateResult/DeleteResult; bulk_write
+    returns pymongo's bulk_api_result dict (nInserted, nMatched,
+    nModified, nRemoved, writeErrors), whether or not some writes failed.
+    find's read_pref is one of READ_PREFERENCES; engines without
+    replicas ignore it.
+    """
+    name = None
+
+    def find(self, db, collection, filt=None, projection=None, sort=None,
+             limit=0, skip=0, batch_size=0, read_pref=PRIMARY):
+        raise NotImplementedError()
+
+    def find_raw(self, db, collection, filt=None, projection=None,
+                 sort=None, limit=0, skip=0, batch_size=0,
+                 read_pref=PRIMARY):
+        """
+        find, yielding each doc as the bytes of its BSON encoding.
+        """
+        for doc in self.find(db, collection, filt, projection, sort, limit,
+                             skip, batch_size, read_pref):
+            yield bson.encode(doc)
+
+    def insert_one(self, db, collection, doc):
+        raise NotImplementedError()
+
+    def update_one(self, db, collection, filt, update):
+        raise NotImplementedError()
+
+    def update_many(self, db, collection, filt, update):
+        raise NotImplementedError()
+
+    def delete_one(self, db, collection, filt):
+        raise NotImplementedError()
+
+    def delete_many(self, db, collection, filt):
+        raise NotImplementedError()
+
+    def bulk_write(self, db, collection, ops, ordered=True) -> dict:
+        raise NotImplementedError()
+
+    def create_indexes(self, db, collection, specs):
+        raise NotImplementedError()
+
+    def index_names(self, db, collection) -> list:
+        raise NotImplementedError()
+
+    def drop_index(self, db, collection, name):
+        raise NotImplementedError()
+
+    def explain(self, db, collection, filt=None, sort=None) -> dict:
+        """
+        Run find(filt, sort) and summarize how the engine answered it:
+        {STAGE: COLLSCAN or IXSCAN, INDEX: name or None,
+         IN_MEMORY_SORT: bool, KEYS_EXAMINED: n, DOCS_EXAMINED: n,
+         RETURNED: n}.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class AsyncAdapter:
+    """
+    Present a synchronous engine with the async engine interface: the
+    same methods as coroutines, and find returning an async iterator.
+    Meant for engines that do not block, like the in-memory one.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.name = engine.name
+
+    def find(self, *args, **kwargs):
+        return _AsyncIterator(self.engine.find(*args, **kwargs))
+
+    def __getattr__(self, attr):
+        method = getattr(self.engine, attr)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class ThreadAdapter(AsyncAdapter):
+    """
+    An AsyncAdapter for engines that block on disk, like the SQLite one:
+    each call runs in a worker thread, off the event loop.
+    """
+    def find(self, *args, **kwargs):
+        return _ThreadIterator(lambda: list(self.engine.find(*args,
+                                                             **kwargs)))
+
+    def __getattr__(self, attr):
+        method = getattr(self.engine, attr)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return call
+
+
+class _AsyncIterator:
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class _ThreadIterator(_AsyncIterator):
+    """
+    Run read() in a worker thread on the first __anext__, then iterate
+    over what it returned.
+    """
+    def __init__(self, read):
+        self.read = read
+        self.iterator = None
+
+    async def __anext__(self):
+        if self.iterator is None:
+            self.iterator = iter(await asyncio.to_thread(self.read))
+        return await super().__anext__()
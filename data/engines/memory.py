@@ -0,0 +1,380 @@
+"""
+An in-memory engine, for tests and local development without a mongod.
+Docs live in dicts keyed by _id; every declared index keeps a hash map
+on its first field so equality lookups avoid a full scan, and unique
+indexes are enforced with pymongo's DuplicateKeyError.
+Docs are copied on the way in and out, so callers never share state
+with the store.
+"""
+import copy
+import threading
+
+import bson
+import pymongo.errors as pme
+import pymongo.results as pmr
+
+import data.engines.base as base
+import data.engines.query as qry
+
+MEMORY = 'memory'
+
+MONGO_ID_INDEX = '_id_'
+DUPLICATE_KEY = 11000
+IMMUTABLE_FIELD = 66
+BAD_VALUE = 2
+INDEX_NOT_FOUND = 27
+INDEX_OPTIONS_CONFLICT = 85
+
+
+def _options_conflict(name):
+    return pme.OperationFailure(
+        f'An existing index has the same name as the requested index '
+        f'but different options: {name}', INDEX_OPTIONS_CONFLICT)
+
+
+def _hashable(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+def _index_values(doc, field):
+    """
+    The values doc is indexed under for field: one per element for
+    lists, None when the field is missing.
+    """
+    value = qry.get_path(doc, field)
+    if value is qry.MISSING:
+        return [None]
+    if isinstance(value, list):
+        return [_hashable(item) for item in value] or [None]
+    return [_hashable(value)]
+
+
+def _lookup_values(condition):
+    """
+    The values a condition pins a field to, if it is a plain value, $eq
+    or an $in of plain values; None otherwise.
+    """
+    if isinstance(condition, dict):
+        if set(condition) == {'$eq'}:
+            condition = condition['$eq']
+        elif set(condition) == {'$in'}:
+            values = list(condition['$in'])
+            if all(isinstance(value, qry.SCALARS) for value in values):
+                return values
+            return None
+    if isinstance(condition, qry.SCALARS):
+        return [condition]
+    return None
+
+
+def _key_value(doc, keys):
+    ret = {}
+    for field, _ in keys:
+        value = qry.get_path(doc, field)
+        ret[field] = None if value is qry.MISSING else value
+    return ret
+
+
+class _Collection:
+    def __init__(self):
+        self.docs = {}
+        self.indexes = {}
+        # {field: {value: set of _ids}}
+        self.lookups = {}
+        # {_id: insertion number}, to return lookups in natural order.
+        self.seqs = {}
+        self.inserted = 0
+
+    def _index(self, doc_id, doc):
+        for field, lookup in self.lookups.items():
+            for value in _index_values(doc, field):
+                lookup.setdefault(value, set()).add(doc_id)
+
+    def _unindex(self, doc_id, doc):
+        for field, lookup in self.lookups.items():
+            for value in _index_values(doc, field):
+                ids = lookup.get(value)
+                if ids is not None:
+                    ids.discard(doc_id)
+                    if not ids:
+                        del lookup[value]
+
+    def rebuild_lookups(self):
+        fields = {spec[base.INDEX_KEYS][0][0]
+                  for spec in self.indexes.values()
+                  if not base.text_fields(spec)}
+        self.lookups = {field: {} for field in fields}
+        for doc_id, doc in self.docs.items():
+            self._index(doc_id, doc)
+
+    def plan(self, filt):
+        """
+        The index a lookup of filt goes through (None for a full scan)
+        and the _ids that might match, narrowed by that index when the
+        filter pins an indexed field to a value.
+        """
+        if qry.MONGO_ID in (filt or {}):
+            target = filt[qry.MONGO_ID]
+            if not isinstance(target, dict):
+                return MONGO_ID_INDEX, ([target] if _hashable(target)
+                                        in self.docs else [])
+        best = self._lookup(filt)
+        if best is None:
+            return None, list(self.docs)
+        index = next(name for name, spec in self.indexes.items()
+                     if spec[base.INDEX_KEYS][0][0] == best[0]
+                     and not base.text_fields(spec))
+        return index, sorted(best[1], key=self.seqs.__getitem__)
+
+    def _lookup(self, filt):
+        """
+        The narrowest index lookup filt allows, as (field, set of _ids),
+        or None. A $or can use the indexes if all its branches can.
+        """
+        best = None
+        for field, condition in (filt or {}).items():
+            if field == '$or':
+                branches = [self._lookup(branch) for branch in condition]
+                if not branches or not all(branches):
+                    continue
+                found = branches[0][0], set().union(
+                    *(ids for _, ids in branches))
+            elif field in self.lookups:
+                values = _lookup_values(condition)
+                if values is None:
+                    continue
+                lookup = self.lookups[field]
+                found = field, set().union(
+                    *(lookup.get(_hashable(value), ()) for value in values))
+            else:
+                continue
+            if best is None or len(found[1]) < len(best[1]):
+                best = found
+        return best
+
+    def candidates(self, filt):
+        return self.plan(filt)[1]
+
+    def text_fields(self) -> list:
+        return [field for spec in self.indexes.values()
+                for field in base.text_fields(spec)]
+
+    def check_unique(self, doc, doc_id=None):
+        for name, spec in self.indexes.items():
+            if not spec[base.INDEX_UNIQUE] or base.text_fields(spec):
+                continue
+            keys = spec[base.INDEX_KEYS]
+            key_value = _key_value(doc, keys)
+            if spec.get('sparse') and all(
+                    qry.get_path(doc, field) is qry.MISSING
+                    for field, _ in keys):
+                continue
+            first = keys[0][0]
+            for value in _index_values(doc, first):
+                for other_id in self.lookups[first].get(value, ()):
+                    if other_id == doc_id:
+                        continue
+                    if _key_value(self.docs[other_id], keys) == key_value:
+                        raise pme.DuplicateKeyError(
+                            f'E11000 duplicate key error collection index: '
+                            f'{name} dup key: {key_value}',
+                            DUPLICATE_KEY,
+                            {'keyPattern': dict(keys),
+                             'keyValue': key_value})
+
+    def insert(self, doc):
+        doc_id = doc[qry.MONGO_ID]
+        if _hashable(doc_id) in self.docs:
+            raise pme.DuplicateKeyError(
+                f'E11000 duplicate key error collection index: '
+                f'{MONGO_ID_INDEX} dup key: {{_id: {doc_id!r}}}',
+                DUPLICATE_KEY,
+                {'keyPattern': {qry.MONGO_ID: 1},
+                 'keyValue': {qry.MONGO_ID: doc_id}})
+        self.check_unique(doc)
+        doc_id = _hashable(doc_id)
+        self.docs[doc_id] = doc
+        self.seqs[doc_id] = self.inserted
+        self.inserted += 1
+        self._index(doc_id, doc)
+
+    def update(self, doc_id, update) -> bool:
+        doc = copy.deepcopy(self.docs[doc_id])
+        try:
+            changed = qry.apply_update(doc, update)
+        except ValueError as err:
+            raise pme.WriteError(str(err), IMMUTABLE_FIELD)
+        if changed:
+            self.check_unique(doc, doc_id)
+            self._unindex(doc_id, self.docs[doc_id])
+            self.docs[doc_id] = doc
+            self._index(doc_id, doc)
+        return changed
+
+    def delete(self, doc_id):
+        self._unindex(doc_id, self.docs.pop(doc_id))
+        del self.seqs[doc_id]
+
+
+class MemoryEngine(base.Engine):
+    name = MEMORY
+
+    def __init__(self):
+        self.dbs = {}
+        self.lock = threading.RLock()
+
+    def _collection(self, db, collection) -> _Collection:
+        return self.dbs.setdefault(db, {}).setdefault(collection,
+                                                      _Collection())
+
+    def _matching(self, coll, filt):
+        text_fields = coll.text_fields()
+        if '$text' in (filt or {}) and not text_fields:
+            raise pme.OperationFailure('text index required for $text query',
+                                       INDEX_NOT_FOUND)
+        return [doc_id for doc_id in coll.candidates(filt)
+                if qry.matches(coll.docs[doc_id], filt, text_fields)]
+
+    def find(self, db, collection, filt=None, projection=None, sort=None,
+             limit=0, skip=0, batch_size=0, read_pref=base.PRIMARY):
+        with self.lock:
+            coll = self._collection(db, collection)
+            docs = [coll.docs[doc_id] for doc_id in
+                    self._matching(coll, filt)]
+            if sort:
+                qry.sort_docs(docs, sort)
+            docs = docs[skip:]
+            if limit:
+                docs = docs[:limit]
+            return [qry.project(doc, projection) for doc in docs]
+
+    def insert_one(self, db, collection, doc):
+        with self.lock:
+            if qry.MONGO_ID not in doc:
+                doc[qry.MONGO_ID] = bson.ObjectId()
+            self._collection(db, collection).insert(copy.deepcopy(doc))
+            return pmr.InsertOneResult(doc[qry.MONGO_ID], True)
+
+    def _update(self, db, collection, filt, update, multi):
+        with self.lock:
+            coll = self._collection(db, collection)
+            matched = self._matching(coll, filt)
+            if not multi:
+                matched = matched[:1]
+            modified = sum(coll.update(doc_id, update)
+                           for doc_id in matched)
+            return pmr.UpdateResult({'n': len(matched),
+                                     'nModified': modified,
+                                     'ok': 1.0}, True)
+
+    def update_one(self, db, collection, filt, update):
+        return self._update(db, collection, filt, update, False)
+
+    def update_many(self, db, collection, filt, update):
+        return self._update(db, collection, filt, update, True)
+
+    def _delete(self, db, collection, filt, multi):
+        with self.lock:
+            coll = self._collection(db, collection)
+            matched = self._matching(coll, filt)
+            if not multi:
+                matched = matched[:1]
+            for doc_id in matched:
+                coll.delete(doc_id)
+            return pmr.DeleteResult({'n': len(matched), 'ok': 1.0}, True)
+
+    def delete_one(self, db, collection, filt):
+        return self._delete(db, collection, filt, False)
+
+    def delete_many(self, db, collection, filt):
+        return self._delete(db, collection, filt, True)
+
+    def bulk_write(self, db, collection, ops, ordered=True) -> dict:
+        details = {'writeErrors': [], 'writeConcernErrors': [],
+                   'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                   'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self.lock:
+            for i, op in enumerate(ops):
+                try:
+                    if op[base.OP] == base.INSERT:
+                        self.insert_one(db, collection, op[base.DOC])
+                        details['nInserted'] += 1
+                    elif op[base.OP] == base.UPDATE:
+                        result = self.update_one(db, collection,
+                                                 op[base.FILTER],
+                                                 op[base.DOC])
+                        details['nMatched'] += result.matched_count
+                        details['nModified'] += result.modified_count
+                    elif op[base.OP] == base.DELETE:
+                        result = self.delete_one(db, collection,
+                                                 op[base.FILTER])
+                        details['nRemoved'] += result.deleted_count
+                    else:
+                        raise ValueError(
+                            f'Unknown bulk operation: {op[base.OP]}')
+                except pme.OperationFailure as err:
+                    details['writeErrors'].append(
+                        {'index': i, 'code': err.code or BAD_VALUE,
+                         'errmsg': str(err)})
+                    if ordered:
+                        break
+        return details
+
+    def create_indexes(self, db, collection, specs):
+        with self.lock:
+            coll = self._collection(db, collection)
+            for spec in specs:
+                name = spec[base.INDEX_NAME]
+                if base.options_conflict(coll.indexes.get(name), spec):
+                    raise _options_conflict(name)
+            before = dict(coll.indexes)
+            for spec in specs:
+                coll.indexes[spec[base.INDEX_NAME]] = {
+                    **spec, base.INDEX_KEYS: list(spec[base.INDEX_KEYS])}
+            coll.rebuild_lookups()
+            try:
+                for doc_id, doc in coll.docs.items():
+                    coll.check_unique(doc, doc_id)
+            except pme.DuplicateKeyError:
+                coll.indexes = before
+                coll.rebuild_lookups()
+                raise
+
+    def index_names(self, db, collection) -> list:
+        with self.lock:
+            return [MONGO_ID_INDEX] + list(
+                self._collection(db, collection).indexes)
+
+    def drop_index(self, db, collection, name):
+        with self.lock:
+            coll = self._collection(db, collection)
+            if name not in coll.indexes:
+                raise pme.OperationFailure(
+                    f'index not found with name [{name}]', INDEX_NOT_FOUND)
+            del coll.indexes[name]
+            coll.rebuild_lookups()
+
+    def explain(self, db, collection, filt=None, sort=None) -> dict:
+        with self.lock:
+            coll = self._collection(db, collection)
+            index, candidates = coll.plan(filt)
+            return {
+                base.STAGE: base.IXSCAN if index else base.COLLSCAN,
+                base.INDEX: index,
+                base.IN_MEMORY_SORT: not base.sort_covered(
+                    coll.indexes.values(), qry.equality_fields(filt), sort),
+                base.KEYS_EXAMINED: len(candidates) if index else 0,
+                base.DOCS_EXAMINED: len(candidates),
+                base.RETURNED: len(self._matching(coll, filt)),
+            }
+
+    def drop(self):
+        """
+        Forget every doc and index.
+        """
+        with self.lock:
+            self.dbs = {}
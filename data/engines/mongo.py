@@ -0,0 +1,314 @@
+"""
+The MongoDB engines, over pymongo's MongoClient and AsyncMongoClient.
+Writes run in causally consistent sessions, and reads sent to
+secondaries start from the latest write this process has seen on the
+same deployment, so a process always reads back what it wrote.
+"""
+import threading
+
+import bson.codec_options as bco
+import bson.raw_bson as raw_bson
+import pymongo as pm
+
+import data.engines.base as base
+
+MONGO = 'mongo'
+
+RAW_CODEC_OPTIONS = bco.CodecOptions(document_class=raw_bson.RawBSONDocument)
+
+READ_PREFERENCES = {
+    base.PRIMARY: pm.ReadPreference.PRIMARY,
+    base.SECONDARY_PREFERRED: pm.ReadPreference.SECONDARY_PREFERRED,
+    base.NEAREST: pm.ReadPreference.NEAREST,
+}
+
+
+class _CausalClock:
+    """
+    The cluster and operation times of the latest write this process
+    has seen on one deployment.
+    """
+    def __init__(self):
+        self.cluster_time = None
+        self.operation_time = None
+        self.lock = threading.Lock()
+
+    def note(self, session):
+        if session.operation_time is None:
+            return
+        with self.lock:
+            if (self.operation_time is None
+                    or session.operation_time > self.operation_time):
+                self.operation_time = session.operation_time
+                self.cluster_time = session.cluster_time
+
+    def advance(self, session):
+        with self.lock:
+            if self.cluster_time is not None:
+                session.advance_cluster_time(self.cluster_time)
+            if self.operation_time is not None:
+                session.advance_operation_time(self.operation_time)
+
+
+# {deployment: _CausalClock}. A cluster time only means something to
+# the replica set that signed it, so each deployment (e.g. each shard)
+# keeps its own; the sync and async engines on one share it.
+_clocks = {}
+_clocks_lock = threading.Lock()
+
+
+def clock_for(deployment) -> _CausalClock:
+    with _clocks_lock:
+        return _clocks.setdefault(deployment, _CausalClock())
+
+
+def to_pymongo_op(op):
+    if op[base.OP] == base.INSERT:
+        return pm.InsertOne(op[base.DOC])
+    if op[base.OP] == base.UPDATE:
+        return pm.UpdateOne(op[base.FILTER], op[base.DOC])
+    if op[base.OP] == base.DELETE:
+        return pm.DeleteOne(op[base.FILTER])
+    raise ValueError(f'Unknown bulk operation: {op[base.OP]}')
+
+
+def to_index_models(specs):
+    return [pm.IndexModel(spec[base.INDEX_KEYS], name=spec[base.INDEX_NAME],
+                          unique=spec[base.INDEX_UNIQUE])
+            for spec in specs]
+
+
+# The explain() stages that read through an index.
+INDEX_STAGES = ['IXSCAN', 'EXPRESS_IXSCAN', 'IDHACK', 'COUNT_SCAN',
+                'DISTINCT_SCAN']
+
+
+def _stages(plan):
+    """
+    Every stage in a query plan, its input stages included.
+    """
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+def summarize_explain(explain) -> dict:
+    """
+    Boil the output of a cursor's explain() down to what
+    Engine.explain returns.
+    """
+    stages = list(_stages(explain['queryPlanner']['winningPlan']))
+    names = [stage['stage'] for stage in stages]
+    index = next((stage.get('indexName', base.MONGO_ID_INDEX)
+                  for stage in stages if stage['stage'] in INDEX_STAGES),
+                 None)
+    stats = explain.get('executionStats', {})
+    return {
+        base.STAGE: base.COLLSCAN if 'COLLSCAN' in names or index is None
+        else base.IXSCAN,
+        base.INDEX: index,
+        base.IN_MEMORY_SORT: 'SORT' in names,
+        base.KEYS_EXAMINED: stats.get('totalKeysExamined', 0),
+        base.DOCS_EXAMINED: stats.get('totalDocsExamined', 0),
+        base.RETURNED: stats.get('nReturned', 0),
+    }
+
+
+def _with_read_pref(collection, read_pref):
+    if read_pref not in READ_PREFERENCES:
+        raise ValueError(f'Unknown read preference: {read_pref}')
+    if read_pref == base.PRIMARY:
+        return collection
+    return collection.with_options(
+        read_preference=READ_PREFERENCES[read_pref])
+
+
+def _find(collection, filt, projection, sort, limit, skip, batch_size,
+          session=None):
+    cursor = collection.find(filt or {}, projection, session=session)
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    if sort:
+        cursor = cursor.sort(sort)
+    if skip:
+        cursor = cursor.skip(skip)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+class MongoEngine(base.Engine):
+    name = MONGO
+
+    def __init__(self, client, clock=None):
+        self.client = client
+        self.clock = _CausalClock() if clock is None else clock
+
+    def _write(self, method, *args, **kwargs):
+        with self.client.start_session(causal_consistency=True) as session:
+            try:
+                return method(*args, session=session, **kwargs)
+            finally:
+                self.clock.note(session)
+
+    def find(self, db, collection, filt=None, projection=None, sort=None,
+             limit=0, skip=0, batch_size=0, read_pref=base.PRIMARY):
+        coll = _with_read_pref(self.client[db][collection], read_pref)
+        if read_pref == base.PRIMARY:
+            return _find(coll, filt, projection, sort, limit, skip,
+                         batch_size)
+        return self._causal_find(coll, filt, projection, sort, limit, skip,
+                                 batch_size)
+
+    def _causal_find(self, coll, *args):
+        with self.client.start_session(causal_consistency=True) as session:
+            self.clock.advance(session)
+            yield from _find(coll, *args, session=session)
+
+    def find_raw(self, db, collection, filt=None, projection=None,
+                 sort=None, limit=0, skip=0, batch_size=0,
+                 read_pref=base.PRIMARY):
+        """
+        Have pymongo hand back the BSON it receives as is, rather than
+        decode it into dicts.
+        """
+        coll = self.client[db].get_collection(
+            collection, codec_options=RAW_CODEC_OPTIONS)
+        coll = _with_read_pref(coll, read_pref)
+        if read_pref == base.PRIMARY:
+            docs = _find(coll, filt, projection, sort, limit, skip,
+                         batch_size)
+        else:
+            docs = self._causal_find(coll, filt, projection, sort, limit,
+                                     skip, batch_size)
+        for doc in docs:
+            yield doc.raw
+
+    def insert_one(self, db, collection, doc):
+        return self._write(self.client[db][collection].insert_one, doc)
+
+    def update_one(self, db, collection, filt, update):
+        return self._write(self.client[db][collection].update_one, filt,
+                           update)
+
+    def update_many(self, db, collection, filt, update):
+        return self._write(self.client[db][collection].update_many, filt,
+                           update)
+
+    def delete_one(self, db, collection, filt):
+        return self._write(self.client[db][collection].delete_one, filt)
+
+    def delete_many(self, db, collection, filt):
+        return self._write(self.client[db][collection].delete_many, filt)
+
+    def bulk_write(self, db, collection, ops, ordered=True) -> dict:
+        try:
+            result = self._write(self.client[db][collection].bulk_write,
+                                 [to_pymongo_op(op) for op in ops],
+                                 ordered=ordered)
+            return result.bulk_api_result
+        except pm.errors.BulkWriteError as err:
+            return err.details
+
+    def create_indexes(self, db, collection, specs):
+        self.client[db][collection].create_indexes(to_index_models(specs))
+
+    def index_names(self, db, collection) -> list:
+        return [ix[base.INDEX_NAME]
+                for ix in self.client[db][collection].list_indexes()]
+
+    def explain(self, db, collection, filt=None, sort=None) -> dict:
+        cursor = self.client[db][collection].find(filt or {})
+        if sort:
+            cursor = cursor.sort(sort)
+        return summarize_explain(cursor.explain())
+
+    def drop_index(self, db, collection, name):
+        self.client[db][collection].drop_index(name)
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncMongoEngine:
+    """
+    The async counterpart of MongoEngine: the same methods as coroutines,
+    with find returning an async cursor.
+    """
+    name = MONGO
+
+    def __init__(self, client, clock=None):
+        self.client = client
+        self.clock = _CausalClock() if clock is None else clock
+
+    async def _write(self, method, *args, **kwargs):
+        async with self.client.start_session(
+                causal_consistency=True) as session:
+            try:
+                return await method(*args, session=session, **kwargs)
+            finally:
+                self.clock.note(session)
+
+    def find(self, db, collection, filt=None, projection=None, sort=None,
+             limit=0, skip=0, batch_size=0, read_pref=base.PRIMARY):
+        coll = _with_read_pref(self.client[db][collection], read_pref)
+        if read_pref == base.PRIMARY:
+            return _find(coll, filt, projection, sort, limit, skip,
+                         batch_size)
+        return self._causal_find(coll, filt, projection, sort, limit, skip,
+                                 batch_size)
+
+    async def _causal_find(self, coll, *args):
+        async with self.client.start_session(
+                causal_consistency=True) as session:
+            self.clock.advance(session)
+            async for doc in _find(coll, *args, session=session):
+                yield doc
+
+    async def insert_one(self, db, collection, doc):
+        return await self._write(self.client[db][collection].insert_one,
+                                 doc)
+
+    async def update_one(self, db, collection, filt, update):
+        return await self._write(self.client[db][collection].update_one,
+                                 filt, update)
+
+    async def update_many(self, db, collection, filt, update):
+        return await self._write(self.client[db][collection].update_many,
+                                 filt, update)
+
+    async def delete_one(self, db, collection, filt):
+        return await self._write(self.client[db][collection].delete_one,
+                                 filt)
+
+    async def delete_many(self, db, collection, filt):
+        return await self._write(self.client[db][collection].delete_many,
+                                 filt)
+
+    async def bulk_write(self, db, collection, ops, ordered=True) -> dict:
+        try:
+            result = await self._write(
+                self.client[db][collection].bulk_write,
+                [to_pymongo_op(op) for op in ops], ordered=ordered)
+            return result.bulk_api_result
+        except pm.errors.BulkWriteError as err:
+            return err.details
+
+    async def create_indexes(self, db, collection, specs):
+        await self.client[db][collection].create_indexes(
+            to_index_models(specs))
+
+    async def index_names(self, db, collection) -> list:
+        return [ix[base.INDEX_NAME] async for ix in
+                await self.client[db][collection].list_indexes()]
+
+    async def drop_index(self, db, collection, name):
+        await self.client[db][collection].drop_index(name)
+
+    async def close(self):
+        await self.client.close()
@@ -0,0 +1,250 @@
+"""
+Mongo query semantics for the engines that are not Mongo.
+Covers the subset the data modules use: equality (including dot paths),
+$regex, $in, $nin, $ne, $exists, $gt/$gte/$lt/$lte, $and/$or/$nor and
+$text in filters; inclusion and exclusion projections; $set, $unset and
+$inc in updates; and sorts on one or more fields.
+"""
+import copy
+import re
+
+MONGO_ID = '_id'
+
+MISSING = object()
+
+# The values an index can look up.
+SCALARS = (str, int, float, bool)
+
+WORD = re.compile(r'\w+')
+
+REGEX_FLAGS = {
+    'i': re.IGNORECASE,
+    'm': re.MULTILINE,
+    's': re.DOTALL,
+    'x': re.VERBOSE,
+}
+
+
+def get_path(doc, path):
+    """
+    Follow a dot path (e.g. 'Journals.123') into doc.
+    Returns MISSING if any step is not there.
+    """
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return MISSING
+    return value
+
+
+def set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def unset_path(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def compile_regex(pattern, options=''):
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    flags = 0
+    for option in options:
+        flags |= REGEX_FLAGS.get(option, 0)
+    return re.compile(pattern, flags)
+
+
+def _equals(value, target):
+    if isinstance(target, re.Pattern):
+        return isinstance(value, str) and target.search(value) is not None
+    if value is MISSING:
+        return target is None
+    if isinstance(value, list) and not isinstance(target, list):
+        return target in value
+    return value == target
+
+
+def _compare(value, target, op):
+    if value is MISSING or value is None or target is None:
+        return False
+    try:
+        return op(value, target)
+    except TypeError:
+        return False
+
+
+COMPARISONS = {
+    '$gt': lambda a, b: a > b,
+    '$gte': lambda a, b: a >= b,
+    '$lt': lambda a, b: a < b,
+    '$lte': lambda a, b: a <= b,
+}
+
+
+def _matches_condition(value, condition):
+    """
+    Check one field's value against its condition, which is either a
+    plain value or a dict of operators.
+    """
+    if not (isinstance(condition, dict)
+            and any(key.startswith('$') for key in condition)):
+        return _equals(value, condition)
+    for op, target in condition.items():
+        if op == '$eq':
+            ok = _equals(value, target)
+        elif op == '$ne':
+            ok = not _equals(value, target)
+        elif op == '$in':
+            ok = any(_equals(value, item) for item in target)
+        elif op == '$nin':
+            ok = not any(_equals(value, item) for item in target)
+        elif op == '$exists':
+            ok = (value is not MISSING) == bool(target)
+        elif op == '$regex':
+            regex = compile_regex(target, condition.get('$options', ''))
+            ok = isinstance(value, str) and regex.search(value) is not None
+        elif op == '$options':
+            ok = True
+        elif op in COMPARISONS:
+            ok = _compare(value, target, COMPARISONS[op])
+        else:
+            raise ValueError(f'Unsupported query operator: {op}')
+        if not ok:
+            return False
+    return True
+
+
+def search_terms(search: str) -> list:
+    return WORD.findall(search.lower())
+
+
+def _matches_text(doc, search, text_fields) -> bool:
+    """
+    Like Mongo's $text: does any of the search terms appear as a word in
+    one of the text indexed fields?
+    """
+    words = set()
+    for field in text_fields:
+        value = get_path(doc, field)
+        if isinstance(value, str):
+            words.update(search_terms(value))
+    return any(term in words for term in search_terms(search))
+
+
+def matches(doc, filt, text_fields=None) -> bool:
+    """
+    Does doc match the Mongo filter filt?
+    text_fields are the fields a $text condition searches; None means
+    the caller has already checked it.
+    """
+    for key, condition in (filt or {}).items():
+        if key == '$and':
+            ok = all(matches(doc, sub, text_fields) for sub in condition)
+        elif key == '$or':
+            ok = any(matches(doc, sub, text_fields) for sub in condition)
+        elif key == '$nor':
+            ok = not any(matches(doc, sub, text_fields)
+                         for sub in condition)
+        elif key == '$text':
+            ok = (text_fields is None
+                  or _matches_text(doc, condition['$search'], text_fields))
+        else:
+            ok = _matches_condition(get_path(doc, key), condition)
+        if not ok:
+            return False
+    return True
+
+
+def equality_fields(filt) -> dict:
+    """
+    The fields filt pins to a single plain value, which an engine can
+    look up in an index.
+    """
+    ret = {}
+    for key, condition in (filt or {}).items():
+        if key.startswith('$'):
+            continue
+        if isinstance(condition, dict):
+            if set(condition) == {'$eq'}:
+                condition = condition['$eq']
+            else:
+                continue
+        if isinstance(condition, SCALARS):
+            ret[key] = condition
+    return ret
+
+
+def project(doc, projection):
+    """
+    Apply an inclusion ({field: 1}) or exclusion ({field: 0}) projection
+    to a copy of doc.
+    """
+    if not projection:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include = [field for field, on in projection.items()
+               if on and field != MONGO_ID]
+    if include:
+        ret = {}
+        if projection.get(MONGO_ID, 1) and MONGO_ID in doc:
+            ret[MONGO_ID] = doc[MONGO_ID]
+        for field in include:
+            value = get_path(doc, field)
+            if value is not MISSING:
+                set_path(ret, field, copy.deepcopy(value))
+        return ret
+    ret = copy.deepcopy(doc)
+    for field, on in projection.items():
+        if not on:
+            unset_path(ret, field)
+    return ret
+
+
+def apply_update(doc, update) -> bool:
+    """
+    Apply a Mongo update document to doc in place.
+    Returns whether doc changed.
+    """
+    before = copy.deepcopy(doc)
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if path == MONGO_ID or path.startswith(MONGO_ID + '.'):
+                raise ValueError("Performing an update on the path '_id' "
+                                 "would modify the immutable field '_id'")
+            if op == '$set':
+                set_path(doc, path, copy.deepcopy(value))
+            elif op == '$unset':
+                unset_path(doc, path)
+            elif op == '$inc':
+                current = get_path(doc, path)
+                set_path(doc, path,
+                         value if current is MISSING else current + value)
+            else:
+                raise ValueError(f'Unsupported update operator: {op}')
+    return doc != before
+
+
+def sort_docs(docs, sort):
+    """
+    Sort docs in place by a list of (field, direction) pairs.
+    Missing and None values sort first, as in Mongo.
+    """
+    for field, direction in reversed(sort or []):
+        def key(doc, field=field):
+            value = get_path(doc, field)
+            if value is MISSING or value is None:
+                return (0, '')
+            return (1, value)
+        docs.sort(key=key, reverse=direction < 0)
+    return docs
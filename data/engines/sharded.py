@@ -0,0 +1,904 @@
+"""
+Spread the data over several engines (e.g. one Mongo per mongod) by the
+user that owns it.
+Each collection registers the field holding its owner (see
+ShardedEngine's shard_keys). A doc lives on the shard a consistent hash
+ring maps its owner to, so adding a shard moves only about 1/N of the
+users. Operations whose filter pins the owner go to that one shard;
+the rest fan out to every shard and their results are merged.
+Collections without a shard key live on the first shard.
+A collection can also register the field holding its docs' ids (see
+id_keys). Each new doc then gets an entry in LOCATIONS_COLLECT, on the
+shard its id hashes to, naming its owner. An operation that pins only
+the id looks the owner up there (or in a per-process cache, as an
+owner never changes) and goes to that one shard.
+Unique indexes are enforced within a shard. A unique index on any
+other field than the owner or the id is also enforced across shards:
+a doc's value for it is first claimed in CLAIMS_COLLECT on the first
+shard, which only takes each value once.
+"""
+import asyncio
+import bisect
+import collections
+import hashlib
+import heapq
+import itertools
+import threading
+
+import pymongo.errors as pme
+import pymongo.results as pmr
+
+import data.engines.base as base
+import data.engines.query as qry
+
+SHARDED = 'sharded'
+
+# Points each shard gets on the ring; more spread the users more evenly.
+VNODES = 64
+
+BAD_VALUE = 2
+DUPLICATE_KEY = 11000
+
+# {KEY: 'collection:id', OWNER: owner} for each doc of an id-keyed
+# collection, kept on the shard KEY hashes to.
+LOCATIONS_COLLECT = 'shard_locations'
+# {KEY: 'collection.field:value'} for each value of a unique field taken
+# across shards, kept on the first shard.
+CLAIMS_COLLECT = 'shard_claims'
+KEY = 'key'
+OWNER = 'owner'
+KEY_INDEX = {base.INDEX_NAME: f'{KEY}_1', base.INDEX_KEYS: [(KEY, 1)],
+             base.INDEX_UNIQUE: True}
+# How many id owners each process keeps in memory.
+OWNER_CACHE_SIZE = 100_000
+
+
+def _hash(key: str) -> int:
+    digest = hashlib.md5(key.encode(), usedforsecurity=False).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+class HashRing:
+    """
+    A consistent hash ring over shard names, with vnodes points each.
+    """
+    def __init__(self, names, vnodes=VNODES):
+        points = sorted((_hash(f'{name}#{i}'), name)
+                        for name in names for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.names = [name for _, name in points]
+
+    def node(self, key) -> str:
+        i = bisect.bisect(self.hashes, _hash(str(key)))
+        return self.names[i % len(self.names)]
+
+
+class _SortKey:
+    """
+    Orders docs by a list of (field, direction) pairs, as Mongo does,
+    for merging the sorted results of several shards.
+    """
+    def __init__(self, doc, sort):
+        self.values = []
+        for field, direction in sort:
+            value = qry.get_path(doc, field)
+            if value is qry.MISSING or value is None:
+                value = (0, '')
+            else:
+                value = (1, value)
+            self.values.append((value, direction))
+
+    def __lt__(self, other):
+        for (mine, direction), (theirs, _) in zip(self.values,
+                                                  other.values):
+            if mine != theirs:
+                return mine < theirs if direction > 0 else mine > theirs
+        return False
+
+
+def _with_sort_fields(projection, sort):
+    """
+    projection, widened so the docs keep the fields they are merged on.
+    """
+    if not (projection and sort):
+        return projection
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    if not any(on for field, on in projection.items()
+               if field != qry.MONGO_ID):
+        return projection
+    return {**projection, **{field: 1 for field, _ in sort}}
+
+
+def _merge(results, projection, sort, limit, skip):
+    """
+    Merge the docs from each shard (each sorted by sort, if given) and
+    apply the overall skip and limit.
+    """
+    if sort:
+        docs = heapq.merge(*results, key=lambda doc: _SortKey(doc, sort))
+    else:
+        docs = itertools.chain(*results)
+    docs = itertools.islice(docs, skip, skip + limit if limit else None)
+    if sort and _with_sort_fields(projection, sort) != projection:
+        return (qry.project(doc, projection) for doc in docs)
+    return docs
+
+
+def _shard_limit(limit, skip):
+    """
+    How many docs each shard must return for the merge to find the
+    first skip + limit of them all.
+    """
+    return limit + skip if limit else 0
+
+
+def _update_result(results):
+    return pmr.UpdateResult({
+        'n': sum(result.matched_count for result in results),
+        'nModified': sum(result.modified_count for result in results),
+        'ok': 1.0}, True)
+
+
+def _delete_result(results):
+    return pmr.DeleteResult({
+        'n': sum(result.deleted_count for result in results),
+        'ok': 1.0}, True)
+
+
+def _add_details(details, more, offset):
+    for count in ['nInserted', 'nUpserted', 'nMatched', 'nModified',
+                  'nRemoved']:
+        details[count] += more.get(count, 0)
+    for error in more.get('writeErrors', []):
+        details['writeErrors'].append({**error,
+                                       'index': error['index'] + offset})
+
+
+def _empty_details():
+    return {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0,
+            'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0,
+            'upserted': []}
+
+
+def _check_many(collection, fields):
+    if fields:
+        raise ValueError(f'Can not change the unique {", ".join(fields)} '
+                         + f'of many {collection} docs at once.')
+
+
+def _by_mongo_id(docs) -> dict:
+    return {qry.MONGO_ID: {'$in': [doc[qry.MONGO_ID] for doc in docs]}}
+
+
+def _location_key(collection, _id) -> str:
+    return f'{collection}:{_id}'
+
+
+def _claim_key(collection, field, value) -> str:
+    return f'{collection}.{field}:{value}'
+
+
+def _taken(collection, field, value):
+    return pme.DuplicateKeyError(
+        f'E11000 duplicate key error collection: {collection} index: '
+        f'{field}_1 dup key: {{{field}: {value!r}}}', DUPLICATE_KEY,
+        {'keyPattern': {field: 1}, 'keyValue': {field: value}})
+
+
+def _runs(ops, target):
+    """
+    Split ops into runs of consecutive ops for the same shard.
+    Yields (offset, shard name or None for a fan out, ops).
+    """
+    offset = 0
+    for name, run in itertools.groupby(ops, target):
+        run = list(run)
+        if name is None:
+            for i, op in enumerate(run):
+                yield offset + i, None, [op]
+        else:
+            yield offset, name, run
+        offset += len(run)
+
+
+class _Router:
+    """
+    Picks the shards an operation goes to.
+    shards is {name: engine}; shard_keys and id_keys are
+    {(db, collection): field} and index_specs is
+    {(db, collection): {name: spec}}; all three may be filled in after
+    the engine is made.
+    """
+    def __init__(self, shards, shard_keys, vnodes=VNODES, id_keys=None,
+                 index_specs=None):
+        if not shards:
+            raise ValueError('A sharded engine needs at least one shard.')
+        self.shards = dict(shards)
+        self.shard_keys = shard_keys
+        self.id_keys = {} if id_keys is None else id_keys
+        self.index_specs = {} if index_specs is None else index_specs
+        self.ring = HashRing(self.shards, vnodes)
+        self.primary = next(iter(self.shards))
+        # {location key: owner}, least recently used first.
+        self.owners = collections.OrderedDict()
+        # Request threads share owners.
+        self.owners_lock = threading.Lock()
+
+    def shard_for(self, key) -> str:
+        """
+        The name of the shard holding the docs owned by key.
+        """
+        return self.ring.node(key)
+
+    def _owned_by(self, db, collection, filt):
+        """
+        The shard names filt limits the operation to, or None for all.
+        """
+        field = self.shard_keys.get((db, collection))
+        if field is None:
+            return [self.primary]
+        pinned = qry.equality_fields(filt)
+        if field in pinned:
+            return [self.shard_for(pinned[field])]
+        owner = self._cached_owner(
+            self._pinned_location(db, collection, filt))
+        if owner is not qry.MISSING:
+            return [self.shard_for(owner)]
+        condition = (filt or {}).get(field)
+        if isinstance(condition, dict) and set(condition) == {'$in'}:
+            return sorted({self.shard_for(key) for key in condition['$in']})
+        return None
+
+    def _id_field(self, db, collection):
+        """
+        The field holding the ids of a sharded collection's docs, if
+        they are tracked in LOCATIONS_COLLECT.
+        """
+        if (db, collection) not in self.shard_keys:
+            return None
+        return self.id_keys.get((db, collection))
+
+    def _claimed_fields(self, db, collection) -> list:
+        """
+        The fields of collection whose unique index must hold across
+        shards.
+        """
+        owner_field = self.shard_keys.get((db, collection))
+        if owner_field is None:
+            return []
+        local = [owner_field, self._id_field(db, collection)]
+        return [spec[base.INDEX_KEYS][0][0]
+                for spec in self.index_specs.get((db, collection),
+                                                 {}).values()
+                if spec.get(base.INDEX_UNIQUE)
+                and len(spec[base.INDEX_KEYS]) == 1
+                and spec[base.INDEX_KEYS][0][0] not in local]
+
+    def _tracked(self, db, collection) -> bool:
+        """
+        Do writes to collection have to keep entries up to date?
+        """
+        return bool(self._id_field(db, collection)
+                    or self._claimed_fields(db, collection))
+
+    def _entry_fields(self, db, collection) -> list:
+        """
+        The fields the entries of a doc are made from.
+        """
+        fields = [qry.MONGO_ID, self.shard_keys[(db, collection)]]
+        if self._id_field(db, collection) is not None:
+            fields.append(self._id_field(db, collection))
+        return fields + self._claimed_fields(db, collection)
+
+    def _entries(self, db, collection, doc, fields=None) -> list:
+        """
+        (shard name, collection, entry, error if taken) for where doc
+        lives and each value it claims; fields limits them to the
+        claims of those fields.
+        """
+        ret = []
+        id_field = self._id_field(db, collection)
+        _id = (qry.MISSING if id_field is None or fields is not None
+               else qry.get_path(doc, id_field))
+        if _id is not qry.MISSING:
+            key = _location_key(collection, _id)
+            owner = qry.get_path(doc, self.shard_keys[(db, collection)])
+            ret.append((self.shard_for(key), LOCATIONS_COLLECT,
+                        {KEY: key,
+                         OWNER: None if owner is qry.MISSING else owner},
+                        _taken(collection, id_field, _id)))
+        if fields is None:
+            fields = self._claimed_fields(db, collection)
+        for field in fields:
+            value = qry.get_path(doc, field)
+            if value is not qry.MISSING:
+                ret.append((self.primary, CLAIMS_COLLECT,
+                            {KEY: _claim_key(collection, field, value)},
+                            _taken(collection, field, value)))
+        return ret
+
+    def _claimed_in(self, db, collection, update) -> list:
+        """
+        The claimed fields update sets or unsets.
+        """
+        return [field for field in self._claimed_fields(db, collection)
+                if any(field in changes for changes in update.values())]
+
+    def _claim_changes(self, db, collection, old, update, fields):
+        """
+        The entries update takes and the ones it gives up, for old.
+        """
+        new = {field: update['$set'][field]
+               for field in fields if field in update.get('$set', {})}
+        changed = [field for field in fields
+                   if qry.get_path(old, field) != new.get(field,
+                                                          qry.MISSING)]
+        return (self._entries(db, collection, new, changed),
+                self._entries(db, collection, old, changed))
+
+    def _pinned_location(self, db, collection, filt):
+        """
+        The location key of the doc filt pins by id, if any.
+        """
+        field = self._id_field(db, collection)
+        if field is None:
+            return None
+        pinned = qry.equality_fields(filt)
+        if field not in pinned:
+            return None
+        return _location_key(collection, pinned[field])
+
+    def _lookups(self, db, collection, filts) -> dict:
+        """
+        {shard name: filter} to find the locations of the docs filts
+        pin by id that are not cached yet.
+        """
+        keys = {}
+        for filt in filts:
+            key = self._pinned_location(db, collection, filt)
+            if key is not None:
+                with self.owners_lock:
+                    cached = key in self.owners
+                if not cached:
+                    keys.setdefault(self.shard_for(key), set()).add(key)
+        return {name: {KEY: {'$in': sorted(names)}}
+                for name, names in keys.items()}
+
+    def _cached_owner(self, key):
+        """
+        The cached owner of the doc at location key, or qry.MISSING.
+        """
+        with self.owners_lock:
+            owner = self.owners.get(key, qry.MISSING)
+            if owner is not qry.MISSING:
+                self.owners.move_to_end(key)
+            return owner
+
+    def _remember(self, key, owner):
+        with self.owners_lock:
+            self.owners[key] = owner
+            self.owners.move_to_end(key)
+            if len(self.owners) > OWNER_CACHE_SIZE:
+                self.owners.popitem(last=False)
+
+    def _forget(self, entries):
+        with self.owners_lock:
+            for _, collection, entry, _ in entries:
+                if collection == LOCATIONS_COLLECT:
+                    self.owners.pop(entry[KEY], None)
+
+    def _releases(self, entries) -> dict:
+        """
+        {(shard name, collection): filter} to delete entries.
+        """
+        keys = {}
+        for name, collection, entry, _ in entries:
+            keys.setdefault((name, collection), []).append(entry[KEY])
+        return {target: {KEY: {'$in': names}}
+                for target, names in keys.items()}
+
+    def _note_indexes(self, db, collection, specs):
+        declared = self.index_specs.setdefault((db, collection), {})
+        for spec in specs:
+            declared[spec[base.INDEX_NAME]] = spec
+
+    def _entry_indexes(self, db, collection) -> list:
+        """
+        (shard names, collection) that need KEY_INDEX for the entries
+        of collection.
+        """
+        ret = []
+        if self._id_field(db, collection) is not None:
+            ret.append((list(self.shards), LOCATIONS_COLLECT))
+        if self._claimed_fields(db, collection):
+            ret.append(([self.primary], CLAIMS_COLLECT))
+        return ret
+
+    def _targets(self, db, collection, filt) -> list:
+        names = self._owned_by(db, collection, filt)
+        return [self.shards[name] for name in names or self.shards]
+
+    def _owner(self, db, collection, doc):
+        field = self.shard_keys.get((db, collection))
+        if field is None:
+            return self.shards[self.primary]
+        key = qry.get_path(doc, field)
+        return self.shards[self.shard_for(None if key is qry.MISSING
+                                          else key)]
+
+    def _check_update(self, db, collection, update):
+        field = self.shard_keys.get((db, collection))
+        for fields in update.values():
+            if field in fields:
+                raise ValueError(f'Can not change the shard key {field} '
+                                 + f'of {collection} docs.')
+
+    def _op_target(self, db, collection):
+        """
+        The function _runs groups bulk ops by.
+        """
+        def target(op):
+            if op[base.OP] == base.UPDATE:
+                if self._claimed_in(db, collection, op[base.DOC]):
+                    return None
+            elif self._tracked(db, collection):
+                return None
+            if op[base.OP] == base.INSERT:
+                field = self.shard_keys.get((db, collection))
+                key = (qry.get_path(op[base.DOC], field)
+                       if field is not None else None)
+                if field is None:
+                    return self.primary
+                return self.shard_for(None if key is qry.MISSING else key)
+            names = self._owned_by(db, collection, op[base.FILTER])
+            return names[0] if names and len(names) == 1 else None
+        return target
+
+
+class ShardedEngine(_Router, base.Engine):
+    name = SHARDED
+
+    def _locate(self, db, collection, filts):
+        """
+        Cache the owners of the docs filts pin by id.
+        """
+        for name, filt in self._lookups(db, collection, filts).items():
+            for entry in self.shards[name].find(db, LOCATIONS_COLLECT, filt):
+                self._remember(entry[KEY], entry[OWNER])
+
+    def _take(self, db, entries) -> list:
+        """
+        Insert entries; if one is taken, remove the others and raise
+        its DuplicateKeyError.
+        """
+        taken = []
+        for entry in entries:
+            name, collection, doc, error = entry
+            try:
+                self.shards[name].insert_one(db, collection, dict(doc))
+            except pme.DuplicateKeyError:
+                self._release(db, taken)
+                raise error from None
+            taken.append(entry)
+            if collection == LOCATIONS_COLLECT:
+                self._remember(doc[KEY], doc[OWNER])
+        return taken
+
+    def _release(self, db, entries):
+        self._forget(entries)
+        for (name, collection), filt in self._releases(entries).items():
+            self.shards[name].delete_many(db, collection, filt)
+
+    def find(self, db, collection, filt=None, projection=None, sort=None,
+             limit=0, skip=0, batch_size=0, read_pref=base.PRIMARY):
+        self._locate(db, collection, [filt])
+        shards = self._targets(db, collection, filt)
+        if len(shards) == 1:
+            return shards[0].find(db, collection, filt, projection, sort,
+                                  limit, skip, batch_size, read_pref)
+        return _merge([shard.find(db, collection, filt,
+                                  _with_sort_fields(projection, sort), sort,
+                                  _shard_limit(limit, skip), 0, batch_size,
+                                  read_pref)
+                       for shard in shards], projection, sort, limit, skip)
+
+    def find_raw(self, db, collection, filt=None, projection=None,
+                 sort=None, limit=0, skip=0, batch_size=0,
+                 read_pref=base.PRIMARY):
+        self._locate(db, collection, [filt])
+        shards = self._targets(db, collection, filt)
+        if len(shards) == 1:
+            return shards[0].find_raw(db, collection, filt, projection, sort,
+                                      limit, skip, batch_size, read_pref)
+        if sort:
+            return super().find_raw(db, collection, filt, projection, sort,
+                                    limit, skip, batch_size, read_pref)
+        return _merge([shard.find_raw(db, collection, filt, projection,
+                                      None, _shard_limit(limit, skip), 0,
+                                      batch_size, read_pref)
+                       for shard in shards], projection, None, limit, skip)
+
+    def insert_one(self, db, collection, doc):
+        taken = self._take(db, self._entries(db, collection, doc))
+        try:
+            return self._owner(db, collection, doc).insert_one(db,
+                                                               collection,
+                                                               doc)
+        except Exception:
+            self._release(db, taken)
+            raise
+
+    def update_one(self, db, collection, filt, update):
+        self._check_update(db, collection, update)
+        self._locate(db, collection, [filt])
+        fields = self._claimed_in(db, collection, update)
+        for shard in self._targets(db, collection, filt):
+            if fields:
+                result = self._update_claimed(db, collection, shard, filt,
+                                              update, fields)
+            else:
+                result = shard.update_one(db, collection, filt, update)
+            if result.matched_count:
+                return result
+        return result
+
+    def _update_claimed(self, db, collection, shard, filt, update, fields):
+        """
+        Update the doc filt matches on shard, moving its claims.
+        """
+        old = next(iter(shard.find(db, collection, filt,
+                                   self._entry_fields(db, collection),
+                                   limit=1)), None)
+        if old is None:
+            return _update_result([])
+        take, give_up = self._claim_changes(db, collection, old, update,
+                                            fields)
+        taken = self._take(db, take)
+        try:
+            result = shard.update_one(db, collection,
+                                      {qry.MONGO_ID: old[qry.MONGO_ID]},
+                                      update)
+        except Exception:
+            self._release(db, taken)
+            raise
+        self._release(db, give_up if result.matched_count else taken)
+        return result
+
+    def update_many(self, db, collection, filt, update):
+        self._check_update(db, collection, update)
+        _check_many(collection, self._claimed_in(db, collection, update))
+        self._locate(db, collection, [filt])
+        return _update_result([shard.update_many(db, collection, filt,
+                                                 update)
+                               for shard in self._targets(db, collection,
+                                                          filt)])
+
+    def delete_one(self, db, collection, filt):
+        self._locate(db, collection, [filt])
+        for shard in self._targets(db, collection, filt):
+            if self._tracked(db, collection):
+                result = self._delete_tracked(db, collection, shard, filt, 1)
+            else:
+                result = shard.delete_one(db, collection, filt)
+            if result.deleted_count:
+                return result
+        return result
+
+    def delete_many(self, db, collection, filt):
+        self._locate(db, collection, [filt])
+        if self._tracked(db, collection):
+            return _delete_result([
+                self._delete_tracked(db, collection, shard, filt)
+                for shard in self._targets(db, collection, filt)])
+        return _delete_result([shard.delete_many(db, collection, filt)
+                               for shard in self._targets(db, collection,
+                                                          filt)])
+
+    def _delete_tracked(self, db, collection, shard, filt, limit=0):
+        """
+        Delete the docs filt matches on shard, and their entries.
+        """
+        old = list(shard.find(db, collection, filt,
+                              self._entry_fields(db, collection),
+                              limit=limit))
+        if not old:
+            return _delete_result([])
+        result = shard.delete_many(db, collection, _by_mongo_id(old))
+        self._release(db, [entry for doc in old
+                           for entry in self._entries(db, collection, doc)])
+        return result
+
+    def _fan_out_op(self, db, collection, op) -> dict:
+        details = _empty_details()
+        try:
+            if op[base.OP] == base.INSERT:
+                self.insert_one(db, collection, op[base.DOC])
+                details['nInserted'] = 1
+            elif op[base.OP] == base.UPDATE:
+                result = self.update_one(db, collection, op[base.FILTER],
+                                         op[base.DOC])
+                details['nMatched'] = result.matched_count
+                details['nModified'] = result.modified_count
+            elif op[base.OP] == base.DELETE:
+                result = self.delete_one(db, collection, op[base.FILTER])
+                details['nRemoved'] = result.deleted_count
+            else:
+                raise ValueError(f'Unknown bulk operation: {op[base.OP]}')
+        except pme.OperationFailure as err:
+            details['writeErrors'].append(
+                {'index': 0, 'code': err.code or BAD_VALUE,
+                 'errmsg': str(err)})
+        return details
+
+    def bulk_write(self, db, collection, ops, ordered=True) -> dict:
+        """
+        Send each run of consecutive ops for one shard as a batch; ops
+        that do not pin their shard go one at a time.
+        """
+        details = _empty_details()
+        self._locate(db, collection, [op[base.FILTER] for op in ops
+                                      if base.FILTER in op])
+        for offset, name, run in _runs(ops,
+                                       self._op_target(db, collection)):
+            if name is None:
+                more = self._fan_out_op(db, collection, run[0])
+            else:
+                more = self.shards[name].bulk_write(db, collection, run,
+                                                    ordered)
+            _add_details(details, more, offset)
+            if ordered and details['writeErrors']:
+                break
+        return details
+
+    def create_indexes(self, db, collection, specs):
+        self._note_indexes(db, collection, specs)
+        for names, entries in self._entry_indexes(db, collection):
+            for name in names:
+                self.shards[name].create_indexes(db, entries, [KEY_INDEX])
+        for shard in self.shards.values():
+            shard.create_indexes(db, collection, specs)
+
+    def index_names(self, db, collection) -> list:
+        """
+        The indexes every shard has.
+        """
+        names = [shard.index_names(db, collection)
+                 for shard in self.shards.values()]
+        return [name for name in names[0]
+                if all(name in others for others in names[1:])]
+
+    def drop_index(self, db, collection, name):
+        for shard in self.shards.values():
+            shard.drop_index(db, collection, name)
+
+    def explain(self, db, collection, filt=None, sort=None) -> dict:
+        """
+        The plans of the shards filt goes to, added up: a collection
+        scan on any of them counts.
+        """
+        self._locate(db, collection, [filt])
+        plans = [shard.explain(db, collection, filt, sort)
+                 for shard in self._targets(db, collection, filt)]
+        scans = [plan for plan in plans if plan[base.STAGE] == base.COLLSCAN]
+        return {
+            base.STAGE: base.COLLSCAN if scans else base.IXSCAN,
+            base.INDEX: None if scans else plans[0][base.INDEX],
+            base.IN_MEMORY_SORT: any(plan[base.IN_MEMORY_SORT]
+                                     for plan in plans),
+            base.KEYS_EXAMINED: sum(plan[base.KEYS_EXAMINED]
+                                    for plan in plans),
+            base.DOCS_EXAMINED: sum(plan[base.DOCS_EXAMINED]
+                                    for plan in plans),
+            base.RETURNED: sum(plan[base.RETURNED] for plan in plans),
+        }
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+
+
+async def _collect(docs) -> list:
+    return [doc async for doc in docs]
+
+
+class AsyncShardedEngine(_Router):
+    """
+    The async counterpart of ShardedEngine, over async engines.
+    Fanned out reads query the shards concurrently.
+    """
+    name = SHARDED
+
+    async def _locate(self, db, collection, filts):
+        lookups = self._lookups(db, collection, filts)
+        found = await asyncio.gather(*[
+            _collect(self.shards[name].find(db, LOCATIONS_COLLECT, filt))
+            for name, filt in lookups.items()])
+        for entry in itertools.chain.from_iterable(found):
+            self._remember(entry[KEY], entry[OWNER])
+
+    async def _take(self, db, entries) -> list:
+        taken = []
+        for entry in entries:
+            name, collection, doc, error = entry
+            try:
+                await self.shards[name].insert_one(db, collection, dict(doc))
+            except pme.DuplicateKeyError:
+                await self._release(db, taken)
+                raise error from None
+            taken.append(entry)
+            if collection == LOCATIONS_COLLECT:
+                self._remember(doc[KEY], doc[OWNER])
+        return taken
+
+    async def _release(self, db, entries):
+        self._forget(entries)
+        await asyncio.gather(*[
+            self.shards[name].delete_many(db, collection, filt)
+            for (name, collection), filt in self._releases(entries).items()])
+
+    async def find(self, db, collection, filt=None, projection=None,
+                   sort=None, limit=0, skip=0, batch_size=0,
+                   read_pref=base.PRIMARY):
+        await self._locate(db, collection, [filt])
+        shards = self._targets(db, collection, filt)
+        if len(shards) == 1:
+            async for doc in shards[0].find(db, collection, filt, projection,
+                                            sort, limit, skip, batch_size,
+                                            read_pref):
+                yield doc
+            return
+        results = await asyncio.gather(*[
+            _collect(shard.find(db, collection, filt,
+                                _with_sort_fields(projection, sort), sort,
+                                _shard_limit(limit, skip), 0, batch_size,
+                                read_pref))
+            for shard in shards])
+        for doc in _merge(results, projection, sort, limit, skip):
+            yield doc
+
+    async def insert_one(self, db, collection, doc):
+        taken = await self._take(db, self._entries(db, collection, doc))
+        try:
+            return await self._owner(db, collection, doc).insert_one(
+                db, collection, doc)
+        except Exception:
+            await self._release(db, taken)
+            raise
+
+    async def update_one(self, db, collection, filt, update):
+        self._check_update(db, collection, update)
+        await self._locate(db, collection, [filt])
+        fields = self._claimed_in(db, collection, update)
+        for shard in self._targets(db, collection, filt):
+            if fields:
+                result = await self._update_claimed(db, collection, shard,
+                                                    filt, update, fields)
+            else:
+                result = await shard.update_one(db, collection, filt,
+                                                update)
+            if result.matched_count:
+                return result
+        return result
+
+    async def _update_claimed(self, db, collection, shard, filt, update,
+                              fields):
+        old = await _collect(shard.find(db, collection, filt,
+                                        self._entry_fields(db, collection),
+                                        limit=1))
+        if not old:
+            return _update_result([])
+        take, give_up = self._claim_changes(db, collection, old[0], update,
+                                            fields)
+        taken = await self._take(db, take)
+        try:
+            result = await shard.update_one(
+                db, collection, {qry.MONGO_ID: old[0][qry.MONGO_ID]}, update)
+        except Exception:
+            await self._release(db, taken)
+            raise
+        await self._release(db, give_up if result.matched_count else taken)
+        return result
+
+    async def update_many(self, db, collection, filt, update):
+        self._check_update(db, collection, update)
+        _check_many(collection, self._claimed_in(db, collection, update))
+        await self._locate(db, collection, [filt])
+        return _update_result(await asyncio.gather(*[
+            shard.update_many(db, collection, filt, update)
+            for shard in self._targets(db, collection, filt)]))
+
+    async def delete_one(self, db, collection, filt):
+        await self._locate(db, collection, [filt])
+        for shard in self._targets(db, collection, filt):
+            if self._tracked(db, collection):
+                result = await self._delete_tracked(db, collection, shard,
+                                                    filt, 1)
+            else:
+                result = await shard.delete_one(db, collection, filt)
+            if result.deleted_count:
+                return result
+        return result
+
+    async def delete_many(self, db, collection, filt):
+        await self._locate(db, collection, [filt])
+        if self._tracked(db, collection):
+            return _delete_result(await asyncio.gather(*[
+                self._delete_tracked(db, collection, shard, filt)
+                for shard in self._targets(db, collection, filt)]))
+        return _delete_result(await asyncio.gather(*[
+            shard.delete_many(db, collection, filt)
+            for shard in self._targets(db, collection, filt)]))
+
+    async def _delete_tracked(self, db, collection, shard, filt, limit=0):
+        old = await _collect(shard.find(db, collection, filt,
+                                        self._entry_fields(db, collection),
+                                        limit=limit))
+        if not old:
+            return _delete_result([])
+        result = await shard.delete_many(db, collection, _by_mongo_id(old))
+        await self._release(db, [entry for doc in old for entry
+                                 in self._entries(db, collection, doc)])
+        return result
+
+    async def _fan_out_op(self, db, collection, op) -> dict:
+        details = _empty_details()
+        try:
+            if op[base.OP] == base.INSERT:
+                await self.insert_one(db, collection, op[base.DOC])
+                details['nInserted'] = 1
+            elif op[base.OP] == base.UPDATE:
+                result = await self.update_one(db, collection,
+                                               op[base.FILTER], op[base.DOC])
+                details['nMatched'] = result.matched_count
+                details['nModified'] = result.modified_count
+            elif op[base.OP] == base.DELETE:
+                result = await self.delete_one(db, collection,
+                                               op[base.FILTER])
+                details['nRemoved'] = result.deleted_count
+            else:
+                raise ValueError(f'Unknown bulk operation: {op[base.OP]}')
+        except pme.OperationFailure as err:
+            details['writeErrors'].append(
+                {'index': 0, 'code': err.code or BAD_VALUE,
+                 'errmsg': str(err)})
+        return details
+
+    async def bulk_write(self, db, collection, ops, ordered=True) -> dict:
+        details = _empty_details()
+        await self._locate(db, collection, [op[base.FILTER] for op in ops
+                                            if base.FILTER in op])
+        for offset, name, run in _runs(ops,
+                                       self._op_target(db, collection)):
+            if name is None:
+                more = await self._fan_out_op(db, collection, run[0])
+            else:
+                more = await self.shards[name].bulk_write(db, collection,
+                                                          run, ordered)
+            _add_details(details, more, offset)
+            if ordered and details['writeErrors']:
+                break
+        return details
+
+    async def create_indexes(self, db, collection, specs):
+        self._note_indexes(db, collection, specs)
+        await asyncio.gather(*[
+            self.shards[name].create_indexes(db, entries, [KEY_INDEX])
+            for names, entries in self._entry_indexes(db, collection)
+            for name in names])
+        await asyncio.gather(*[shard.create_indexes(db, collection, specs)
+                               for shard in self.shards.values()])
+
+    async def index_names(self, db, collection) -> list:
+        names = await asyncio.gather(*[shard.index_names(db, collection)
+                                       for shard in self.shards.values()])
+        return [name for name in names[0]
+                if all(name in others for others in names[1:])]
+
+    async def drop_index(self, db, collection, name):
+        for shard in self.shards.values():
+            await shard.drop_index(db, collection, name)
+
+    async def close(self):
+        for shard in self.shards.values():
+            await shard.close()
@@ -0,0 +1,617 @@
+"""
+An embedded SQLite engine, for single-node deployments without a mongod.
+Each collection is a table of JSON docs keyed on the _id. Declared
+indexes become expression indexes on the JSON fields, each with a
+case-insensitive twin on its first field for the ^...$ regex lookups
+the data modules make, and text indexes become FTS5 tables kept in step
+by triggers.
+Filters are translated to SQL as far as they can be, so the indexes do
+the narrowing, and the rows that come back are checked against the
+whole filter in Python, so the Mongo semantics are the ones in
+data.engines.query.
+The database runs in WAL mode, so readers do not block the writer, and
+each thread gets its own connection.
+"""
+import re
+import sqlite3
+import threading
+
+import bson
+import bson.json_util as json_util
+import pymongo.errors as pme
+import pymongo.results as pmr
+
+import data.engines.base as base
+import data.engines.query as qry
+
+SQLITE = 'sqlite'
+
+MONGO_ID_INDEX = '_id_'
+DUPLICATE_KEY = 11000
+IMMUTABLE_FIELD = 66
+BAD_VALUE = 2
+INDEX_NOT_FOUND = 27
+INDEX_OPTIONS_CONFLICT = 85
+
+# How long a connection waits for another one's write lock.
+BUSY_TIMEOUT_MS = 5000
+
+JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS
+CI_SUFFIX = ':ci'
+# Split words the way data.engines.query does.
+TEXT_TOKENIZER = "unicode61 remove_diacritics 0 tokenchars '_'"
+
+# The declared indexes and the fields that have held an array, per table.
+META_TABLES = [
+    'CREATE TABLE IF NOT EXISTS _indexes '
+    '(tbl TEXT, name TEXT, spec TEXT NOT NULL, PRIMARY KEY (tbl, name))',
+    'CREATE TABLE IF NOT EXISTS _array_fields '
+    '(tbl TEXT, path TEXT, PRIMARY KEY (tbl, path))',
+]
+
+UNIQUE_INDEX = re.compile(r"UNIQUE constraint failed: index '(.+)'")
+PLAN_INDEX = re.compile(r'USING (?:COVERING )?INDEX (\S+)')
+REGEX_SPECIALS = set('.^$*+?{}[]\\|()')
+
+
+def quote(name) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def json_path(field) -> str:
+    return '$' + ''.join('.' + quote(part) for part in field.split('.'))
+
+
+def field_expr(field, doc='doc') -> str:
+    """
+    The SQL for a field of the doc; indexes use the same text, so that
+    SQLite matches queries to them.
+    """
+    return f"json_extract({doc}, '{json_path(field)}')"
+
+
+def encode(doc) -> str:
+    return json_util.dumps(doc, json_options=JSON_OPTIONS)
+
+
+def decode(text):
+    return json_util.loads(text, json_options=JSON_OPTIONS)
+
+
+def _literal(pattern):
+    """
+    The text an anchored regex like ^abc$ matches exactly, or None if
+    it is not one.
+    """
+    if not (pattern.startswith('^') and pattern.endswith('$')):
+        return None
+    ret = []
+    chars = iter(pattern[1:-1])
+    for char in chars:
+        if char == '\\':
+            char = next(chars, None)
+            if char is None or char.isalnum():
+                return None
+        elif char in REGEX_SPECIALS:
+            return None
+        ret.append(char)
+    return ''.join(ret)
+
+
+def _regex_sql(field, regex, options=''):
+    """
+    SQL for a case-insensitive ^...$ regex on field, or None.
+    NOCASE only folds ASCII, so other text is left to Python.
+    """
+    if isinstance(regex, re.Pattern):
+        pattern = regex.pattern
+        insensitive = bool(regex.flags & re.IGNORECASE)
+    else:
+        pattern = regex
+        insensitive = 'i' in options
+    text = _literal(pattern)
+    if text is None or not text.isascii():
+        return None
+    if insensitive:
+        return f'{field_expr(field)} = ? COLLATE NOCASE', [text]
+    return f'{field_expr(field)} = ?', [text]
+
+
+class _Translation:
+    """
+    The SQL WHERE clause for a filter.
+    It matches at least the docs the filter does; exact says whether it
+    matches only those, so the LIMIT can go to SQL too.
+    """
+    def __init__(self, array_paths):
+        self.array_paths = array_paths
+        self.exact = True
+
+    def _may_hold_array(self, field):
+        parts = field.split('.')
+        return any('.'.join(parts[:i]) in self.array_paths
+                   for i in range(1, len(parts) + 1))
+
+    def _id(self, condition):
+        if not isinstance(condition, dict):
+            return 'id = ?', [encode(condition)]
+        if set(condition) == {'$in'}:
+            items = list(condition['$in'])
+            if not items:
+                return '0', []
+            marks = ', '.join('?' * len(items))
+            return f'id IN ({marks})', [encode(item) for item in items]
+        return None
+
+    def _equals(self, field, value):
+        if value is None:
+            return f'{field_expr(field)} IS NULL', []
+        if isinstance(value, qry.SCALARS):
+            return f'{field_expr(field)} = ?', [value]
+        if isinstance(value, re.Pattern):
+            return _regex_sql(field, value)
+        return None
+
+    def _condition(self, field, condition):
+        if field == qry.MONGO_ID:
+            return self._id(condition)
+        if self._may_hold_array(field):
+            return None
+        if not (isinstance(condition, dict)
+                and any(key.startswith('$') for key in condition)):
+            return self._equals(field, condition)
+        clauses, params = [], []
+        for op, target in condition.items():
+            sql = None
+            if op == '$eq':
+                sql = self._equals(field, target)
+            elif op == '$in':
+                sql = self._in(field, target)
+            elif op == '$exists':
+                sql = (f"json_type(doc, '{json_path(field)}') IS "
+                       + ('NOT NULL' if target else 'NULL'), [])
+            elif op == '$regex':
+                sql = _regex_sql(field, target, condition.get('$options', ''))
+            elif op == '$options':
+                continue
+            elif (op in qry.COMPARISONS and isinstance(target, (int, float))
+                  and not isinstance(target, bool)):
+                sql = (f'{field_expr(field)} {op_sql(op)} ?', [target])
+            if sql is None:
+                self.exact = False
+                continue
+            clauses.append(sql[0])
+            params += sql[1]
+        if not clauses:
+            return None
+        return ' AND '.join(clauses), params
+
+    def _in(self, field, items):
+        clauses, params = [], []
+        for item in items:
+            sql = self._equals(field, item)
+            if sql is None:
+                return None
+            clauses.append(sql[0])
+            params += sql[1]
+        if not clauses:
+            return '0', []
+        return '(' + ' OR '.join(clauses) + ')', params
+
+    def where(self, filt):
+        clauses, params = [], []
+        for key, condition in (filt or {}).items():
+            if key == '$text':
+                continue
+            if key == '$or':
+                subs = [self.where(sub) for sub in condition]
+                sql = None
+                if subs and all(sub[0] != '1' for sub in subs):
+                    sql = ('(' + ' OR '.join(f'({sub[0]})' for sub in subs)
+                           + ')', [p for sub in subs for p in sub[1]])
+            elif key == '$and':
+                subs = [self.where(sub) for sub in condition]
+                sql = (' AND '.join(f'({sub[0]})' for sub in subs),
+                       [p for sub in subs for p in sub[1]]) if subs else None
+            elif key.startswith('$'):
+                sql = None
+            else:
+                sql = self._condition(key, condition)
+            if sql is None:
+                self.exact = False
+                continue
+            clauses.append(sql[0])
+            params += sql[1]
+        if not clauses:
+            return '1', []
+        return ' AND '.join(clauses), params
+
+
+def op_sql(op) -> str:
+    return {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}[op]
+
+
+def _options_conflict(name):
+    return pme.OperationFailure(
+        f'An existing index has the same name as the requested index '
+        f'but different options: {name}', INDEX_OPTIONS_CONFLICT)
+
+
+def _array_paths(doc, prefix=''):
+    """
+    The dot paths in doc that hold a list.
+    """
+    for key, value in doc.items():
+        path = prefix + key
+        if isinstance(value, list):
+            yield path
+        elif isinstance(value, dict):
+            yield from _array_paths(value, path + '.')
+
+
+def _key_value(doc, keys):
+    ret = {}
+    for field, _ in keys:
+        value = qry.get_path(doc, field)
+        ret[field] = None if value is qry.MISSING else value
+    return ret
+
+
+class SqliteEngine(base.Engine):
+    name = SQLITE
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.tables = set()
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+            for sql in META_TABLES:
+                conn.execute(sql)
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def _table(self, conn, db, collection) -> str:
+        table = f'{db}.{collection}'
+        if table not in self.tables:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {quote(table)} '
+                         '(rid INTEGER PRIMARY KEY, '
+                         'id TEXT UNIQUE NOT NULL, doc TEXT NOT NULL)')
+            self.tables.add(table)
+        return table
+
+    def _specs(self, conn, table) -> dict:
+        return {name: decode(spec) for name, spec in conn.execute(
+            'SELECT name, spec FROM _indexes WHERE tbl = ?', (table,))}
+
+    def _transaction(self, conn):
+        return _Transaction(conn)
+
+    def _query(self, conn, table, filt):
+        """
+        The SQL selecting the rows that might match filt, its params,
+        whether it selects only those, and the filter and text fields
+        to check the docs it returns with.
+        """
+        specs = self._specs(conn, table)
+        text_fields = [field for spec in specs.values()
+                       for field in base.text_fields(spec)]
+        array_paths = {path for path, in conn.execute(
+            'SELECT path FROM _array_fields WHERE tbl = ?', (table,))}
+        translation = _Translation(array_paths)
+        where, params = translation.where(filt)
+        rest = filt
+        if '$text' in (filt or {}):
+            text = [(name, spec) for name, spec in specs.items()
+                    if base.text_fields(spec)]
+            if not text:
+                raise pme.OperationFailure(
+                    'text index required for $text query', INDEX_NOT_FOUND)
+            terms = qry.search_terms(filt['$text']['$search'])
+            fts = quote(f'{table}:{text[0][0]}')
+            if terms:
+                where += (f' AND rid IN (SELECT rowid FROM {fts} '
+                          f'WHERE {fts} MATCH ?)')
+                params.append(' OR '.join(f'"{term}"' for term in terms))
+            else:
+                where += ' AND 0'
+            rest = {key: value for key, value in filt.items()
+                    if key != '$text'}
+        sql = f'SELECT rid, doc FROM {quote(table)} WHERE {where} ORDER BY rid'
+        return sql, params, translation.exact, rest, text_fields
+
+    def _select(self, conn, table, filt, limit=0, skip=0):
+        """
+        The (rid, doc) pairs matching filt, in insertion order.
+        """
+        sql, params, exact, rest, text_fields = self._query(conn, table,
+                                                            filt)
+        if exact and (limit or skip):
+            sql += ' LIMIT ? OFFSET ?'
+            params += [limit or -1, skip]
+            limit = skip = 0
+        ret = []
+        for rid, text in conn.execute(sql, params):
+            doc = decode(text)
+            if qry.matches(doc, rest, text_fields):
+                ret.append((rid, doc))
+        ret = ret[skip:]
+        if limit:
+            ret = ret[:limit]
+        return ret
+
+    def find(self, db, collection, filt=None, projection=None, sort=None,
+             limit=0, skip=0, batch_size=0, read_pref=base.PRIMARY):
+        conn = self._conn()
+        table = self._table(conn, db, collection)
+        if sort:
+            docs = qry.sort_docs(
+                [doc for _, doc in self._select(conn, table, filt)], sort)
+            docs = docs[skip:]
+            if limit:
+                docs = docs[:limit]
+        else:
+            docs = [doc for _, doc in
+                    self._select(conn, table, filt, limit, skip)]
+        return [qry.project(doc, projection) for doc in docs]
+
+    def explain(self, db, collection, filt=None, sort=None) -> dict:
+        conn = self._conn()
+        table = self._table(conn, db, collection)
+        sql, params, _, rest, text_fields = self._query(conn, table, filt)
+        stage, index = base.COLLSCAN, None
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[-1]
+            if (detail + ' ').startswith(f'SCAN {table} '):
+                stage, index = base.COLLSCAN, None
+                break
+            if detail.startswith(f'SEARCH {table} '):
+                stage, index = base.IXSCAN, MONGO_ID_INDEX
+                match = PLAN_INDEX.search(detail)
+                if match and match.group(1).startswith(table + ':'):
+                    index = match.group(1)[len(table) + 1:]
+                    index = index.removesuffix(CI_SUFFIX)
+        rows = conn.execute(sql, params).fetchall()
+        # A table scan reads every row, not just the ones SQL kept.
+        examined = len(rows) if index else conn.execute(
+            f'SELECT COUNT(*) FROM {quote(table)}').fetchone()[0]
+        return {
+            base.KEYS_EXAMINED: len(rows) if index else 0,
+            base.STAGE: stage,
+            base.INDEX: index,
+            base.IN_MEMORY_SORT: not base.sort_covered(
+                self._specs(conn, table).values(),
+                qry.equality_fields(filt), sort),
+            base.DOCS_EXAMINED: examined,
+            base.RETURNED: sum(qry.matches(decode(text), rest, text_fields)
+                               for _, text in rows),
+        }
+
+    def _note_arrays(self, conn, table, doc):
+        for path in _array_paths(doc):
+            conn.execute('INSERT OR IGNORE INTO _array_fields VALUES (?, ?)',
+                         (table, path))
+
+    def _duplicate_key(self, conn, table, doc, err):
+        match = UNIQUE_INDEX.search(str(err))
+        if match is None:
+            name = MONGO_ID_INDEX
+            keys = [(qry.MONGO_ID, 1)]
+        else:
+            name = match.group(1)[len(table) + 1:]
+            keys = self._specs(conn, table)[name][base.INDEX_KEYS]
+        key_value = _key_value(doc, keys)
+        return pme.DuplicateKeyError(
+            f'E11000 duplicate key error collection: {table} index: '
+            f'{name} dup key: {key_value}',
+            DUPLICATE_KEY,
+            {'keyPattern': dict(keys), 'keyValue': key_value})
+
+    def _insert(self, conn, table, doc):
+        if qry.MONGO_ID not in doc:
+            doc[qry.MONGO_ID] = bson.ObjectId()
+        try:
+            conn.execute(f'INSERT INTO {quote(table)} (id, doc) '
+                         'VALUES (?, ?)',
+                         (encode(doc[qry.MONGO_ID]), encode(doc)))
+        except sqlite3.IntegrityError as err:
+            raise self._duplicate_key(conn, table, doc, err)
+        self._note_arrays(conn, table, doc)
+        return pmr.InsertOneResult(doc[qry.MONGO_ID], True)
+
+    def _update(self, conn, table, filt, update, multi):
+        matched = self._select(conn, table, filt, 0 if multi else 1)
+        modified = 0
+        for rid, doc in matched:
+            try:
+                changed = qry.apply_update(doc, update)
+            except ValueError as err:
+                raise pme.WriteError(str(err), IMMUTABLE_FIELD)
+            if not changed:
+                continue
+            try:
+                conn.execute(f'UPDATE {quote(table)} SET doc = ? '
+                             'WHERE rid = ?', (encode(doc), rid))
+            except sqlite3.IntegrityError as err:
+                raise self._duplicate_key(conn, table, doc, err)
+            self._note_arrays(conn, table, doc)
+            modified += 1
+        return pmr.UpdateResult({'n': len(matched), 'nModified': modified,
+                                 'ok': 1.0}, True)
+
+    def _delete(self, conn, table, filt, multi):
+        matched = self._select(conn, table, filt, 0 if multi else 1)
+        conn.executemany(f'DELETE FROM {quote(table)} WHERE rid = ?',
+                         [(rid,) for rid, _ in matched])
+        return pmr.DeleteResult({'n': len(matched), 'ok': 1.0}, True)
+
+    def _write(self, db, collection, write, *args):
+        conn = self._conn()
+        table = self._table(conn, db, collection)
+        with self._transaction(conn):
+            return write(conn, table, *args)
+
+    def insert_one(self, db, collection, doc):
+        return self._write(db, collection, self._insert, doc)
+
+    def update_one(self, db, collection, filt, update):
+        return self._write(db, collection, self._update, filt, update, False)
+
+    def update_many(self, db, collection, filt, update):
+        return self._write(db, collection, self._update, filt, update, True)
+
+    def delete_one(self, db, collection, filt):
+        return self._write(db, collection, self._delete, filt, False)
+
+    def delete_many(self, db, collection, filt):
+        return self._write(db, collection, self._delete, filt, True)
+
+    def _bulk_write(self, conn, table, ops, ordered):
+        details = {'writeErrors': [], 'writeConcernErrors': [],
+                   'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                   'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        for i, op in enumerate(ops):
+            try:
+                if op[base.OP] == base.INSERT:
+                    self._insert(conn, table, op[base.DOC])
+                    details['nInserted'] += 1
+                elif op[base.OP] == base.UPDATE:
+                    result = self._update(conn, table, op[base.FILTER],
+                                          op[base.DOC], False)
+                    details['nMatched'] += result.matched_count
+                    details['nModified'] += result.modified_count
+                elif op[base.OP] == base.DELETE:
+                    result = self._delete(conn, table, op[base.FILTER],
+                                          False)
+                    details['nRemoved'] += result.deleted_count
+                else:
+                    raise ValueError(
+                        f'Unknown bulk operation: {op[base.OP]}')
+            except pme.OperationFailure as err:
+                details['writeErrors'].append(
+                    {'index': i, 'code': err.code or BAD_VALUE,
+                     'errmsg': str(err)})
+                if ordered:
+                    break
+        return details
+
+    def bulk_write(self, db, collection, ops, ordered=True) -> dict:
+        """
+        Run every op in one transaction; a failed op is reported and
+        undone on its own, as in Mongo.
+        """
+        return self._write(db, collection, self._bulk_write, ops, ordered)
+
+    def _create_text_index(self, conn, table, spec):
+        fts = f'{table}:{spec[base.INDEX_NAME]}'
+        fields = base.text_fields(spec)
+        columns = [f'c{i}' for i in range(len(fields))]
+        exprs = ', '.join(field_expr(field) for field in fields)
+        new = ', '.join(field_expr(field, 'new.doc') for field in fields)
+        conn.execute(f'CREATE VIRTUAL TABLE {quote(fts)} USING fts5('
+                     f"{', '.join(columns)}, tokenize=\"{TEXT_TOKENIZER}\")")
+        conn.execute(f"INSERT INTO {quote(fts)} (rowid, {', '.join(columns)})"
+                     f' SELECT rid, {exprs} FROM {quote(table)}')
+        delete = f'DELETE FROM {quote(fts)} WHERE rowid = old.rid;'
+        insert = (f"INSERT INTO {quote(fts)} (rowid, {', '.join(columns)}) "
+                  f'VALUES (new.rid, {new});')
+        for event, body in [('INSERT', insert), ('DELETE', delete),
+                            ('UPDATE', delete + insert)]:
+            conn.execute(f'CREATE TRIGGER {quote(fts + ":" + event)} '
+                         f'AFTER {event} ON {quote(table)} '
+                         f'BEGIN {body} END')
+
+    def _create_index(self, conn, table, spec):
+        index = f'{table}:{spec[base.INDEX_NAME]}'
+        keys = ', '.join(field_expr(field)
+                         + (' DESC' if direction == -1 else '')
+                         for field, direction in spec[base.INDEX_KEYS])
+        unique = 'UNIQUE ' if spec[base.INDEX_UNIQUE] else ''
+        conn.execute(f'CREATE {unique}INDEX {quote(index)} '
+                     f'ON {quote(table)} ({keys})')
+        first = field_expr(spec[base.INDEX_KEYS][0][0])
+        conn.execute(f'CREATE INDEX {quote(index + CI_SUFFIX)} '
+                     f'ON {quote(table)} ({first} COLLATE NOCASE)')
+
+    def create_indexes(self, db, collection, specs):
+        conn = self._conn()
+        table = self._table(conn, db, collection)
+        with self._transaction(conn):
+            existing = self._specs(conn, table)
+            for spec in specs:
+                name = spec[base.INDEX_NAME]
+                if name in existing:
+                    if base.options_conflict(existing[name], spec):
+                        raise _options_conflict(name)
+                    continue
+                spec = {**spec, base.INDEX_KEYS: list(spec[base.INDEX_KEYS])}
+                try:
+                    if base.text_fields(spec):
+                        self._create_text_index(conn, table, spec)
+                    else:
+                        self._create_index(conn, table, spec)
+                except sqlite3.IntegrityError as err:
+                    raise pme.DuplicateKeyError(
+                        f'E11000 duplicate key error collection: {table} '
+                        f'index: {name}: {err}', DUPLICATE_KEY)
+                conn.execute('INSERT INTO _indexes VALUES (?, ?, ?)',
+                             (table, name, encode(spec)))
+
+    def index_names(self, db, collection) -> list:
+        conn = self._conn()
+        table = self._table(conn, db, collection)
+        return [MONGO_ID_INDEX] + list(self._specs(conn, table))
+
+    def drop_index(self, db, collection, name):
+        conn = self._conn()
+        table = self._table(conn, db, collection)
+        with self._transaction(conn):
+            spec = self._specs(conn, table).get(name)
+            if spec is None:
+                raise pme.OperationFailure(
+                    f'index not found with name [{name}]', INDEX_NOT_FOUND)
+            index = f'{table}:{name}'
+            if base.text_fields(spec):
+                for event in ['INSERT', 'DELETE', 'UPDATE']:
+                    conn.execute(
+                        f'DROP TRIGGER {quote(index + ":" + event)}')
+                conn.execute(f'DROP TABLE {quote(index)}')
+            else:
+                conn.execute(f'DROP INDEX {quote(index)}')
+                conn.execute(f'DROP INDEX {quote(index + CI_SUFFIX)}')
+            conn.execute('DELETE FROM _indexes WHERE tbl = ? AND name = ?',
+                         (table, name))
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+class _Transaction:
+    """
+    BEGIN IMMEDIATE ... COMMIT, rolled back on an exception.
+    Taking the write lock up front means the reads a write does first
+    see the data it then changes.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
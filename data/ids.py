@@ -0,0 +1,223 @@
+"""
+New ids for users, categories and journals.
+An id is a string of ID_LEN digits that needs no database read to be
+unique, and that sorts in the order the ids were made, so new docs land
+next to each other in the id indexes and ids can bound a range scan by
+creation time (see first_id_at()).
+ID_GENERATOR picks how they are made:
+    time: a millisecond timestamp, the process's worker number and a
+        per-millisecond counter, packed like a Twitter snowflake. Each
+        process claims its worker number from the WORKER_SEQUENCE
+        counter the first time it makes an id, so processes forked from
+        one parent still get numbers of their own.
+    sequence: numbers handed out in blocks of ID_BLOCK_SIZE from a
+        counter in SEQUENCES_COLLECT, one database round trip a block.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import data.db_connect as dbc
+
+TIME = 'time'
+SEQUENCE = 'sequence'
+ID_GENERATOR = os.environ.get('ID_GENERATOR', TIME)
+
+# Wide enough for any 63 bit number.
+ID_LEN = 19
+
+# Time ids: milliseconds since EPOCH_MS, then WORKER_BITS of worker
+# number, then COUNTER_BITS of counter.
+EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+WORKER_BITS = 10
+COUNTER_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_COUNTER = (1 << COUNTER_BITS) - 1
+
+SEQUENCES_COLLECT = 'sequences'
+NAME = 'name'
+VALUE = 'value'
+ID_SEQUENCE = 'ids'
+WORKER_SEQUENCE = 'workers'
+ID_BLOCK_SIZE = int(os.environ.get('ID_BLOCK_SIZE', 1000))
+
+dbc.register_indexes(SEQUENCES_COLLECT, [dbc.index(NAME, unique=True)])
+
+
+def _format(value: int) -> str:
+    return str(value).rjust(ID_LEN, '0')
+
+
+class IdTaken(ValueError):
+    """
+    The id given for a new doc is already in use.
+    """
+
+
+# Set in a forked child, which must not use its parent's ID_WORKER.
+forked = False
+
+
+def _worker() -> int:
+    """
+    ID_WORKER, or the next number from the WORKER_SEQUENCE counter.
+    Two processes only make the same time id if they share a worker
+    number. Claimed numbers wrap at MAX_WORKER, so they stay apart while
+    fewer than MAX_WORKER + 1 processes start between two that run at
+    once. ID_WORKER is for a single process that can not reach the
+    database at startup; a forked child ignores it and claims its own.
+    """
+    worker = os.environ.get('ID_WORKER')
+    if worker is None or forked:
+        dbc.connect_db()
+        return SequenceIds(WORKER_SEQUENCE)._claim(1) % (MAX_WORKER + 1)
+    worker = int(worker)
+    if not 0 <= worker <= MAX_WORKER:
+        raise ValueError(f'ID_WORKER must be between 0 and {MAX_WORKER}.')
+    return worker
+
+
+class TimeIds:
+    """
+    Make snowflake ids in this process.
+    """
+    name = TIME
+
+    def __init__(self, worker=None):
+        self.lock = threading.Lock()
+        self.worker = _worker() if worker is None else worker
+        self.last_ms = 0
+        self.counter = 0
+
+    def _now_ms(self) -> int:
+        return int(time.time() * 1000) - EPOCH_MS
+
+    def new_ids(self, count: int) -> list:
+        ret = []
+        with self.lock:
+            while len(ret) < count:
+                # A clock that steps back keeps using the last millisecond.
+                now = max(self._now_ms(), self.last_ms)
+                if now == self.last_ms:
+                    if self.counter == MAX_COUNTER:
+                        # Out of ids for this millisecond; wait for the next.
+                        time.sleep(0.001)
+                        continue
+                    self.counter += 1
+                else:
+                    self.last_ms = now
+                    self.counter = 0
+                ret.append(_format((now << (WORKER_BITS + COUNTER_BITS))
+                                   | (self.worker << COUNTER_BITS)
+                                   | self.counter))
+        return ret
+
+
+class SequenceIds:
+    """
+    Hand out numbers from blocks claimed from a shared counter.
+    """
+    name = SEQUENCE
+
+    def __init__(self, sequence=ID_SEQUENCE, block_size=None):
+        self.lock = threading.Lock()
+        self.sequence = sequence
+        self.block_size = block_size or ID_BLOCK_SIZE
+        self.next = 0
+        self.end = 0
+
+    def _claim(self, size: int) -> int:
+        """
+        Move the counter on by size and return where it was.
+        The update only applies if the counter still holds what was read,
+        so two processes never claim the same block.
+        """
+        while True:
+            found = dbc.fetch_many(SEQUENCES_COLLECT,
+                                   {NAME: self.sequence}, [VALUE], limit=1)
+            if not found:
+                try:
+                    dbc.insert_one(SEQUENCES_COLLECT,
+                                   {NAME: self.sequence, VALUE: size})
+                    return 0
+                except dbc.DuplicateKeyError:
+                    continue
+            start = found[0][VALUE]
+            result = dbc.update_doc(SEQUENCES_COLLECT,
+                                    {NAME: self.sequence, VALUE: start},
+                                    {VALUE: start + size})
+            if result.matched_count:
+                return start
+
+    def new_ids(self, count: int) -> list:
+        with self.lock:
+            if self.end - self.next < count:
+                # Bulk requests get a block of their own size.
+                size = max(count, self.block_size)
+                self.next = self._claim(size)
+                self.end = self.next + size
+            start = self.next
+            self.next += count
+        return [_format(value) for value in range(start, start + count)]
+
+
+GENERATORS = {
+    TIME: TimeIds,
+    SEQUENCE: SequenceIds,
+}
+
+generator = None
+
+
+def use_generator(new_generator):
+    """
+    Swap in new_generator and return the one it replaced (or None).
+    """
+    global generator
+    old = generator
+    generator = new_generator
+    return old
+
+
+def _generator():
+    global generator
+    if generator is None:
+        if ID_GENERATOR not in GENERATORS:
+            raise ValueError(f'Unknown ID_GENERATOR {ID_GENERATOR}; '
+                             f'use one of {", ".join(GENERATORS)}.')
+        generator = GENERATORS[ID_GENERATOR]()
+    return generator
+
+
+def new_id() -> str:
+    return new_ids(1)[0]
+
+
+def new_ids(count: int) -> list:
+    """
+    count new ids, in order, for a bulk add.
+    """
+    return _generator().new_ids(count)
+
+
+def first_id_at(when: datetime) -> str:
+    """
+    The lowest time id made at or after when (UTC if naive), for
+    {JOURNAL_ID: {'$gte': first_id_at(start)}} style range filters.
+    """
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    ms = int(when.timestamp() * 1000) - EPOCH_MS
+    return _format(max(ms, 0) << (WORKER_BITS + COUNTER_BITS))
+
+
+def _reset_after_fork():
+    # A child must not hand out the ids or use the worker number its
+    # parent has.
+    global generator, forked
+    generator = None
+    forked = True
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -5,6 +5,8 @@ This module interfaces to our journal data.
 import random
 # import time
 import data.db_connect as dbc
+import data.ids as ids
+import data.migrations as mgr
 import data.users as usrs
 import data.categories as ctgs
 
@@ -13,8 +15,7 @@ from datetime import datetime, timedelta
 
 JOURNALS_COLLECT = 'journals'
 
-ID_LEN = 9
-BIG_NUM = 1_000_000_000
+ID_LEN = ids.ID_LEN
 
 MOCK_ID = "0" * ID_LEN
 
@@ -30,7 +31,27 @@ CATEGORY = 'category'
 DEFAULT_TITLE = 'Untitled'
 TEST_PROMPT = 'Reflect on an act of kindness.'
 
-FORMAT = "%Y-%m-%d %H:%M:%S"
+# TIMESTAMP and MODIFIED are stored as datetimes (see dbc.utc_now());
+# this is how the API shows them.
+FORMAT = dbc.DATETIME_FORMAT
+
+# Fields for list views; leaves out the prompt and content bodies.
+SUMMARY_FIELDS = [JOURNAL_ID, TITLE, MODIFIED, CATEGORY]
+
+# JOURNAL_ID is unique, so the insert itself turns away one in use.
+# The (USER, date) indexes also serve the plain USER lookups.
+INDEXES = [
+    dbc.index(JOURNAL_ID, unique=True),
+    dbc.index(USER, MODIFIED),
+    dbc.index(USER, TIMESTAMP),
+    dbc.index(CATEGORY),
+    dbc.index((CONTENT, dbc.TEXT)),
+]
+dbc.register_indexes(JOURNALS_COLLECT, INDEXES)
+dbc.register_shard_key(JOURNALS_COLLECT, USER)
+dbc.register_id_key(JOURNALS_COLLECT, JOURNAL_ID)
+
+NATIVE_DATES = 2
 
 journals = {}
 
@@ -40,16 +61,19 @@ def _get_test_timestamp():
     rand_days = random.randint(0, 365)
     rand_secs = random.randint(0, 24*60*60)
     rand_timedelta = timedelta(days=rand_days, seconds=rand_secs)
-    rand_timestamp = start_date + rand_timedelta
-    rand_timestamp_str = rand_timestamp.strftime(FORMAT)
-    return rand_timestamp_str
+    return start_date + rand_timedelta
+
+
+def _native_dates_update(journal: dict) -> dict:
+    return mgr.native_dates_update(journal, [TIMESTAMP, MODIFIED])
+
+
+mgr.register_migration(NATIVE_DATES, 'native_journal_dates',
+                       JOURNALS_COLLECT, JOURNAL_ID, _native_dates_update)
 
 
 def _get_journal_id() -> str:
-    _id = random.randint(0, BIG_NUM)
-    _id = str(_id)
-    _id = _id.rjust(ID_LEN, '0')
-    return _id
+    return ids.new_id()
 
 
 def get_test_journal():
@@ -65,42 +89,111 @@ def get_test_journal():
     return test_journal
 
 
-def get_journals() -> dict:
+def get_journals(fields: list = None) -> dict:
     dbc.connect_db()
-    return dbc.fetch_all_as_dict(JOURNAL_ID, JOURNALS_COLLECT)
+    return dbc.fetch_all_as_dict(JOURNAL_ID, JOURNALS_COLLECT, fields=fields,
+                                 read_pref=dbc.LIST_READ_PREF)
 
 
-def get_user_journals(user_id: str) -> dict:
+def get_user_journals(user_id: str, fields: list = None) -> dict:
     dbc.connect_db()
-    all_journals = dbc.fetch_all_as_dict(JOURNAL_ID, JOURNALS_COLLECT)
-    user_specific_journals = {}
-    for journal_id, journal in all_journals.items():
-        if journal[USER] == user_id:
-            user_specific_journals[journal_id] = journal
-    return user_specific_journals
+    return dbc.fetch_many_as_dict(JOURNAL_ID, JOURNALS_COLLECT,
+                                  {USER: user_id}, fields,
+                                  read_pref=dbc.LIST_READ_PREF)
 
 
-def get_category_journals(category_id: str) -> dict:
+def get_category_journals(category_id: str, fields: list = None) -> dict:
     dbc.connect_db()
-    all_journals = dbc.fetch_all_as_dict(JOURNAL_ID, JOURNALS_COLLECT)
-    category_specific_journals = {}
-    for journal_id, journal in all_journals.items():
-        if journal[CATEGORY] == category_id:
-            category_specific_journals[journal_id] = journal
-    return category_specific_journals
+    return dbc.fetch_many_as_dict(JOURNAL_ID, JOURNALS_COLLECT,
+                                  {CATEGORY: category_id}, fields,
+                                  read_pref=dbc.LIST_READ_PREF)
 
 
-def add_journal(journal_id: str, title: str, prompt: str, content: str,
-                user_id: str, category_id: str):
-    if exists(journal_id):
-        raise ValueError("Duplicate journal")
+def search_journals(query: str, user_id: str = None,
+                    fields: list = None) -> dict:
+    """
+    The journals (of user_id, if given) with any word of query in their
+    content.
+    """
+    dbc.connect_db()
+    filt = dbc.text_filter(query)
+    if user_id is not None:
+        filt[USER] = user_id
+    return dbc.fetch_many_as_dict(JOURNAL_ID, JOURNALS_COLLECT, filt, fields)
+
+
+def _between_filter(user_id: str, start, end, field: str) -> dict:
+    if field not in (MODIFIED, TIMESTAMP):
+        raise ValueError(f'Can only select journals by {MODIFIED} '
+                         f'or {TIMESTAMP}.')
+    filt = {USER: user_id}
+    bounds = {}
+    if start is not None:
+        bounds['$gte'] = start
+    if end is not None:
+        bounds['$lt'] = end
+    if bounds:
+        filt[field] = bounds
+    return filt
+
+
+def get_user_journals_between(user_id: str, start=None, end=None,
+                              fields: list = None, field: str = MODIFIED,
+                              limit: int = 0) -> dict:
+    """
+    A user's journals with field (MODIFIED or TIMESTAMP) from start up
+    to but not including end, newest first; either bound may be left
+    out. The (USER, field) index serves both the range and the order.
+    """
+    dbc.connect_db()
+    return dbc.fetch_many_as_dict(JOURNAL_ID, JOURNALS_COLLECT,
+                                  _between_filter(user_id, start, end, field),
+                                  fields, sort=[(field, -1)], limit=limit,
+                                  read_pref=dbc.LIST_READ_PREF)
+
+
+def iter_journals(fields: list = None):
+    """
+    Yield every journal without loading them all at once.
+    """
+    dbc.connect_db()
+    return dbc.iter_docs(JOURNALS_COLLECT, fields=fields,
+                         read_pref=dbc.LIST_READ_PREF)
+
+
+def iter_journals_json(fields: list = None):
+    """
+    Yield get_journals() as JSON object members, straight from the BSON.
+    """
+    dbc.connect_db()
+    return dbc.iter_json_items(JOURNAL_ID, JOURNALS_COLLECT, fields=fields,
+                               read_pref=dbc.LIST_READ_PREF)
 
-    # The commented checks below are done in the Journal POST endpoint
-    # if not usrs.exists(user_id):
-    #     raise wz.NotAcceptable("Please input a user ID that exists.")
-    # if not categories.exists(user_id):
-    #     raise wz.NotAcceptable("Please input a category ID that exists.")
 
+def iter_user_journals(user_id: str, fields: list = None):
+    """
+    Yield a user's journals without loading them all at once.
+    """
+    dbc.connect_db()
+    return dbc.iter_docs(JOURNALS_COLLECT, {USER: user_id}, fields,
+                         read_pref=dbc.LIST_READ_PREF)
+
+
+def iter_category_journals(category_id: str, fields: list = None):
+    """
+    Yield a category's journals without loading them all at once.
+    """
+    dbc.connect_db()
+    return dbc.iter_docs(JOURNALS_COLLECT, {CATEGORY: category_id}, fields,
+                         read_pref=dbc.LIST_READ_PREF)
+
+
+def _make_journal_entry(journal_id: str, title: str, prompt: str,
+                        content: str, user_id: str,
+                        category_id: str) -> dict:
+    """
+    Validate a new journal's fields and build the doc to store.
+    """
     # Check if the input types are correct
     if not isinstance(title, str):
         raise TypeError("Title must be a string")
@@ -120,7 +213,7 @@ def add_journal(journal_id: str, title: str, prompt: str, content: str,
     #     raise ValueError(f'Duplicate prompt: {prompt}')
 
     # Set the created and modified timestamps
-    timestamp = datetime.now().strftime(FORMAT)
+    timestamp = dbc.utc_now()
     modified = timestamp
 
     # Set default title if empty
@@ -137,46 +230,103 @@ def add_journal(journal_id: str, title: str, prompt: str, content: str,
     journal_entry[MODIFIED] = modified
     journal_entry[USER] = user_id
     journal_entry[CATEGORY] = category_id
+    return journal_entry
+
+
+def add_journal(journal_id: str, title: str, prompt: str, content: str,
+                user_id: str, category_id: str):
+    # The commented checks below are done in the Journal POST endpoint
+    # if not usrs.exists(user_id):
+    #     raise wz.NotAcceptable("Please input a user ID that exists.")
+    # if not categories.exists(user_id):
+    #     raise wz.NotAcceptable("Please input a category ID that exists.")
+
+    journal_entry = _make_journal_entry(journal_id, title, prompt, content,
+                                        user_id, category_id)
     dbc.connect_db()
-    _id = dbc.insert_one(JOURNALS_COLLECT, journal_entry)
+    try:
+        _id = dbc.insert_one(JOURNALS_COLLECT, journal_entry)
+    except dbc.DuplicateKeyError as err:
+        raise ids.IdTaken("Duplicate journal") from err
 
-    # Add (journal_id: title) key-value pair to the
-    # corresponding category's Journals field
-    category = ctgs.get_category(category_id)
-    category_journals = ctgs.get_journals(category)
-    category_journals[journal_id] = title
-    category_data = {ctgs.JOURNALS: category_journals}
-    ctgs.update_category(category_id, category_data)
+    # Count it in its category with $inc, so journals added to it at
+    # the same time are all counted.
+    dbc.increment(ctgs.CATEGORIES_COLLECT, {ctgs.CATEGORY_ID: category_id},
+                  {ctgs.JOURNAL_COUNT: 1},
+                  {ctgs.LAST_MODIFIED: journal_entry[TIMESTAMP]})
 
     return _id is not None
 
 
+def add_journals(journals: list) -> dict:
+    """
+    Add many journals in one insert round trip, then count them in their
+    categories in one more.
+
+    Args:
+    journals (list): Dicts with JOURNAL_ID, TITLE, PROMPT, CONTENT,
+                     USER and CATEGORY.
+
+    Returns:
+    dict: A dbc bulk write report for the journal inserts; ERRORS holds
+          an entry for every journal that was not added, with ITEM_INDEX
+          its position in journals.
+    """
+    dbc.connect_db()
+    journal_ids = [journal.get(JOURNAL_ID) for journal in journals]
+    existing = dbc.fetch_many(JOURNALS_COLLECT,
+                              {JOURNAL_ID: {'$in': journal_ids}},
+                              [JOURNAL_ID])
+    taken_ids = {journal[JOURNAL_ID] for journal in existing}
+    added = {}
+
+    def make_entry(journal):
+        if journal.get(JOURNAL_ID) in taken_ids:
+            raise ValueError("Duplicate journal")
+        entry = _make_journal_entry(journal[JOURNAL_ID], journal[TITLE],
+                                    journal[PROMPT], journal[CONTENT],
+                                    journal[USER], journal[CATEGORY])
+        taken_ids.add(entry[JOURNAL_ID])
+        added[entry[JOURNAL_ID]] = entry
+        return entry
+
+    report = dbc.insert_many_checked(JOURNALS_COLLECT, journals, make_entry)
+    for error in report[dbc.ERRORS]:
+        if dbc.CODE in error:  # built fine but the insert failed
+            del added[journals[error[dbc.ITEM_INDEX]][JOURNAL_ID]]
+    counts = {}
+    for entry in added.values():
+        counts[entry[CATEGORY]] = counts.get(entry[CATEGORY], 0) + 1
+    when = dbc.utc_now()
+    category_ops = [ctgs._membership_op(category_id, count, when)
+                    for category_id, count in counts.items()]
+    dbc.bulk_write(ctgs.CATEGORIES_COLLECT, category_ops, ordered=False)
+    return report
+
+
 def del_journal(journal_id: str):
     dbc.connect_db()
-    if not exists(journal_id):
+    journal_entry = get_journal(journal_id, [CATEGORY])
+    if journal_entry is None:
         raise ValueError(f"Delete failure: {journal_id} not in database.")
 
-    # Removing the journal entry from
-    # the category it belongs to before deleting
-    journal_entry = get_journal(journal_id)
-    category_id = get_category(journal_entry)
-    category_entry = ctgs.get_category(category_id)
-    category_entry_journals = ctgs.get_journals(category_entry)
-    del category_entry_journals[journal_id]
-    category_data = {ctgs.JOURNALS: category_entry_journals}
-    ctgs.update_category(category_id, category_data)
-
-    dbc.del_one(JOURNALS_COLLECT, {JOURNAL_ID: journal_id})
+    # Only the request that deleted it takes it off its category's count.
+    result = dbc.del_one(JOURNALS_COLLECT, {JOURNAL_ID: journal_id})
+    if result.deleted_count:
+        dbc.increment(ctgs.CATEGORIES_COLLECT,
+                      {ctgs.CATEGORY_ID: get_category(journal_entry)},
+                      {ctgs.JOURNAL_COUNT: -1},
+                      {ctgs.LAST_MODIFIED: dbc.utc_now()})
     return True
 
 
-def get_journal(journal_id: str) -> dict:
+def get_journal(journal_id: str, fields: list = None) -> dict:
     dbc.connect_db()
-    return dbc.fetch_one(JOURNALS_COLLECT, {JOURNAL_ID: journal_id})
+    return dbc.fetch_one(JOURNALS_COLLECT, {JOURNAL_ID: journal_id}, fields)
 
 
 def exists(journal_id: str) -> bool:
-    return get_journal(journal_id) is not None
+    return get_journal(journal_id, [JOURNAL_ID]) is not None
 
 
 def get_timestamp(journal: dict):
@@ -218,52 +368,59 @@ def update_journal(journal_id: str, journal_data: dict) -> bool:
     Returns:
     bool: True if the update was successful, False otherwise.
     """
-    if not exists(journal_id):
-        raise ValueError(f"Update failure: {journal_id} not in database.")
-
     if not journal_data:
         raise ValueError("Update failure: No valid fields to update.")
 
     update_data = {}
     for key in [TITLE, PROMPT, CONTENT, CATEGORY]:
         if key in journal_data and (len(journal_data[key]) != 0):
-
-            if key == CATEGORY and (len(journal_data[key]) != 0):
-                if not ctgs.exists(journal_data[CATEGORY]):
-                    raise ValueError("Please input a category ID that exists.")
-
-                # remove journal from previous category
-                journal_entry = get_journal(journal_id)
-                prev_cat_id = get_category(journal_entry)
-                prev_category = ctgs.get_category(prev_cat_id)
-                prev_category_journals = ctgs.get_journals(prev_category)
-                del prev_category_journals[journal_id]
-                prev_category_data = {ctgs.JOURNALS: prev_category_journals}
-                ctgs.update_category(prev_cat_id, prev_category_data)
-
-                # add journal to new category
-                new_cat_id = journal_data[CATEGORY]
-                new_category = ctgs.get_category(new_cat_id)
-                new_category_journals = ctgs.get_journals(new_category)
-                new_category_journals[journal_id] = get_title(journal_entry)
-                new_category_data = {ctgs.JOURNALS: new_category_journals}
-                ctgs.update_category(new_cat_id, new_category_data)
-
-            if key == TITLE and (len(journal_data[key]) != 0):
-                journal_entry = get_journal(journal_id)
-                cat_id = get_category(journal_entry)
-                category = ctgs.get_category(cat_id)
-                category_journals = ctgs.get_journals(category)
-                category_journals[journal_id] = journal_data[TITLE]
-                category_data = {ctgs.JOURNALS: category_journals}
-                ctgs.update_category(cat_id, category_data)
-
             update_data[key] = journal_data[key]
 
     # To see a measureable difference between TIMESTAMP and MODIFIED
     # time.sleep(1)
-    update_data[MODIFIED] = datetime.now().strftime(FORMAT)
+    update_data[MODIFIED] = dbc.utc_now()
 
     dbc.connect_db()
-    dbc.update_doc(JOURNALS_COLLECT, {JOURNAL_ID: journal_id}, update_data)
+    if CATEGORY not in update_data:
+        # The categories' counts do not change, so there is nothing to read.
+        result = dbc.update_doc(JOURNALS_COLLECT, {JOURNAL_ID: journal_id},
+                                update_data)
+        if not result.matched_count:
+            raise ValueError(f"Update failure: {journal_id} not in database.")
+        return True
+
+    journal_entry = get_journal(journal_id, [CATEGORY])
+    if journal_entry is None:
+        raise ValueError(f"Update failure: {journal_id} not in database.")
+
+    prev_cat_id = get_category(journal_entry)
+    new_cat_id = update_data[CATEGORY]
+    if new_cat_id != prev_cat_id and not ctgs.exists(new_cat_id):
+        raise ValueError("Please input a category ID that exists.")
+
+    result = dbc.update_doc(JOURNALS_COLLECT,
+                            _move_filter(journal_id, prev_cat_id),
+                            update_data)
+    if not result.matched_count:
+        raise ValueError(f"Update failure: {journal_id} was changed at "
+                         "the same time; please try again.")
+    dbc.bulk_write(ctgs.CATEGORIES_COLLECT,
+                   _move_ops(prev_cat_id, new_cat_id, update_data[MODIFIED]))
     return True
+
+
+def _move_ops(prev_cat_id: str, cat_id: str, when) -> list:
+    """
+    The bulk write ops that move one journal's count from prev_cat_id
+    to cat_id, if they differ.
+    """
+    if cat_id == prev_cat_id:
+        return []
+    return [ctgs._membership_op(cat_id, 1, when),
+            ctgs._membership_op(prev_cat_id, -1, when)]
+
+
+def _move_filter(journal_id: str, prev_cat_id: str) -> dict:
+    # Only matches while the journal is still where it was read, so two
+    # moves at once do not both count it out of prev_cat_id.
+    return {JOURNAL_ID: journal_id, CATEGORY: prev_cat_id}
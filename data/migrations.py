@@ -0,0 +1,232 @@
+"""
+Versioned data migrations that run while the API keeps serving.
+A data module registers a migration with register_migration(): a
+version, the collection, the collection's key field and a transform
+that turns one doc into the Mongo update it needs ({'$set': ...,
+'$unset': ...}), or None if the doc is fine as it is. A batch
+transform takes a whole batch of docs and returns their updates in
+order, so it can look up what it needs for all of them at once.
+run() applies the pending migrations in version order. Each pages
+through its collection on the key, MIGRATION_BATCH_SIZE docs at a time,
+sends the batch's updates as one bulk write, checkpoints the last key
+done in MIGRATIONS_COLLECT and pauses for MIGRATION_PAUSE_S, so a run
+that stops part way resumes after the last batch it finished.
+An update only applies if the fields it rewrites (or the guard fields
+given for the migration) still hold what the migration read. A doc the
+API changed in the meantime is counted as a conflict and left alone:
+the code that changed it already writes the new shape.
+Run them with:
+    python -m data.admin migrate [--dry-run]
+"""
+import os
+import time
+
+import data.db_connect as dbc
+import data.engines.query as qry
+
+MIGRATIONS_COLLECT = 'migrations'
+
+# Migration fields.
+VERSION = 'version'
+NAME = 'name'
+COLLECTION = 'collection'
+KEY = 'key'
+TRANSFORM = 'transform'
+BATCH = 'batch'
+GUARD = 'guard'
+DB = 'db'
+
+# Fields of a migration's state in MIGRATIONS_COLLECT.
+STATE = 'state'
+LAST_KEY = 'last_key'
+SCANNED = 'scanned'
+CHANGED = 'changed'
+CONFLICTS = 'conflicts'
+COUNTERS = [SCANNED, CHANGED, CONFLICTS]
+
+# States.
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+DRY_RUN = 'dry_run'
+
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 500))
+MIGRATION_PAUSE_S = float(os.environ.get('MIGRATION_PAUSE_S', 0.05))
+
+# {version: migration}
+migrations = {}
+
+dbc.register_indexes(MIGRATIONS_COLLECT, [dbc.index(VERSION, unique=True)])
+
+
+def register_migration(version: int, name: str, collection: str, key: str,
+                       transform, db=dbc.JOURNALS_DB, batch=False,
+                       guard=None):
+    """
+    Add a migration; key must be a unique, indexed field of collection.
+    With batch, transform is given a list of docs and returns a list of
+    updates. guard names the fields an update's guard checks, for a
+    migration whose other fields the API may change under it.
+    """
+    if version in migrations and migrations[version][NAME] != name:
+        raise ValueError(f'Migration version {version} is already '
+                         f'{migrations[version][NAME]}.')
+    migrations[version] = {VERSION: version, NAME: name,
+                           COLLECTION: collection, KEY: key,
+                           TRANSFORM: transform, DB: db, BATCH: batch,
+                           GUARD: guard}
+
+
+def _get_state(version: int) -> dict:
+    return dbc.fetch_one(MIGRATIONS_COLLECT, {VERSION: version}) or {}
+
+
+def _report(migration, state) -> dict:
+    return {VERSION: migration[VERSION], NAME: migration[NAME],
+            COLLECTION: migration[COLLECTION],
+            STATE: state.get(STATE, PENDING),
+            LAST_KEY: state.get(LAST_KEY),
+            **{counter: state.get(counter, 0) for counter in COUNTERS}}
+
+
+def get_status() -> list:
+    """
+    The state of every registered migration, oldest first.
+    """
+    dbc.connect_db()
+    return [_report(migration, _get_state(version))
+            for version, migration in sorted(migrations.items())]
+
+
+def native_dates_update(doc, fields) -> dict:
+    """
+    The update that stores the dbc.DATETIME_FORMAT strings in fields of
+    doc as datetimes, read as UTC, or None if there are none.
+    """
+    dates = {}
+    for field in fields:
+        value = doc.get(field)
+        if isinstance(value, str):
+            try:
+                dates[field] = dbc.parse_datetime(value)
+            except ValueError:
+                continue
+    return {'$set': dates} if dates else None
+
+
+def _updates(migration, docs) -> list:
+    """
+    The update for each of docs, or None for those that need none.
+    """
+    if migration.get(BATCH):
+        return migration[TRANSFORM](docs)
+    return [migration[TRANSFORM](doc) for doc in docs]
+
+
+def _guard(doc, update, paths=None) -> dict:
+    """
+    The filter that only matches doc while paths (by default, the fields
+    update rewrites) still hold the values read.
+    """
+    if paths is None:
+        paths = [path for fields in update.values() for path in fields]
+    ret = {}
+    for path in paths:
+        value = qry.get_path(doc, path)
+        ret[path] = {'$exists': False} if value is qry.MISSING else value
+    return ret
+
+
+def _write(migration, docs) -> tuple:
+    """
+    Apply migration to a batch of docs.
+    Returns the number of docs changed and the number that conflicted.
+    """
+    key = migration[KEY]
+    # Naming the owner sends each update to one shard only.
+    owner = dbc.shard_keys.get((migration[DB], migration[COLLECTION]))
+    ops = []
+    for doc, update in zip(docs, _updates(migration, docs)):
+        if update:
+            filt = {key: doc[key],
+                    **_guard(doc, update, migration.get(GUARD))}
+            if owner in doc:
+                filt[owner] = doc[owner]
+            ops.append({dbc.OP: dbc.UPDATE, dbc.FILTER: filt,
+                        dbc.DOC: update})
+    if not ops:
+        return 0, 0
+    report = dbc.bulk_write(migration[COLLECTION], ops, ordered=False,
+                            db=migration[DB])
+    if report[dbc.ERRORS]:
+        raise ValueError(f'Migration {migration[NAME]} failed: '
+                         f'{report[dbc.ERRORS][0][dbc.MESSAGE]}')
+    return report[dbc.MATCHED], len(ops) - report[dbc.MATCHED]
+
+
+def _migrate(migration, dry_run=False, max_batches=0, pause=None) -> dict:
+    """
+    Run one migration from its checkpoint to the end of its collection,
+    or for max_batches batches if that is set.
+    A dry run counts the docs it would change without writing anything.
+    """
+    pause = MIGRATION_PAUSE_S if pause is None else pause
+    key = migration[KEY]
+    version = migration[VERSION]
+    state = _get_state(version)
+    if state.get(STATE) == DONE:
+        return _report(migration, state)
+    if not state and not dry_run:
+        dbc.insert_one(MIGRATIONS_COLLECT,
+                       {VERSION: version, NAME: migration[NAME],
+                        STATE: RUNNING, LAST_KEY: None,
+                        **{counter: 0 for counter in COUNTERS}})
+    last_key = state.get(LAST_KEY)
+    counts = {counter: state.get(counter, 0) for counter in COUNTERS}
+    batches = 0
+    while True:
+        filt = {} if last_key is None else {key: {'$gt': last_key}}
+        docs = dbc.fetch_many(migration[COLLECTION], filt, sort=[(key, 1)],
+                              limit=MIGRATION_BATCH_SIZE, db=migration[DB])
+        if not docs:
+            break
+        if dry_run:
+            changed = sum(1 for update in _updates(migration, docs)
+                          if update)
+            conflicts = 0
+        else:
+            changed, conflicts = _write(migration, docs)
+        last_key = docs[-1][key]
+        counts[SCANNED] += len(docs)
+        counts[CHANGED] += changed
+        counts[CONFLICTS] += conflicts
+        if not dry_run:
+            dbc.update_doc(MIGRATIONS_COLLECT, {VERSION: version},
+                           {LAST_KEY: last_key, **counts})
+        batches += 1
+        if len(docs) < MIGRATION_BATCH_SIZE or batches == max_batches:
+            break
+        time.sleep(pause)
+    finished = len(docs) < MIGRATION_BATCH_SIZE
+    if finished and not dry_run:
+        dbc.update_doc(MIGRATIONS_COLLECT, {VERSION: version},
+                       {STATE: DONE})
+    return _report(migration, {
+        STATE: DRY_RUN if dry_run else (DONE if finished else RUNNING),
+        LAST_KEY: last_key, **counts})
+
+
+def run(dry_run=False, max_batches=0, pause=None) -> list:
+    """
+    Apply the pending migrations in version order and report on each.
+    Stops at a migration that max_batches leaves unfinished, as the
+    later ones may rely on it.
+    """
+    dbc.connect_db()
+    ret = []
+    for _, migration in sorted(migrations.items()):
+        report = _migrate(migration, dry_run, max_batches, pause)
+        ret.append(report)
+        if report.get(STATE) == RUNNING:
+            break
+    return ret
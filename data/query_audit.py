@@ -0,0 +1,262 @@
+"""
+Audit the query plans of the data layer.
+audit() seeds a scratch database through the data modules, runs every
+read and write they offer against it, and explains each distinct query
+shape (collection, filter with the values blanked out, and sort) that
+reached the engine. A shape is flagged for a collection scan, a sort
+done in memory, or examining more than MAX_EXAMINED_RATIO index keys or
+docs per doc returned.
+PLANS_FILE holds the baseline, per engine: for each shape, the indexes
+it may use and the flags accepted so far. regressions() lists the shapes
+that are missing from it, use another index, or have a flag it does not
+accept, so an engine with no baseline fails outright.
+An engine's entry is only ever written by --update run against that
+engine.
+Run it with:
+    python -m data.admin query-audit [--update]
+"""
+import json
+import os
+
+import data.db_connect as dbc
+import data.engines.base as base
+import data.categories as ctgs
+import data.journals as jrnls
+import data.users as usrs
+
+# Where the seeded data goes, away from the real journals_db.
+AUDIT_DB = 'query_audit_db'
+
+PLANS_FILE = os.path.join(os.path.dirname(__file__), 'query_plans.json')
+
+# Flags.
+COLLSCAN = 'collscan'
+IN_MEMORY_SORT = 'in_memory_sort'
+EXAMINED_RATIO = 'examined_ratio'
+FLAGS = 'flags'
+INDEXES = 'indexes'
+
+MAX_EXAMINED_RATIO = 10
+
+# The engine methods that take a database and collection, besides
+# the ones _RecordingEngine wraps itself.
+DB_METHODS = ['insert_one', 'update_one', 'update_many', 'delete_one',
+              'delete_many', 'create_indexes', 'index_names', 'drop_index',
+              'explain']
+
+SEED_USERS = 20
+CATEGORIES_PER_USER = 3
+JOURNALS_PER_CATEGORY = 4
+
+
+class _RecordingEngine:
+    """
+    Wrap an engine, sending every database to AUDIT_DB and noting the
+    shape of every filter that reaches it.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.name = engine.name
+        # {shape: (collection, filter, sort)}, in the order first seen.
+        self.queries = {}
+
+    def _note(self, collection, filt, sort=None):
+        shape = (f'{collection} {json.dumps(dbc.filter_shape(filt or {}))}'
+                 + (f' sort {json.dumps(sort)}' if sort else ''))
+        self.queries.setdefault(shape, (collection, filt or {}, sort))
+
+    def find(self, db, collection, filt=None, projection=None, sort=None,
+             *args, **kwargs):
+        self._note(collection, filt, sort)
+        return self.engine.find(AUDIT_DB, collection, filt, projection,
+                                sort, *args, **kwargs)
+
+    def find_raw(self, db, collection, filt=None, projection=None,
+                 sort=None, *args, **kwargs):
+        self._note(collection, filt, sort)
+        return self.engine.find_raw(AUDIT_DB, collection, filt, projection,
+                                    sort, *args, **kwargs)
+
+    def bulk_write(self, db, collection, ops, ordered=True):
+        for op in ops:
+            if base.FILTER in op:
+                self._note(collection, op[base.FILTER])
+        return self.engine.bulk_write(AUDIT_DB, collection, ops, ordered)
+
+    def __getattr__(self, attr):
+        method = getattr(self.engine, attr)
+        if attr not in DB_METHODS:
+            return method
+
+        def call(db, collection, *args, **kwargs):
+            if attr.startswith(('update', 'delete')):
+                self._note(collection, args[0])
+            return method(AUDIT_DB, collection, *args, **kwargs)
+        return call
+
+
+def _user_id(i) -> str:
+    return str(i).rjust(usrs.USER_ID_LEN, '0')
+
+
+def _category_id(user, i) -> str:
+    return str(user * CATEGORIES_PER_USER + i).rjust(ctgs.CATEGORY_ID_LEN,
+                                                     '0')
+
+
+def _journal_id(category, i) -> str:
+    return str(int(category) * JOURNALS_PER_CATEGORY + i).rjust(
+        jrnls.ID_LEN, '0')
+
+
+def seed():
+    """
+    Fill the scratch database, using the data modules' bulk adds.
+    """
+    usrs.add_users([
+        {usrs.USER_ID: _user_id(i), usrs.FIRST_NAME: 'Ann',
+         usrs.LAST_NAME: 'Lee', usrs.DOB: '2000-01-01',
+         usrs.EMAIL: f'user{i}@example.com', usrs.PASSWORD: 'Password1'}
+        for i in range(SEED_USERS)])
+    ctgs.add_categories([
+        {ctgs.CATEGORY_ID: _category_id(user, i),
+         ctgs.CATEGORY_NAME: f'Category {i}', ctgs.USER: _user_id(user)}
+        for user in range(SEED_USERS) for i in range(CATEGORIES_PER_USER)])
+    jrnls.add_journals([
+        {jrnls.JOURNAL_ID: _journal_id(_category_id(user, c), i),
+         jrnls.TITLE: f'Entry {i}', jrnls.PROMPT: jrnls.TEST_PROMPT,
+         jrnls.CONTENT: f'Dear diary, day {i}.', jrnls.USER: _user_id(user),
+         jrnls.CATEGORY: _category_id(user, c)}
+        for user in range(SEED_USERS) for c in range(CATEGORIES_PER_USER)
+        for i in range(JOURNALS_PER_CATEGORY)])
+
+
+def run_workload():
+    """
+    Call every read and write of the data modules once.
+    """
+    user, other = _user_id(0), _user_id(1)
+    category = _category_id(0, 0)
+    journal = _journal_id(category, 0)
+    usrs.get_users()
+    usrs.get_users(usrs.SUMMARY_FIELDS)
+    list(usrs.iter_users_json())
+    usrs.get_user(user)
+    usrs.get_user('user1@example.com')
+    usrs.update_user(user, {usrs.FIRST_NAME: 'Bea'})
+    ctgs.get_categories()
+    list(ctgs.iter_categories_json())
+    ctgs.expand_journals(ctgs.get_user_categories(user))
+    list(ctgs.iter_user_categories(user))
+    ctgs.get_category(category)
+    ctgs.update_category(category, {ctgs.CATEGORY_NAME: 'Renamed'})
+    jrnls.get_journals()
+    jrnls.get_journals(jrnls.SUMMARY_FIELDS)
+    list(jrnls.iter_journals_json())
+    jrnls.get_user_journals(user)
+    list(jrnls.iter_user_journals(user))
+    jrnls.get_category_journals(category)
+    list(jrnls.iter_category_journals(category))
+    jrnls.search_journals('diary', user)
+    jrnls.get_journal(journal)
+    jrnls.update_journal(journal, {jrnls.TITLE: 'Retitled',
+                                   jrnls.CATEGORY: _category_id(0, 1)})
+    new_user = _user_id(SEED_USERS)
+    usrs.add_user(new_user, 'Cal', 'Lee', '2000-01-01', 'new@example.com',
+                  'Password1')
+    new_category = _category_id(SEED_USERS, 0)
+    ctgs.add_category(new_category, 'New', new_user)
+    new_journal = _journal_id(new_category, 0)
+    jrnls.add_journal(new_journal, 'New', jrnls.TEST_PROMPT, 'Hello',
+                      new_user, new_category)
+    jrnls.del_journal(new_journal)
+    ctgs.del_category(new_category)
+    usrs.del_user(new_user)
+    ctgs.get_user_categories(other)
+
+
+def explain(engine, queries) -> dict:
+    """
+    Explain each query and flag the bad plans:
+    {shape: {...Engine.explain, FLAGS: [flags]}}.
+    """
+    report = {}
+    for shape, (collection, filt, sort) in queries.items():
+        plan = engine.explain(AUDIT_DB, collection, filt, sort)
+        flags = []
+        # Listing a whole collection is meant to read all of it.
+        if plan[base.STAGE] == base.COLLSCAN and filt:
+            flags.append(COLLSCAN)
+        if plan[base.IN_MEMORY_SORT]:
+            flags.append(IN_MEMORY_SORT)
+        examined = max(plan[base.KEYS_EXAMINED], plan[base.DOCS_EXAMINED])
+        if examined > MAX_EXAMINED_RATIO * max(plan[base.RETURNED], 1):
+            flags.append(EXAMINED_RATIO)
+        report[shape] = {**plan, FLAGS: flags}
+    return report
+
+
+def audit() -> dict:
+    """
+    Seed the scratch database, run the workload and explain its queries.
+    The scratch collections are emptied afterwards.
+    """
+    recorder = _RecordingEngine(dbc.connect_db())
+    old = dbc.use_engine(recorder)
+    try:
+        seed()
+        run_workload()
+        return explain(recorder.engine, recorder.queries)
+    finally:
+        dbc.use_engine(old)
+        for collection in [usrs.USERS_COLLECT, ctgs.CATEGORIES_COLLECT,
+                           jrnls.JOURNALS_COLLECT]:
+            recorder.engine.delete_many(AUDIT_DB, collection, {})
+
+
+def load_plans(path=PLANS_FILE) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as plans:
+        return json.load(plans)
+
+
+def save_plans(report, engine_name, path=PLANS_FILE):
+    """
+    Accept the indexes and flags in report as the baseline for
+    engine_name.
+    """
+    plans = load_plans(path)
+    plans[engine_name] = {
+        shape: {INDEXES: [result[base.INDEX]] if result[base.INDEX] else [],
+                FLAGS: result[FLAGS]}
+        for shape, result in sorted(report.items())}
+    with open(path, 'w') as out:
+        json.dump(plans, out, indent=4)
+        out.write('\n')
+
+
+def regressions(report, accepted) -> list:
+    """
+    Describe each shape in report that accepted does not cover.
+    accepted is {shape: {INDEXES: [names], FLAGS: [flags]}} for the
+    engine report came from; a shape with no INDEXES must use none.
+    """
+    ret = []
+    for shape, result in report.items():
+        if shape not in accepted:
+            ret.append(f'{shape}: not in the baseline')
+            continue
+        indexes = accepted[shape][INDEXES]
+        index = result[base.INDEX]
+        problems = [flag for flag in result[FLAGS]
+                    if flag not in accepted[shape][FLAGS]]
+        if (index or indexes) and index not in indexes:
+            problems.append(f'uses {index or "no index"}'
+                            + (f', not {" or ".join(indexes)}'
+                               if indexes else ''))
+        if problems:
+            ret.append(f'{shape}: {", ".join(problems)} '
+                       f'(examined {result[base.DOCS_EXAMINED]}, '
+                       f'returned {result[base.RETURNED]})')
+    return ret
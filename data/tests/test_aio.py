@@ -0,0 +1,217 @@
+import asyncio
+import threading
+import weakref
+
+import pytest
+
+import data.aio.categories as actgs
+import data.aio.db_connect as adbc
+import data.aio.journals as ajrnls
+import data.aio.users as ausrs
+import data.categories as ctgs
+import data.engines.base as base
+import data.engines.memory as memory
+import data.engines.sqlite as sqlite
+import data.journals as jrnls
+import data.users as usrs
+
+AIO_EMAIL = "aioemail@gmail.com"
+AIO_TITLE = "Async title"
+
+
+def run(coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            # Each asyncio.run is a new event loop.
+            await adbc.close_db()
+    return asyncio.run(main())
+
+
+@pytest.fixture(scope='function')
+def temp_user():
+    user_id = usrs._get_user_id()
+    run(ausrs.add_user(user_id, "John", "Smith", "2002-11-20", AIO_EMAIL,
+                       "Password1"))
+    yield user_id
+    if run(ausrs.exists(user_id)):
+        run(ausrs.del_user(user_id))
+
+
+@pytest.fixture(scope='function')
+def temp_category(temp_user):
+    category_id = ctgs._get_category_id()
+    run(actgs.add_category(category_id, ctgs._get_category_name(), temp_user))
+    yield category_id
+    if run(actgs.exists(category_id)):
+        run(actgs.del_category(category_id))
+
+
+def test_add_user(temp_user):
+    user = run(ausrs.get_user(temp_user))
+    assert usrs.get_email(user) == AIO_EMAIL
+    assert run(ausrs.get_user(AIO_EMAIL.upper()))[usrs.USER_ID] == temp_user
+
+
+def test_add_dup_user(temp_user):
+    with pytest.raises(ValueError, match='under this email'):
+        run(ausrs.add_user(usrs._get_user_id(), "John", "Smith",
+                           "2002-11-20", AIO_EMAIL, "Password1"))
+    with pytest.raises(ValueError, match='This user is already registered'):
+        run(ausrs.add_user(temp_user, "John", "Smith", "2002-11-20",
+                           "other" + AIO_EMAIL, "Password1"))
+
+
+def test_update_user(temp_user):
+    assert run(ausrs.update_user(temp_user, {usrs.FIRST_NAME: "James"}))
+    assert usrs.get_first_name(run(ausrs.get_user(temp_user))) == "James"
+
+
+def test_del_user_not_there():
+    with pytest.raises(ValueError):
+        run(ausrs.del_user(usrs._get_user_id()))
+
+
+def test_get_user_categories(temp_category, temp_user):
+    user_cats = run(actgs.get_user_categories(temp_user))
+    assert list(user_cats) == [temp_category]
+
+
+def test_journal_lifecycle(temp_user, temp_category):
+    journal_id = jrnls._get_journal_id()
+    assert run(ajrnls.add_journal(journal_id, "", "prompt", "content",
+                                  temp_user, temp_category))
+    category = run(actgs.get_category(temp_category))
+    assert ctgs.get_journal_count(category) == 1
+
+    assert run(ajrnls.update_journal(journal_id, {jrnls.TITLE: AIO_TITLE}))
+    categories = run(actgs.expand_journals(
+        run(actgs.get_user_categories(temp_user))))
+    assert ctgs.get_journals(categories[temp_category]) \
+        == {journal_id: AIO_TITLE}
+    assert list(run(ajrnls.get_user_journals(temp_user))) == [journal_id]
+
+    run(ajrnls.del_journal(journal_id))
+    assert not run(ajrnls.exists(journal_id))
+    category = run(actgs.get_category(temp_category))
+    assert ctgs.get_journal_count(category) == 0
+
+
+def test_update_journal_move_category(temp_user, temp_category):
+    journal_id = jrnls._get_journal_id()
+    new_category_id = ctgs._get_category_id()
+    run(actgs.add_category(new_category_id, ctgs._get_category_name(),
+                           temp_user))
+    run(ajrnls.add_journal(journal_id, AIO_TITLE, "", "", temp_user,
+                           temp_category))
+    assert run(ajrnls.update_journal(journal_id,
+                                     {jrnls.CATEGORY: new_category_id}))
+    old_category = run(actgs.get_category(temp_category))
+    new_category = run(actgs.get_category(new_category_id))
+    assert ctgs.get_journal_count(old_category) == 0
+    assert ctgs.get_journal_count(new_category) == 1
+    run(actgs.del_category(new_category_id))
+    assert not run(ajrnls.exists(journal_id))
+
+
+def test_update_journal_nonexistent_category(temp_user, temp_category):
+    journal_id = jrnls._get_journal_id()
+    run(ajrnls.add_journal(journal_id, "", "", "", temp_user, temp_category))
+    with pytest.raises(ValueError):
+        run(ajrnls.update_journal(journal_id,
+                                  {jrnls.CATEGORY: ctgs._get_category_id()}))
+
+
+def test_single_flight():
+    calls = []
+
+    async def slow_read():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'users': []}
+
+    async def reads():
+        return await asyncio.gather(*[
+            adbc._read('fetch_test', 'test', adbc.JOURNALS_DB, (), slow_read)
+            for _ in range(4)])
+
+    results = run(reads())
+    assert len(calls) == 1
+    assert results == [{'users': []}] * 4
+    assert len({id(result) for result in results}) == 4
+
+
+def test_connect_db_adapters(monkeypatch, tmp_path):
+    monkeypatch.setattr(adbc, 'engine', None)
+    shared = memory.MemoryEngine()
+
+    async def sync_engine():
+        return shared
+    monkeypatch.setattr(adbc, '_sync_engine', sync_engine)
+    assert type(run(adbc.connect_db())) is base.AsyncAdapter
+    shared = sqlite.SqliteEngine(str(tmp_path / 'aio.sqlite3'))
+    assert type(run(adbc.connect_db())) is base.ThreadAdapter
+    shared.close()
+
+
+class FakeMongoEngine:
+    name = adbc.dbc.MONGO_ENGINE
+
+    def __init__(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def test_connect_db_per_loop(monkeypatch):
+    async def no_shared():
+        return None
+    monkeypatch.setattr(adbc, '_sync_engine', no_shared)
+    monkeypatch.setattr(adbc, '_create_engine', FakeMongoEngine)
+    monkeypatch.setattr(adbc, '_loop_engines', weakref.WeakKeyDictionary())
+    monkeypatch.setattr(adbc, '_orphans', [])
+
+    async def connect_twice():
+        first = await adbc.connect_db()
+        assert await adbc.connect_db() is first
+        return first
+    first = asyncio.run(connect_twice())
+    assert not first.closed
+    # The first loop ended without close_db(): the next one closes its
+    # engine and gets its own.
+    second = asyncio.run(adbc.connect_db())
+    assert first.closed and not second.closed
+    assert second is not first
+    third = run(adbc.connect_db())
+    assert second.closed and third.closed
+    assert len(adbc._loop_engines) == 0
+
+
+def test_connect_db_concurrent_loops(monkeypatch):
+    async def no_shared():
+        return None
+    monkeypatch.setattr(adbc, '_sync_engine', no_shared)
+    monkeypatch.setattr(adbc, '_create_engine', FakeMongoEngine)
+    monkeypatch.setattr(adbc, '_loop_engines', weakref.WeakKeyDictionary())
+    monkeypatch.setattr(adbc, '_orphans', [])
+    started = threading.Barrier(2)
+    engines = []
+
+    async def connect():
+        mine = await adbc.connect_db()
+        # Both loops are running at once.
+        await asyncio.to_thread(started.wait)
+        engines.append((mine, await adbc.connect_db()))
+
+    threads = [threading.Thread(target=run, args=(connect(),))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(mine is again for mine, again in engines)
+    (first, _), (second, _) = engines
+    assert first is not second
+    assert first.closed and second.closed
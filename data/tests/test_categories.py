@@ -1,15 +1,13 @@
 from datetime import datetime
 import random
 import data.categories as cats
+import data.db_connect as dbc
 import data.journals as jrnls
 import data.users as usrs
 import pytest
 from datetime import datetime
 
 
-FORMAT = "%Y-%m-%d %H:%M:%S"
-
-
 @pytest.fixture(scope='module')
 def temp_user():
     """
@@ -61,7 +59,8 @@ def test_get_category(temp_category):
     assert cats.CATEGORY_NAME in category
     assert cats.USER in category
     assert cats.DATE_TIME in category
-    assert cats.JOURNALS in category
+    assert cats.JOURNAL_COUNT in category
+    assert cats.LAST_MODIFIED in category
 
 
 def test_get_test_category():
@@ -99,7 +98,25 @@ def test_get_category_name(temp_category):
 
 def test_get_journals(temp_category):
     category = cats.get_category(temp_category)
-    assert cats.get_journals(category) == category[cats.JOURNALS]
+    assert cats.get_journals(category) is None
+    cats.expand_journals({temp_category: category})
+    assert cats.get_journals(category) == category[cats.JOURNALS] == {}
+
+
+def test_get_journal_count(temp_category):
+    category = cats.get_category(temp_category)
+    assert cats.get_journal_count(category) == 0
+    assert cats.get_last_modified(category) == category[cats.DATE_TIME]
+
+
+def test_expand_journals(temp_category):
+    user_id = cats.get_user(cats.get_category(temp_category))
+    journal_id = jrnls._get_journal_id()
+    jrnls.add_journal(journal_id, "Expanded", "", "", user_id, temp_category)
+    categories = cats.expand_journals(cats.get_user_categories(user_id))
+    assert categories[temp_category][cats.JOURNALS] == {journal_id: "Expanded"}
+    assert cats.expand_journals({}) == {}
+    jrnls.del_journal(journal_id)
 
 
 def test_get_categories(temp_category):
@@ -114,13 +131,13 @@ def test_get_categories(temp_category):
         assert cats.CATEGORY_NAME in category
         assert cats.USER in category
         assert cats.DATE_TIME in category
-        assert cats.JOURNALS in category
+        assert cats.JOURNALS not in category
 
         assert isinstance(category[cats.CATEGORY_NAME], str)
         assert isinstance(category[cats.USER], str)
-        date_time = str(category[cats.DATE_TIME])
-        assert isinstance(datetime.strptime(date_time, FORMAT), datetime)
-        assert isinstance(category[cats.JOURNALS], dict)
+        assert isinstance(category[cats.DATE_TIME], datetime)
+        assert isinstance(category[cats.JOURNAL_COUNT], int)
+        assert isinstance(category[cats.LAST_MODIFIED], datetime)
 
     assert cats.exists(temp_category)
 
@@ -151,7 +168,7 @@ def test_add_dup_category_id(temp_category):
     category_name = cats._get_category_name()
         
     # attempting to add category again
-    with pytest.raises(ValueError):
+    with pytest.raises(ValueError, match='Duplicate category.$'):
         cats.add_category(cat_id, category_name, user)
 
 
@@ -174,6 +191,24 @@ def test_del_category(temp_category):
     assert not cats.exists(category_id)
 
 
+def test_del_category_with_journals(temp_category):
+    user_id = cats.get_user(cats.get_category(temp_category))
+    journal_id = jrnls._get_journal_id()
+    jrnls.add_journal(journal_id, "", "", "", user_id, temp_category)
+    cats.del_category(temp_category)
+    assert not jrnls.exists(journal_id)
+
+
+def test_del_category_journals_first(temp_category):
+    dbc.start_op_log()
+    try:
+        cats.del_category(temp_category)
+        assert dbc.get_op_log() == [(jrnls.JOURNALS_COLLECT, 'delete_many'),
+                                    (cats.CATEGORIES_COLLECT, 'delete_one')]
+    finally:
+        dbc.stop_op_log()
+
+
 def test_del_category_not_there():
     category_id = cats._get_category_id()
     with pytest.raises(ValueError):
@@ -195,35 +230,35 @@ def test_update_category(temp_category):
 def test_update_category_name(temp_category):
     category_id = temp_category
     prev_category = cats.get_category(category_id)
-    prev_journals = cats.get_journals(prev_category)
+    prev_count = cats.get_journal_count(prev_category)
     
     update_data = {cats.CATEGORY_NAME: UPDATED_CATEGORY_NAME}
     assert cats.update_category(category_id, update_data)
 
     updated_category = cats.get_category(category_id)
     assert cats.get_category_name(updated_category) == UPDATED_CATEGORY_NAME
-    assert cats.get_journals(updated_category) == prev_journals
+    assert cats.get_journal_count(updated_category) == prev_count
 
 
 def test_update_category_name_zero_length(temp_category):
     category_id = temp_category
     prev_category = cats.get_category(category_id)
     prev_category_name = cats.get_category_name(prev_category)
-    prev_journals = cats.get_journals(prev_category)
+    prev_count = cats.get_journal_count(prev_category)
 
     update_data = {cats.CATEGORY_NAME: ""}
     assert cats.update_category(category_id, update_data)
 
     updated_category = cats.get_category(category_id)
     assert cats.get_category_name(updated_category) == prev_category_name
-    assert cats.get_journals(updated_category) == prev_journals
+    assert cats.get_journal_count(updated_category) == prev_count
 
 
 def test_update_category_journals(temp_category):
     category_id = temp_category
     prev_category = cats.get_category(category_id)
     prev_category_name = cats.get_category_name(prev_category)
-    prev_journals = cats.get_journals(prev_category)
+    prev_count = cats.get_journal_count(prev_category)
 
     journal_id = jrnls._get_journal_id()
     new_journal = jrnls.add_journal(journal_id, "", "", "", 
@@ -233,22 +268,56 @@ def test_update_category_journals(temp_category):
 
     updated_category = cats.get_category(category_id)
     assert cats.get_category_name(updated_category) == prev_category_name
-    assert cats.get_journals(updated_category) != prev_journals
-    assert cats.get_journals(updated_category) == {journal_id: UPDATED_CATEGORY_NAME}
+    assert cats.get_journal_count(updated_category) == prev_count + 1
+    assert cats.get_last_modified(updated_category) \
+        >= cats.get_last_modified(prev_category)
+    expanded = cats.expand_journals({category_id: updated_category})
+    assert cats.get_journals(expanded[category_id]) \
+        == {journal_id: UPDATED_CATEGORY_NAME}
 
 
 def test_update_category_invalid_key(temp_category):
     category_id = temp_category
     prev_category = cats.get_category(category_id)
     prev_category_name = cats.get_category_name(prev_category)
-    prev_journals = cats.get_journals(prev_category)
+    prev_count = cats.get_journal_count(prev_category)
     
     update_data = {"INVALID": "KEY"}
     assert cats.update_category(category_id, update_data)
 
     updated_category = cats.get_category(category_id)
     assert cats.get_category_name(updated_category) == prev_category_name
-    assert cats.get_journals(updated_category) == prev_journals
+    assert cats.get_journal_count(updated_category) == prev_count
+
+
+def test_update_category_journal_count(temp_category):
+    assert cats.update_category(temp_category, {cats.JOURNAL_COUNT: 10})
+    assert cats.get_journal_count(cats.get_category(temp_category)) == 0
+
+
+def test_journal_counts_updates(temp_category):
+    category = cats.get_category(temp_category)
+    assert cats._journal_counts_updates([category]) == [None]
+
+    journal_id = jrnls._get_journal_id()
+    jrnls.add_journal(journal_id, "Old", "", "", cats.get_user(category),
+                      temp_category)
+    old_category = {cats.CATEGORY_ID: temp_category,
+                    cats.DATE_TIME: category[cats.DATE_TIME],
+                    cats.JOURNALS: {journal_id: "Old"}}
+    empty_category = {cats.CATEGORY_ID: cats._get_category_id(),
+                      cats.DATE_TIME: category[cats.DATE_TIME],
+                      cats.JOURNALS: {}}
+    timestamp = jrnls.get_timestamp(jrnls.get_journal(journal_id))
+    assert cats._journal_counts_updates([old_category, category,
+                                         empty_category]) == [
+        {'$set': {cats.JOURNAL_COUNT: 1, cats.LAST_MODIFIED: timestamp},
+         '$unset': {cats.JOURNALS: ''}},
+        None,
+        {'$set': {cats.JOURNAL_COUNT: 0,
+                  cats.LAST_MODIFIED: category[cats.DATE_TIME]},
+         '$unset': {cats.JOURNALS: ''}}]
+    jrnls.del_journal(journal_id)
 
 
 def test_update_category_nonexistent_category():
@@ -263,3 +332,34 @@ def test_update_category_nothing_to_update(temp_category):
     update_data = {}
     with pytest.raises(ValueError):
         cats.update_category(category_id, update_data)
+
+
+def test_get_user_categories_summary(temp_category):
+    user_id = cats.get_user(cats.get_category(temp_category))
+    user_cats = cats.get_user_categories(user_id, cats.SUMMARY_FIELDS)
+    assert set(user_cats[temp_category]) == set(cats.SUMMARY_FIELDS)
+
+
+def test_iter_user_categories(temp_category):
+    user_id = cats.get_user(cats.get_category(temp_category))
+    category_ids = [category[cats.CATEGORY_ID]
+                    for category in cats.iter_user_categories(user_id)]
+    assert category_ids == [temp_category]
+
+
+def test_add_categories(temp_user):
+    cat1_id = cats._get_category_id()
+    cat2_id = cats._get_category_id()
+    report = cats.add_categories([
+        {cats.CATEGORY_ID: cat1_id, cats.CATEGORY_NAME: "Bulk",
+         cats.USER: temp_user},
+        {cats.CATEGORY_ID: cat2_id, cats.CATEGORY_NAME: "bulk",
+         cats.USER: temp_user},
+        {cats.CATEGORY_ID: cats._get_category_id(), cats.CATEGORY_NAME: "",
+         cats.USER: temp_user},
+    ])
+    assert report[dbc.INSERTED] == 1
+    assert [error[dbc.ITEM_INDEX] for error in report[dbc.ERRORS]] == [1, 2]
+    assert cats.exists(cat1_id)
+    assert not cats.exists(cat2_id)
+    cats.del_category(cat1_id)
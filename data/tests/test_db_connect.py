@@ -1,6 +1,16 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import bson
+import pymongo as pm
 import pytest
 
 import data.db_connect as dbc
+import data.engines.memory as memory
+import data.engines.sharded as sharded
 
 TEST_DB = dbc.JOURNALS_DB
 TEST_COLLECT = 'test_collect'
@@ -12,10 +22,10 @@ UPDATE = 'Update'
 @pytest.fixture(scope='function')
 def temp_rec():
     dbc.connect_db()
-    dbc.client[TEST_DB][TEST_COLLECT].insert_one({TEST_NAME: TEST_NAME})
+    dbc.insert_one(TEST_COLLECT, {TEST_NAME: TEST_NAME})
     # yield to our test function
     yield
-    dbc.client[TEST_DB][TEST_COLLECT].delete_one({TEST_NAME: TEST_NAME})
+    dbc.del_one(TEST_COLLECT, {TEST_NAME: TEST_NAME})
 
 
 def test_fetch_one(temp_rec):
@@ -31,4 +41,595 @@ def test_fetch_one_not_there(temp_rec):
 def test_update_doc(temp_rec):
     dbc.update_doc(TEST_COLLECT, {TEST_NAME: TEST_NAME}, {TEST_NAME: UPDATE})
     ret = dbc.fetch_one(TEST_COLLECT, {TEST_NAME: UPDATE})
-    assert ret is not None
\ No newline at end of file
+    assert ret is not None
+
+def test_fetch_many(temp_rec):
+    ret = dbc.fetch_many(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+    assert isinstance(ret, list)
+    assert len(ret) > 0
+    for doc in ret:
+        assert doc[TEST_NAME] == TEST_NAME
+
+
+def test_fetch_many_not_there(temp_rec):
+    ret = dbc.fetch_many(TEST_COLLECT, {TEST_NAME: 'not a field value in db!'})
+    assert ret == []
+
+
+def test_fetch_many_sort_limit_skip(temp_rec):
+    dbc.insert_one(TEST_COLLECT, {TEST_NAME: TEST_NAME, UPDATE: 2})
+    dbc.insert_one(TEST_COLLECT, {TEST_NAME: TEST_NAME, UPDATE: 1})
+    filt = {TEST_NAME: TEST_NAME, UPDATE: {'$exists': True}}
+    ret = dbc.fetch_many(TEST_COLLECT, filt, sort=[(UPDATE, 1)])
+    assert [doc[UPDATE] for doc in ret] == [1, 2]
+    ret = dbc.fetch_many(TEST_COLLECT, filt, sort=[(UPDATE, 1)],
+                         limit=1, skip=1)
+    assert [doc[UPDATE] for doc in ret] == [2]
+    dbc.delete_many(TEST_COLLECT, filt)
+
+
+def test_fetch_many_as_dict(temp_rec):
+    ret = dbc.fetch_many_as_dict(TEST_NAME, TEST_COLLECT,
+                                 {TEST_NAME: TEST_NAME})
+    assert TEST_NAME in ret
+    assert dbc.MONGO_ID not in ret[TEST_NAME]
+
+
+def test_index():
+    spec = dbc.index(TEST_NAME, (UPDATE, dbc.DESCENDING), unique=True)
+    assert spec[dbc.INDEX_NAME] == f'{TEST_NAME}_1_{UPDATE}_-1'
+    assert spec[dbc.INDEX_KEYS] == [(TEST_NAME, dbc.ASCENDING),
+                                    (UPDATE, dbc.DESCENDING)]
+    assert spec[dbc.INDEX_UNIQUE]
+
+
+def test_ensure_indexes():
+    dbc.connect_db()
+    spec = dbc.index(TEST_NAME)
+    dbc.register_indexes(TEST_COLLECT, [spec])
+    dbc.ensure_indexes()
+    report = dbc.index_report()
+    assert report[TEST_COLLECT][dbc.MISSING] == []
+    del dbc.indexes[(TEST_DB, TEST_COLLECT)]
+    dbc.drop_index(TEST_COLLECT, spec[dbc.INDEX_NAME])
+
+
+def test_failed_index_build_not_published(monkeypatch):
+    import data.users as usrs
+    dupes = memory.MemoryEngine()
+    for email in ['xx@yy.com', 'xx@yy.com']:
+        dupes.insert_one(TEST_DB, usrs.USERS_COLLECT, {usrs.EMAIL: email})
+    current = dbc.connect_db()
+    with pytest.raises(dbc.DuplicateKeyError):
+        dbc.use_engine(dupes)
+    assert dbc.engine is current
+    monkeypatch.setitem(dbc.ENGINES, dbc.engine_name(), lambda: dupes)
+    monkeypatch.setattr(dbc, 'engine', None)
+    # Every call fails, rather than only the first.
+    for _ in range(2):
+        with pytest.raises(dbc.DuplicateKeyError):
+            dbc.connect_db()
+        assert dbc.engine is None
+
+
+def test_connect_db_logs(monkeypatch, caplog, capsys):
+    monkeypatch.setitem(dbc.ENGINES, dbc.engine_name(), memory.MemoryEngine)
+    monkeypatch.setattr(dbc, 'engine', None)
+    with caplog.at_level('INFO', logger=dbc.logger.name):
+        dbc.connect_db()
+    assert 'Setting client because it is None.' in caplog.text
+    assert capsys.readouterr().out == ''
+
+
+def test_index_report_missing():
+    dbc.connect_db()
+    spec = dbc.index(UPDATE)
+    dbc.indexes[(TEST_DB, TEST_COLLECT)] = {spec[dbc.INDEX_NAME]: spec}
+    report = dbc.index_report()
+    assert spec[dbc.INDEX_NAME] in report[TEST_COLLECT][dbc.MISSING]
+    del dbc.indexes[(TEST_DB, TEST_COLLECT)]
+
+
+def test_connect_db():
+    assert dbc.connect_db() is dbc.engine
+    assert dbc.engine is not None
+    assert dbc.connect_db() is dbc.engine
+
+
+def test_pool_settings(monkeypatch):
+    monkeypatch.setenv('MONGO_MAX_POOL_SIZE', '25')
+    monkeypatch.setenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', '1000')
+    settings = dbc._pool_settings()
+    assert settings['maxPoolSize'] == 25
+    assert settings['waitQueueTimeoutMS'] == 1000
+    assert 'minPoolSize' not in settings
+
+
+def test_connect_db_after_fork():
+    dbc.connect_db()
+    # pretend the client was created in a parent process
+    dbc._client_pid = -1
+    dbc.connect_db()
+    assert dbc._client_pid == os.getpid()
+    assert dbc.engine is not None
+
+
+def test_close_db():
+    dbc.connect_db()
+    dbc.close_db()
+    assert dbc.engine is None
+    dbc.connect_db()
+    assert dbc.engine is not None
+
+
+def test_fetch_one_fields(temp_rec):
+    filt = {TEST_NAME: TEST_NAME, UPDATE: UPDATE}
+    dbc.insert_one(TEST_COLLECT, filt)
+    ret = dbc.fetch_one(TEST_COLLECT, filt, [UPDATE])
+    assert ret[UPDATE] == UPDATE
+    assert TEST_NAME not in ret
+    dbc.del_one(TEST_COLLECT, filt)
+
+
+def test_fetch_many_as_dict_fields(temp_rec):
+    ret = dbc.fetch_many_as_dict(TEST_NAME, TEST_COLLECT,
+                                 {TEST_NAME: TEST_NAME}, [UPDATE])
+    assert ret[TEST_NAME] == {TEST_NAME: TEST_NAME}
+
+
+def test_iter_docs(temp_rec):
+    docs = dbc.iter_docs(TEST_COLLECT, {TEST_NAME: TEST_NAME}, batch_size=1)
+    assert not isinstance(docs, list)
+    docs = list(docs)
+    assert len(docs) > 0
+    for doc in docs:
+        assert doc[TEST_NAME] == TEST_NAME
+        assert isinstance(doc[dbc.MONGO_ID], str)
+
+
+def test_insert_many():
+    dbc.connect_db()
+    docs = [{TEST_NAME: 'bulk', UPDATE: i} for i in range(3)]
+    report = dbc.insert_many(TEST_COLLECT, docs)
+    assert report[dbc.INSERTED] == 3
+    assert report[dbc.ERRORS] == []
+    assert len(dbc.fetch_many(TEST_COLLECT, {TEST_NAME: 'bulk'})) == 3
+    dbc.delete_many(TEST_COLLECT, {TEST_NAME: 'bulk'})
+    assert dbc.fetch_many(TEST_COLLECT, {TEST_NAME: 'bulk'}) == []
+
+
+def test_update_many():
+    dbc.connect_db()
+    dbc.insert_many(TEST_COLLECT, [{TEST_NAME: 'bulk'}, {TEST_NAME: 'bulk'}])
+    result = dbc.update_many(TEST_COLLECT, {TEST_NAME: 'bulk'}, {UPDATE: 1})
+    assert result.modified_count == 2
+    dbc.delete_many(TEST_COLLECT, {TEST_NAME: 'bulk'})
+
+
+def test_bulk_write():
+    dbc.connect_db()
+    ops = [
+        dbc.insert_op({TEST_NAME: 'bulk'}),
+        dbc.update_op({TEST_NAME: 'bulk'}, {UPDATE: 1}),
+        dbc.delete_op({TEST_NAME: 'bulk'}),
+    ]
+    report = dbc.bulk_write(TEST_COLLECT, ops)
+    assert report[dbc.INSERTED] == 1
+    assert report[dbc.MODIFIED] == 1
+    assert report[dbc.DELETED] == 1
+    assert report[dbc.ERRORS] == []
+
+
+def test_bulk_write_errors():
+    dbc.connect_db()
+    doc_id = 'bulk_write_error'
+    ops = [
+        dbc.insert_op({dbc.MONGO_ID: doc_id}),
+        dbc.insert_op({dbc.MONGO_ID: doc_id}),
+        dbc.insert_op({dbc.MONGO_ID: doc_id + '2'}),
+    ]
+    report = dbc.bulk_write(TEST_COLLECT, ops, ordered=False)
+    assert report[dbc.INSERTED] == 2
+    assert len(report[dbc.ERRORS]) == 1
+    assert report[dbc.ERRORS][0][dbc.ITEM_INDEX] == 1
+    dbc.delete_many(TEST_COLLECT,
+                    {dbc.MONGO_ID: {'$in': [doc_id, doc_id + '2']}})
+
+
+def test_insert_many_checked():
+    dbc.connect_db()
+
+    def make_doc(item):
+        if item < 0:
+            raise ValueError('negative')
+        return {TEST_NAME: 'checked', UPDATE: item}
+
+    report = dbc.insert_many_checked(TEST_COLLECT, [1, -1, 2], make_doc)
+    assert report[dbc.INSERTED] == 2
+    assert report[dbc.ERRORS] == [{dbc.ITEM_INDEX: 1,
+                                   dbc.MESSAGE: 'negative'}]
+    dbc.delete_many(TEST_COLLECT, {TEST_NAME: 'checked'})
+
+
+def test_index_made_unique():
+    old = dbc.use_engine(memory.MemoryEngine())
+    dbc.insert_one(TEST_COLLECT, {TEST_NAME: 'a'})
+    spec = dbc.index(TEST_NAME)
+    dbc.register_indexes(TEST_COLLECT, [spec])
+    dbc.register_indexes(TEST_COLLECT, [dbc.index(TEST_NAME, unique=True)])
+    with pytest.raises(dbc.DuplicateKeyError) as err:
+        dbc.insert_one(TEST_COLLECT, {TEST_NAME: 'a'})
+    assert dbc.duplicate_fields(err.value) == [TEST_NAME]
+    # Docs that are not unique keep the old index.
+    dbc.insert_one(TEST_COLLECT, {TEST_NAME: 'b', UPDATE: 'x'})
+    dbc.insert_one(TEST_COLLECT, {TEST_NAME: 'c', UPDATE: 'x'})
+    dbc.register_indexes(TEST_COLLECT, [dbc.index(UPDATE)])
+    with pytest.raises(dbc.DuplicateKeyError):
+        dbc.register_indexes(TEST_COLLECT,
+                             [dbc.index(UPDATE, unique=True)])
+    assert dbc.index_report()[TEST_COLLECT][dbc.MISSING] == []
+    del dbc.indexes[(TEST_DB, TEST_COLLECT)]
+    dbc.use_engine(old)
+
+
+def test_use_engine():
+    old = dbc.connect_db()
+    new = memory.MemoryEngine()
+    assert dbc.use_engine(new) is old
+    assert dbc.connect_db() is new
+    dbc.insert_one(TEST_COLLECT, {TEST_NAME: 'use_engine'})
+    assert dbc.fetch_one(TEST_COLLECT, {TEST_NAME: 'use_engine'}) is not None
+    dbc.use_engine(old)
+    assert dbc.fetch_one(TEST_COLLECT, {TEST_NAME: 'use_engine'}) is None
+
+
+def test_engine_name(monkeypatch):
+    monkeypatch.setenv('DB_ENGINE', dbc.MEMORY_ENGINE)
+    assert dbc.engine_name() == dbc.MEMORY_ENGINE
+    monkeypatch.setenv('DB_ENGINE', 'no such engine')
+    with pytest.raises(ValueError):
+        dbc.engine_name()
+
+
+def test_filter_shape():
+    filt = {TEST_NAME: {'$in': [1, 2]}, '$or': [{UPDATE: 1}, {UPDATE: 2}]}
+    assert dbc.filter_shape(filt) == {TEST_NAME: {'$in': ['?']},
+                                      '$or': [{UPDATE: '?'}]}
+
+
+def test_op_stats(temp_rec):
+    dbc.reset_op_stats()
+    dbc.fetch_one(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+    dbc.fetch_many(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+    dbc.fetch_many(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+    stats = dbc.get_op_stats()[TEST_COLLECT]
+    assert stats['find_one'][dbc.COUNT] == 1
+    assert stats['find'][dbc.COUNT] == 2
+    assert stats['find'][dbc.MAX_MS] <= stats['find'][dbc.TOTAL_MS]
+    dbc.reset_op_stats()
+    assert dbc.get_op_stats() == {}
+
+
+def test_slow_query_log(temp_rec, monkeypatch, caplog):
+    monkeypatch.setattr(dbc, 'SLOW_QUERY_MS', 0)
+    dbc.reset_op_stats()
+    with caplog.at_level('WARNING', logger=dbc.logger.name):
+        dbc.fetch_one(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+    assert dbc.get_op_stats()[TEST_COLLECT]['find_one'][dbc.SLOW] == 1
+    assert "filter {'test': '?'}" in caplog.text
+
+
+@pytest.fixture(scope='function')
+def query_cache(monkeypatch):
+    monkeypatch.setattr(dbc, 'CACHE_SIZE', 2)
+    dbc.clear_cache()
+    yield
+    dbc.clear_cache()
+
+
+def test_cache_hit(temp_rec, query_cache):
+    filt = {TEST_NAME: TEST_NAME}
+    first = dbc.fetch_one(TEST_COLLECT, filt)
+    first[UPDATE] = UPDATE
+    assert dbc.fetch_one(TEST_COLLECT, filt) == {
+        key: value for key, value in first.items() if key != UPDATE}
+    stats = dbc.get_cache_stats()
+    assert stats[dbc.HITS] == 1
+    assert stats[dbc.MISSES] == 1
+    assert stats[dbc.HIT_RATIO] == 0.5
+
+
+def test_cache_invalidated_by_write(temp_rec, query_cache):
+    filt = {TEST_NAME: TEST_NAME}
+    dbc.fetch_one(TEST_COLLECT, filt, [UPDATE])
+    dbc.update_doc(TEST_COLLECT, filt, {UPDATE: 1})
+    assert dbc.fetch_one(TEST_COLLECT, filt, [UPDATE])[UPDATE] == 1
+    assert dbc.get_cache_stats()[dbc.INVALIDATIONS] == 1
+
+
+def test_cache_eviction_and_ttl(temp_rec, query_cache, monkeypatch):
+    for value in range(3):
+        dbc.fetch_one(TEST_COLLECT, {TEST_NAME: value})
+    stats = dbc.get_cache_stats()
+    assert stats[dbc.EVICTIONS] == 1
+    assert stats[dbc.SIZE] == 2
+    monkeypatch.setitem(dbc.CACHE_TTLS, TEST_COLLECT, 0)
+    dbc.clear_cache()
+    dbc.fetch_one(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+    assert dbc.get_cache_stats()[dbc.SIZE] == 0
+
+
+def test_parse_durations():
+    assert dbc.parse_durations('users=30, journals=2.5') == {
+        'users': 30.0, 'journals': 2.5}
+
+
+def test_parse_shards():
+    assert dbc.parse_shards('a=mongodb://h1:1/?w=1; b=mongodb://h2') == {
+        'a': 'mongodb://h1:1/?w=1', 'b': 'mongodb://h2'}
+    with pytest.raises(ValueError):
+        dbc.parse_shards('mongodb://h1')
+
+
+def test_sharded_engine():
+    import data.categories as ctgs
+    import data.journals as jrnls
+    import data.users as usrs
+    shards = {name: memory.MemoryEngine() for name in ['a', 'b']}
+    old = dbc.use_engine(sharded.ShardedEngine(shards, dbc.shard_keys,
+                                               id_keys=dbc.id_keys))
+    try:
+        # ids that land on both shards:
+        users = [str(i).rjust(usrs.USER_ID_LEN, '0') for i in range(6, 10)]
+        ctg_ids = [str(i).rjust(ctgs.CATEGORY_ID_LEN, '0')
+                   for i in range(4)]
+        jrnl_ids = [str(i).rjust(jrnls.ID_LEN, '0') for i in range(4)]
+        for i, user_id in enumerate(users):
+            usrs.add_user(user_id, 'Ann', 'Lee', '2000-01-01',
+                          f'user{i}@x.com', 'Password1')
+            ctgs.add_category(ctg_ids[i], 'Diary', user_id)
+            jrnls.add_journal(jrnl_ids[i], 'Title', 'Prompt', 'Content',
+                              user_id, ctg_ids[i])
+        assert all(shard.find(dbc.JOURNALS_DB, jrnls.JOURNALS_COLLECT, {})
+                   for shard in shards.values())
+        assert len(jrnls.get_journals()) == 4
+        assert list(jrnls.get_user_journals(users[1])) == [jrnl_ids[1]]
+        assert ctgs.get_journal_count(ctgs.get_category(ctg_ids[1])) == 1
+        categories = ctgs.expand_journals(ctgs.get_user_categories(users[1]))
+        assert ctgs.get_journals(categories[ctg_ids[1]]) == {
+            jrnl_ids[1]: 'Title'}
+        jrnls.del_journal(jrnl_ids[1])
+        assert len(jrnls.get_journals()) == 3
+        # one shard holds each journal, and the email is taken on all:
+        owner = shards[dbc.engine.shard_for(users[2])]
+        dbc.engine.owners.clear()
+        assert jrnls.get_journal(jrnl_ids[2])
+        assert owner.find(dbc.JOURNALS_DB, sharded.LOCATIONS_COLLECT, {})
+        other = next(user_id for user_id in users
+                     if shards[dbc.engine.shard_for(user_id)] is not owner)
+        with pytest.raises(ValueError):
+            usrs.add_user(other[:-1] + 'x', 'Ann', 'Lee', '2000-01-01',
+                          'user2@x.com', 'Password1')
+    finally:
+        dbc.use_engine(old)
+
+
+@pytest.mark.skipif('MONGO_LIST_READ_PREF' in os.environ,
+                    reason='The list read preference is set.')
+def test_list_read_pref_default():
+    # Secondaries are opt-in: another worker would miss a client's write.
+    assert dbc.LIST_READ_PREF == dbc.PRIMARY
+
+
+def test_fetch_many_read_pref(temp_rec):
+    ret = dbc.fetch_many(TEST_COLLECT, {TEST_NAME: TEST_NAME},
+                         read_pref=dbc.SECONDARY_PREFERRED)
+    assert len(ret) > 0
+    with pytest.raises(ValueError):
+        dbc.fetch_many(TEST_COLLECT, read_pref='secondaryOnly')
+
+
+def test_deadline(temp_rec):
+    assert dbc.remaining_time() is None
+    with dbc.deadline(5):
+        assert 0 < dbc.remaining_time() <= 5
+        assert dbc.fetch_one(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+    assert dbc.remaining_time() is None
+
+
+def test_deadline_exceeded(temp_rec):
+    with dbc.deadline(0):
+        with pytest.raises(dbc.DeadlineExceeded):
+            dbc.fetch_one(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+        with pytest.raises(dbc.DeadlineExceeded):
+            dbc.fetch_many(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+
+
+class FlakyEngine(memory.MemoryEngine):
+    """
+    A memory engine whose reads fail to reach the database `failures`
+    times.
+    """
+    def __init__(self, failures=0):
+        super().__init__()
+        self.failures = failures
+
+    def find(self, *args, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise pm.errors.AutoReconnect('connection refused')
+        return super().find(*args, **kwargs)
+
+
+@pytest.fixture(scope='function')
+def flaky_engine(monkeypatch):
+    monkeypatch.setattr(dbc, 'READ_RETRY_BACKOFF_MS', 0)
+    monkeypatch.setattr(dbc, 'BREAKER_THRESHOLD', 3)
+    engine = FlakyEngine()
+    old = dbc.use_engine(engine)
+    dbc.reset_breaker()
+    yield engine
+    dbc.reset_breaker()
+    dbc.use_engine(old)
+
+
+def test_read_retries(flaky_engine):
+    flaky_engine.failures = dbc.READ_RETRIES
+    assert dbc.fetch_many(TEST_COLLECT) == []
+    flaky_engine.failures = dbc.READ_RETRIES + 1
+    with pytest.raises(pm.errors.AutoReconnect):
+        dbc.fetch_many(TEST_COLLECT)
+
+
+def test_circuit_breaker(flaky_engine, monkeypatch):
+    flaky_engine.failures = 3
+    with pytest.raises(pm.errors.AutoReconnect):
+        dbc.fetch_many(TEST_COLLECT)
+    assert dbc.get_breaker_state()[dbc.STATE] == dbc.OPEN
+    with pytest.raises(dbc.CircuitOpenError):
+        dbc.fetch_many(TEST_COLLECT)
+    monkeypatch.setattr(dbc, 'BREAKER_RESET_S', 0)
+    assert dbc.fetch_many(TEST_COLLECT) == []
+    assert dbc.get_breaker_state()[dbc.STATE] == dbc.CLOSED
+
+
+def test_circuit_ignores_deadlines(flaky_engine):
+    for _ in range(dbc.BREAKER_THRESHOLD):
+        with pytest.raises(dbc.DeadlineExceeded):
+            with dbc.circuit():
+                try:
+                    raise pm.errors.NetworkTimeout('timed out')
+                except pm.errors.NetworkTimeout as err:
+                    raise dbc.DeadlineExceeded('out of time') from err
+    assert dbc.get_breaker_state() == {dbc.STATE: dbc.CLOSED,
+                                       dbc.FAILURES: 0}
+
+
+def test_stale_fallback(flaky_engine, monkeypatch):
+    monkeypatch.setattr(dbc, 'STALE_CACHE_SIZE', 10)
+    dbc.insert_one(TEST_COLLECT, {TEST_NAME: 'stale'})
+    assert len(dbc.fetch_many(TEST_COLLECT, {TEST_NAME: 'stale'})) == 1
+    flaky_engine.failures = 100
+    with pytest.raises(pm.errors.AutoReconnect):
+        dbc.fetch_many(TEST_COLLECT, {TEST_NAME: 'stale'})
+    token = dbc.set_allow_stale(True)
+    try:
+        ret = dbc.fetch_many(TEST_COLLECT, {TEST_NAME: 'stale'})
+    finally:
+        dbc._allow_stale.reset(token)
+    assert len(ret) == 1
+
+
+def test_raw_field():
+    doc = {'f': 1.5, 'o': bson.ObjectId(), 'n': None, 'd': {'x': [1, 2]},
+           'b': b'bytes', 'r': bson.Regex('^a', 'i'), 'i': 2 ** 40,
+           TEST_NAME: TEST_NAME}
+    raw = bson.encode(doc)
+    assert dbc.raw_field(raw, TEST_NAME) == TEST_NAME
+    assert dbc.raw_field(raw, 'd') == {'x': [1, 2]}
+    assert dbc.raw_field(raw, 'i') == 2 ** 40
+    assert dbc.raw_field(raw, 'missing', UPDATE) == UPDATE
+
+
+def test_raw_to_json_dates():
+    when = datetime(2024, 1, 2, 3, 4, 5)
+    raw = bson.encode({TEST_NAME: when, 'd': {'x': 1}})
+    ret = json.loads(dbc.raw_to_json(raw))
+    assert ret == {TEST_NAME: dbc.format_datetime(when), 'd': {'x': 1}}
+    assert dbc.parse_datetime(ret[TEST_NAME]) == when
+
+
+def test_iter_json_items(temp_rec):
+    filt = {TEST_NAME: TEST_NAME}
+    items = dbc.iter_json_items(TEST_NAME, TEST_COLLECT, filt)
+    ret = json.loads('{' + ', '.join(items) + '}')
+    assert ret == dbc.fetch_many_as_dict(TEST_NAME, TEST_COLLECT, filt)
+
+
+def test_op_log(temp_rec):
+    assert dbc.get_op_log() == []
+    dbc.start_op_log()
+    try:
+        dbc.fetch_one(TEST_COLLECT, {TEST_NAME: TEST_NAME})
+        dbc.update_doc(TEST_COLLECT, {TEST_NAME: TEST_NAME},
+                       {TEST_NAME: TEST_NAME})
+        assert dbc.get_op_log() == [(TEST_COLLECT, 'find_one'),
+                                    (TEST_COLLECT, 'update_one')]
+    finally:
+        dbc.stop_op_log()
+    assert dbc.get_op_log() == []
+
+
+def test_single_flight():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_read():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {TEST_NAME: [TEST_NAME]}
+
+    def read():
+        results.append(dbc._read('fetch_test', TEST_COLLECT, TEST_DB, (),
+                                 slow_read))
+
+    results = []
+    coalesced = dbc.get_single_flight_stats()[dbc.COALESCED]
+    leader = threading.Thread(target=read)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=read) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    while dbc.get_single_flight_stats()[dbc.COALESCED] < coalesced + 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{TEST_NAME: [TEST_NAME]}] * 4
+    # Each caller gets its own copy.
+    assert len({id(result) for result in results}) == 4
+
+
+def test_single_flight_not_across_writes():
+    release = threading.Event()
+
+    def slow_read():
+        release.wait(5)
+        return 'before'
+
+    leader = threading.Thread(
+        target=dbc._read,
+        args=('fetch_test', TEST_COLLECT, TEST_DB, (), slow_read))
+    leader.start()
+    # A read after a write must not get the answer of one from before.
+    dbc.invalidate_cache(TEST_COLLECT, TEST_DB)
+    assert dbc._read('fetch_test', TEST_COLLECT, TEST_DB, (),
+                     lambda: 'after') == 'after'
+    release.set()
+    leader.join()
+
+
+def test_single_flight_not_across_read_prefs():
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_read():
+        started.set()
+        release.wait(5)
+        return 'secondary'
+
+    leader = threading.Thread(
+        target=dbc._read,
+        args=('fetch_test', TEST_COLLECT, TEST_DB, (), slow_read,
+              dbc.SECONDARY_PREFERRED))
+    leader.start()
+    started.wait(5)
+    # A primary read must not get the answer of a secondary one.
+    assert dbc._read('fetch_test', TEST_COLLECT, TEST_DB, (),
+                     lambda: 'primary') == 'primary'
+    release.set()
+    leader.join()
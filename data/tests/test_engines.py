@@ -0,0 +1,497 @@
+import asyncio
+import contextlib
+import threading
+
+import pymongo.errors as pme
+import pytest
+
+import data.engines.base as base
+import data.engines.memory as memory
+import data.engines.mongo as mongo
+import data.engines.query as qry
+import data.engines.sharded as sharded
+import data.engines.sqlite as sqlite
+
+TEST_DB = 'test_db'
+TEST_COLLECT = 'test_collect'
+NAME = 'name'
+AGE = 'age'
+ID = 'id'
+EMAIL = 'email'
+
+
+@pytest.fixture(scope='function', params=[memory.MEMORY, sqlite.SQLITE])
+def engine(request, tmp_path):
+    if request.param == sqlite.SQLITE:
+        engine = sqlite.SqliteEngine(str(tmp_path / 'test.sqlite3'))
+    else:
+        engine = memory.MemoryEngine()
+    for i, name in enumerate(['ann', 'bob', 'cat']):
+        engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: name, AGE: 20 + i})
+    yield engine
+    engine.close()
+
+
+def test_matches():
+    doc = {NAME: 'Ann', AGE: 20, 'map': {'a': 1}}
+    assert qry.matches(doc, {NAME: 'Ann', 'map.a': 1})
+    assert qry.matches(doc, {AGE: {'$gte': 20, '$lt': 21}})
+    assert qry.matches(doc, {'$or': [{NAME: 'x'}, {AGE: {'$in': [20]}}]})
+    assert qry.matches(doc, {NAME: {'$regex': '^ann$', '$options': 'i'}})
+    assert qry.matches(doc, {'missing': {'$exists': False}})
+    assert not qry.matches(doc, {NAME: {'$ne': 'Ann'}})
+    assert qry.matches(doc, {'$text': {'$search': 'bob ann'}}, [NAME])
+    assert not qry.matches(doc, {'$text': {'$search': 'an'}}, [NAME])
+
+
+def test_project():
+    doc = {'_id': 1, NAME: 'Ann', AGE: 20}
+    assert qry.project(doc, [NAME]) == {'_id': 1, NAME: 'Ann'}
+    assert qry.project(doc, {NAME: 1, '_id': 0}) == {NAME: 'Ann'}
+    assert qry.project(doc, {AGE: 0}) == {'_id': 1, NAME: 'Ann'}
+
+
+def test_apply_update():
+    doc = {NAME: 'Ann', 'map': {'a': 1}}
+    assert qry.apply_update(doc, {'$set': {'map.b': 2},
+                                  '$unset': {'map.a': ''}})
+    assert doc == {NAME: 'Ann', 'map': {'b': 2}}
+    assert not qry.apply_update(doc, {'$set': {NAME: 'Ann'}})
+
+
+def test_find(engine):
+    docs = engine.find(TEST_DB, TEST_COLLECT, {AGE: {'$gt': 20}},
+                       {NAME: 1, '_id': 0}, sort=[(AGE, -1)], limit=1)
+    assert docs == [{NAME: 'cat'}]
+    docs = engine.find(TEST_DB, TEST_COLLECT, {}, sort=[(AGE, 1)], skip=1)
+    assert [doc[NAME] for doc in docs] == ['bob', 'cat']
+
+
+def test_find_returns_copies(engine):
+    doc = engine.find(TEST_DB, TEST_COLLECT, {NAME: 'ann'})[0]
+    doc[AGE] = 99
+    assert engine.find(TEST_DB, TEST_COLLECT, {NAME: 'ann'})[0][AGE] == 20
+
+
+def test_insert_one_sets_id(engine):
+    doc = {NAME: 'dan'}
+    result = engine.insert_one(TEST_DB, TEST_COLLECT, doc)
+    assert doc['_id'] == result.inserted_id
+    with pytest.raises(pme.DuplicateKeyError):
+        engine.insert_one(TEST_DB, TEST_COLLECT, doc)
+
+
+def test_update_and_delete(engine):
+    result = engine.update_many(TEST_DB, TEST_COLLECT, {AGE: {'$lt': 22}},
+                                {'$inc': {AGE: 1}})
+    assert result.matched_count == 2
+    assert result.modified_count == 2
+    result = engine.delete_one(TEST_DB, TEST_COLLECT, {AGE: 22})
+    assert result.deleted_count == 1
+    result = engine.delete_many(TEST_DB, TEST_COLLECT, {})
+    assert result.deleted_count == 2
+
+
+def test_unique_index(engine):
+    spec = {base.INDEX_NAME: 'name_1', base.INDEX_KEYS: [(NAME, 1)],
+            base.INDEX_UNIQUE: True}
+    engine.create_indexes(TEST_DB, TEST_COLLECT, [spec])
+    assert 'name_1' in engine.index_names(TEST_DB, TEST_COLLECT)
+    with pytest.raises(pme.DuplicateKeyError):
+        engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'ann'})
+    with pytest.raises(pme.DuplicateKeyError):
+        engine.update_one(TEST_DB, TEST_COLLECT, {NAME: 'bob'},
+                          {'$set': {NAME: 'ann'}})
+    assert engine.find(TEST_DB, TEST_COLLECT, {NAME: 'bob'}) != []
+    engine.drop_index(TEST_DB, TEST_COLLECT, 'name_1')
+    engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'ann'})
+
+
+def test_index_options_conflict(engine):
+    spec = {base.INDEX_NAME: 'name_1', base.INDEX_KEYS: [(NAME, 1)],
+            base.INDEX_UNIQUE: False}
+    engine.create_indexes(TEST_DB, TEST_COLLECT, [spec])
+    engine.create_indexes(TEST_DB, TEST_COLLECT, [spec])
+    with pytest.raises(pme.OperationFailure) as err:
+        engine.create_indexes(TEST_DB, TEST_COLLECT,
+                              [{**spec, base.INDEX_UNIQUE: True}])
+    assert err.value.code == 85
+
+
+def test_case_insensitive_lookup(engine):
+    spec = {base.INDEX_NAME: 'name_1', base.INDEX_KEYS: [(NAME, 1)],
+            base.INDEX_UNIQUE: False}
+    engine.create_indexes(TEST_DB, TEST_COLLECT, [spec])
+    docs = engine.find(TEST_DB, TEST_COLLECT,
+                       {NAME: {'$regex': '^BOB$', '$options': 'i'}})
+    assert [doc[NAME] for doc in docs] == ['bob']
+    docs = engine.find(TEST_DB, TEST_COLLECT,
+                       {NAME: {'$in': [qry.compile_regex('^C.T$', 'i')]}})
+    assert [doc[NAME] for doc in docs] == ['cat']
+
+
+def test_text_search(engine):
+    spec = {base.INDEX_NAME: 'name_text', base.INDEX_KEYS: [(NAME, 'text')],
+            base.INDEX_UNIQUE: False}
+    engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'Ann Lee', AGE: 40})
+    with pytest.raises(pme.OperationFailure):
+        engine.find(TEST_DB, TEST_COLLECT, {'$text': {'$search': 'ann'}})
+    engine.create_indexes(TEST_DB, TEST_COLLECT, [spec])
+    engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'Lee Bob', AGE: 50})
+    docs = engine.find(TEST_DB, TEST_COLLECT, {'$text': {'$search': 'ANN'},
+                                               AGE: {'$gt': 20}})
+    assert [doc[NAME] for doc in docs] == ['Ann Lee']
+    engine.delete_one(TEST_DB, TEST_COLLECT, {NAME: 'Ann Lee'})
+    docs = engine.find(TEST_DB, TEST_COLLECT, {'$text': {'$search': 'lee'}})
+    assert [doc[NAME] for doc in docs] == ['Lee Bob']
+
+
+def test_explain(engine):
+    plan = engine.explain(TEST_DB, TEST_COLLECT, {NAME: 'bob'})
+    assert plan[base.STAGE] == base.COLLSCAN
+    assert plan[base.DOCS_EXAMINED] == 3
+    assert plan[base.RETURNED] == 1
+    spec = {base.INDEX_NAME: 'name_1', base.INDEX_KEYS: [(NAME, 1)],
+            base.INDEX_UNIQUE: False}
+    engine.create_indexes(TEST_DB, TEST_COLLECT, [spec])
+    plan = engine.explain(TEST_DB, TEST_COLLECT, {NAME: 'bob'}, [(NAME, 1)])
+    assert plan[base.STAGE] == base.IXSCAN
+    assert plan[base.DOCS_EXAMINED] == 1
+    assert not plan[base.IN_MEMORY_SORT]
+    plan = engine.explain(TEST_DB, TEST_COLLECT, {NAME: 'bob'}, [(AGE, 1)])
+    assert plan[base.IN_MEMORY_SORT]
+
+
+def test_array_fields(engine):
+    engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: ['dan', 'eve']})
+    docs = engine.find(TEST_DB, TEST_COLLECT, {NAME: 'eve'})
+    assert [doc[NAME] for doc in docs] == [['dan', 'eve']]
+
+
+def test_memory_index_natural_order():
+    engine = memory.MemoryEngine()
+    spec = {base.INDEX_NAME: 'age_1', base.INDEX_KEYS: [(AGE, 1)],
+            base.INDEX_UNIQUE: False}
+    engine.create_indexes(TEST_DB, TEST_COLLECT, [spec])
+    for name in ['eve', 'dan', 'cat', 'bob']:
+        engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: name, AGE: 30})
+    engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'ann', AGE: 40})
+    engine.delete_one(TEST_DB, TEST_COLLECT, {NAME: 'dan'})
+    engine.update_one(TEST_DB, TEST_COLLECT, {NAME: 'eve'},
+                      {'$set': {AGE: 40}})
+    engine.update_one(TEST_DB, TEST_COLLECT, {NAME: 'eve'},
+                      {'$set': {AGE: 30}})
+    engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'dan', AGE: 30})
+    coll = engine._collection(TEST_DB, TEST_COLLECT)
+    index, doc_ids = coll.plan({AGE: 30})
+    assert index == 'age_1'
+    assert [coll.docs[doc_id][NAME] for doc_id in doc_ids] == [
+        'eve', 'cat', 'bob', 'dan']
+    docs = engine.find(TEST_DB, TEST_COLLECT, {AGE: 30})
+    assert [doc[NAME] for doc in docs] == ['eve', 'cat', 'bob', 'dan']
+
+
+def test_sqlite_persists(tmp_path):
+    path = str(tmp_path / 'test.sqlite3')
+    engine = sqlite.SqliteEngine(path)
+    engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'ann'})
+    engine.close()
+    engine = sqlite.SqliteEngine(path)
+    assert engine.find(TEST_DB, TEST_COLLECT, {}, {'_id': 0}) == [
+        {NAME: 'ann'}]
+    engine.close()
+
+
+def test_bulk_write(engine):
+    ops = [
+        {base.OP: base.INSERT, base.DOC: {'_id': 1}},
+        {base.OP: base.INSERT, base.DOC: {'_id': 1}},
+        {base.OP: base.UPDATE, base.FILTER: {NAME: 'ann'},
+         base.DOC: {'$set': {AGE: 30}}},
+        {base.OP: base.DELETE, base.FILTER: {NAME: 'bob'}},
+    ]
+    details = engine.bulk_write(TEST_DB, TEST_COLLECT, ops, ordered=False)
+    assert details['nInserted'] == 1
+    assert details['nModified'] == 1
+    assert details['nRemoved'] == 1
+    assert [error['index'] for error in details['writeErrors']] == [1]
+    details = engine.bulk_write(TEST_DB, TEST_COLLECT, ops[1:])
+    assert details['nModified'] == 0
+    assert len(details['writeErrors']) == 1
+
+
+def test_hash_ring():
+    ring = sharded.HashRing(['a', 'b', 'c'])
+    owners = {key: ring.node(key) for key in range(3000)}
+    counts = [list(owners.values()).count(name) for name in 'abc']
+    assert min(counts) > 500
+    bigger = sharded.HashRing(['a', 'b', 'c', 'd'])
+    moved = sum(bigger.node(key) != owner for key, owner in owners.items())
+    assert moved < 1500
+
+
+@pytest.fixture(scope='function')
+def shards():
+    shards = {name: memory.MemoryEngine() for name in ['a', 'b', 'c']}
+    engine = sharded.ShardedEngine(shards, {(TEST_DB, TEST_COLLECT): NAME})
+    for i, name in enumerate(['ann', 'bob', 'cat', 'dan', 'eve']):
+        engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: name, AGE: 20 + i})
+    return engine
+
+
+def test_sharded_routing(shards):
+    for name in ['ann', 'bob']:
+        owner = shards.shards[shards.shard_for(name)]
+        assert owner.find(TEST_DB, TEST_COLLECT, {NAME: name}) != []
+        others = [shard for shard in shards.shards.values()
+                  if shard is not owner]
+        assert all(shard.find(TEST_DB, TEST_COLLECT, {NAME: name}) == []
+                   for shard in others)
+    with pytest.raises(ValueError):
+        shards.update_one(TEST_DB, TEST_COLLECT, {NAME: 'ann'},
+                          {'$set': {NAME: 'amy'}})
+
+
+def test_sharded_fan_out(shards):
+    docs = list(shards.find(TEST_DB, TEST_COLLECT, {AGE: {'$gt': 20}},
+                            {NAME: 1, '_id': 0}, sort=[(AGE, -1)],
+                            limit=2, skip=1))
+    assert docs == [{NAME: 'dan'}, {NAME: 'cat'}]
+    assert len(list(shards.find(TEST_DB, TEST_COLLECT, {}))) == 5
+    result = shards.update_many(TEST_DB, TEST_COLLECT, {},
+                                {'$inc': {AGE: 1}})
+    assert result.modified_count == 5
+    result = shards.delete_one(TEST_DB, TEST_COLLECT, {AGE: 25})
+    assert result.deleted_count == 1
+
+
+def test_sharded_bulk_write(shards):
+    ops = [
+        {base.OP: base.INSERT, base.DOC: {'_id': 1, NAME: 'fay'}},
+        {base.OP: base.INSERT, base.DOC: {'_id': 1, NAME: 'fay'}},
+        {base.OP: base.UPDATE, base.FILTER: {AGE: 20},
+         base.DOC: {'$set': {AGE: 30}}},
+        {base.OP: base.DELETE, base.FILTER: {NAME: 'bob'}},
+    ]
+    details = shards.bulk_write(TEST_DB, TEST_COLLECT, ops, ordered=False)
+    assert details['nInserted'] == 1
+    assert details['nModified'] == 1
+    assert details['nRemoved'] == 1
+    assert [error['index'] for error in details['writeErrors']] == [1]
+
+
+def test_async_sharded_engine(shards):
+    engine = sharded.AsyncShardedEngine(
+        {name: base.AsyncAdapter(shard)
+         for name, shard in shards.shards.items()}, shards.shard_keys)
+
+    async def read():
+        docs = [doc async for doc in engine.find(
+            TEST_DB, TEST_COLLECT, {}, [NAME], sort=[(AGE, 1)], limit=2)]
+        result = await engine.delete_many(TEST_DB, TEST_COLLECT, {})
+        return docs, result.deleted_count
+    docs, deleted = asyncio.run(read())
+    assert [doc[NAME] for doc in docs] == ['ann', 'bob']
+    assert deleted == 5
+
+
+def test_thread_adapter(engine):
+    threads = []
+
+    class Recording:
+        name = engine.name
+
+        def __getattr__(self, attr):
+            method = getattr(engine, attr)
+
+            def call(*args, **kwargs):
+                threads.append(threading.get_ident())
+                return method(*args, **kwargs)
+            return call
+
+    adapter = base.ThreadAdapter(Recording())
+
+    async def read():
+        docs = [doc async for doc in adapter.find(
+            TEST_DB, TEST_COLLECT, {}, [NAME], sort=[(AGE, 1)])]
+        await adapter.delete_one(TEST_DB, TEST_COLLECT, {NAME: 'ann'})
+        return docs
+    docs = asyncio.run(read())
+    assert [doc[NAME] for doc in docs] == ['ann', 'bob', 'cat']
+    assert len(engine.find(TEST_DB, TEST_COLLECT)) == 2
+    assert len(threads) == 2
+    assert threading.get_ident() not in threads
+
+
+class CountingEngine(memory.MemoryEngine):
+    """
+    A memory engine that counts the ops on TEST_COLLECT.
+    """
+    def __init__(self):
+        super().__init__()
+        self.ops = 0
+
+    def _count(self, collection):
+        if collection == TEST_COLLECT:
+            self.ops += 1
+
+    def find(self, db, collection, *args, **kwargs):
+        self._count(collection)
+        return super().find(db, collection, *args, **kwargs)
+
+    def update_one(self, db, collection, filt, update):
+        self._count(collection)
+        return super().update_one(db, collection, filt, update)
+
+    def delete_many(self, db, collection, filt):
+        self._count(collection)
+        return super().delete_many(db, collection, filt)
+
+
+def test_sharded_id_routing():
+    shards = {name: CountingEngine() for name in ['a', 'b', 'c']}
+    engine = sharded.ShardedEngine(shards, {(TEST_DB, TEST_COLLECT): NAME},
+                                   id_keys={(TEST_DB, TEST_COLLECT): ID})
+    engine.create_indexes(TEST_DB, TEST_COLLECT, [])
+    for i, name in enumerate(['ann', 'bob', 'cat', 'dan', 'eve']):
+        engine.insert_one(TEST_DB, TEST_COLLECT, {ID: i, NAME: name})
+    engine.owners.clear()
+    assert [doc[NAME] for doc in engine.find(TEST_DB, TEST_COLLECT,
+                                             {ID: 3})] == ['dan']
+    engine.update_one(TEST_DB, TEST_COLLECT, {ID: 3}, {'$set': {AGE: 1}})
+    engine.delete_one(TEST_DB, TEST_COLLECT, {ID: 3})
+    # find; update; find and delete:
+    assert sum(shard.ops for shard in shards.values()) == 4
+    assert all(shard.find(TEST_DB, sharded.LOCATIONS_COLLECT,
+                          {sharded.KEY: f'{TEST_COLLECT}:3'}) == []
+               for shard in shards.values())
+    with pytest.raises(pme.DuplicateKeyError):
+        engine.insert_one(TEST_DB, TEST_COLLECT, {ID: 1, NAME: 'fay'})
+
+
+def test_sharded_owner_cache_threads(monkeypatch):
+    monkeypatch.setattr(sharded, 'OWNER_CACHE_SIZE', 4)
+    engine = sharded.ShardedEngine(
+        {name: memory.MemoryEngine() for name in ['a', 'b']},
+        {(TEST_DB, TEST_COLLECT): NAME},
+        id_keys={(TEST_DB, TEST_COLLECT): ID})
+    errors = []
+
+    def churn(offset):
+        try:
+            for i in range(3000):
+                _id = (i + offset) % 8
+                key = f'{TEST_COLLECT}:{_id}'
+                engine._remember(key, 'ann')
+                engine._owned_by(TEST_DB, TEST_COLLECT, {ID: _id})
+                engine._forget([(None, sharded.LOCATIONS_COLLECT,
+                                 {sharded.KEY: key}, None)])
+        except Exception as err:
+            errors.append(err)
+    threads = [threading.Thread(target=churn, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(engine.owners) <= sharded.OWNER_CACHE_SIZE
+
+
+def test_sharded_unique_across_shards():
+    shards = {name: memory.MemoryEngine() for name in ['a', 'b', 'c']}
+    engine = sharded.ShardedEngine(shards, {(TEST_DB, TEST_COLLECT): NAME})
+    engine.create_indexes(TEST_DB, TEST_COLLECT, [
+        {base.INDEX_NAME: 'email_1', base.INDEX_KEYS: [(EMAIL, 1)],
+         base.INDEX_UNIQUE: True}])
+    names = ['ann', 'bob', 'cat', 'dan', 'eve']
+    assert len({engine.shard_for(name) for name in names}) > 1
+    for name in names:
+        engine.insert_one(TEST_DB, TEST_COLLECT,
+                          {NAME: name, EMAIL: f'{name}@x.com'})
+    for name in names[1:]:
+        with pytest.raises(pme.DuplicateKeyError) as err:
+            engine.insert_one(TEST_DB, TEST_COLLECT,
+                              {NAME: name, EMAIL: 'ann@x.com'})
+        assert err.value.details['keyValue'] == {EMAIL: 'ann@x.com'}
+        with pytest.raises(pme.DuplicateKeyError):
+            engine.update_one(TEST_DB, TEST_COLLECT, {NAME: name},
+                              {'$set': {EMAIL: 'ann@x.com'}})
+    with pytest.raises(ValueError):
+        engine.update_many(TEST_DB, TEST_COLLECT, {},
+                           {'$set': {EMAIL: 'x@x.com'}})
+    engine.update_one(TEST_DB, TEST_COLLECT, {NAME: 'ann'},
+                      {'$set': {EMAIL: 'amy@x.com'}})
+    engine.delete_one(TEST_DB, TEST_COLLECT, {NAME: 'bob'})
+    engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'fay',
+                                              EMAIL: 'ann@x.com'})
+    engine.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'gus',
+                                              EMAIL: 'bob@x.com'})
+    ops = [{base.OP: base.INSERT, base.DOC: {NAME: 'hal',
+                                             EMAIL: 'cat@x.com'}}]
+    details = engine.bulk_write(TEST_DB, TEST_COLLECT, ops)
+    assert details['writeErrors'][0]['code'] == sharded.DUPLICATE_KEY
+
+    async def insert():
+        adapted = sharded.AsyncShardedEngine(
+            {name: base.AsyncAdapter(shard)
+             for name, shard in shards.items()}, engine.shard_keys,
+            index_specs=engine.index_specs)
+        await adapted.insert_one(TEST_DB, TEST_COLLECT,
+                                 {NAME: 'ivy', EMAIL: 'dan@x.com'})
+    with pytest.raises(pme.DuplicateKeyError):
+        asyncio.run(insert())
+
+
+class FakeSession:
+    def __init__(self, operation_time=None, cluster_time=None):
+        self.operation_time = operation_time
+        self.cluster_time = cluster_time
+
+    def advance_operation_time(self, operation_time):
+        self.operation_time = max(self.operation_time or 0, operation_time)
+
+    def advance_cluster_time(self, cluster_time):
+        self.cluster_time = cluster_time
+
+
+class FakeClient:
+    """
+    A client whose writes all happen at time.
+    """
+    def __init__(self, time):
+        self.time = time
+
+    def start_session(self, causal_consistency=False):
+        return contextlib.nullcontext(
+            FakeSession(self.time, {'clusterTime': self.time}))
+
+    def __getitem__(self, name):
+        return self
+
+    def insert_one(self, doc, session=None):
+        return None
+
+
+def test_causal_clock_per_deployment():
+    shard_a = mongo.MongoEngine(FakeClient(5), mongo.clock_for('test-a'))
+    shard_b = mongo.MongoEngine(FakeClient(1), mongo.clock_for('test-b'))
+    shard_a.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'ann'})
+    shard_b.insert_one(TEST_DB, TEST_COLLECT, {NAME: 'bob'})
+    session = FakeSession()
+    shard_b.clock.advance(session)
+    # b's reads wait for b's write, not for a's later cluster time.
+    assert session.operation_time == 1
+    assert session.cluster_time == {'clusterTime': 1}
+    assert mongo.clock_for('test-a') is shard_a.clock
+    assert mongo.MongoEngine(FakeClient(1)).clock is not shard_a.clock
+
+
+def test_causal_clock():
+    clock = mongo._CausalClock()
+    clock.note(FakeSession(2, {'clusterTime': 2}))
+    clock.note(FakeSession(1, {'clusterTime': 1}))
+    clock.note(FakeSession())
+    session = FakeSession()
+    clock.advance(session)
+    assert session.operation_time == 2
+    assert session.cluster_time == {'clusterTime': 2}
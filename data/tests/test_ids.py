@@ -0,0 +1,96 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import data.db_connect as dbc
+import data.ids as ids
+
+TEST_SEQUENCE = 'test_ids'
+BLOCK_SIZE = 5
+
+
+@pytest.fixture(scope='function')
+def sequence():
+    dbc.connect_db()
+    yield TEST_SEQUENCE
+    dbc.delete_many(ids.SEQUENCES_COLLECT, {ids.NAME: TEST_SEQUENCE})
+
+
+def test_new_id():
+    _id = ids.new_id()
+    assert len(_id) == ids.ID_LEN
+    assert _id.isdigit()
+
+
+def test_time_ids_sort_in_order():
+    generator = ids.TimeIds()
+    made = generator.new_ids(ids.MAX_COUNTER * 2)
+    made += generator.new_ids(1)
+    assert len(set(made)) == len(made)
+    assert made == sorted(made)
+
+
+def test_time_ids_across_threads():
+    generator = ids.TimeIds()
+    made = []
+
+    def make():
+        for _ in range(200):
+            made.append(generator.new_ids(1)[0])
+
+    threads = [threading.Thread(target=make) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(made)) == len(made)
+
+
+def test_time_ids_per_worker():
+    now = ids.TimeIds(worker=1).new_ids(1)[0]
+    other = ids.TimeIds(worker=2).new_ids(1)[0]
+    assert now != other
+
+
+def test_workers_claimed(monkeypatch):
+    monkeypatch.delenv('ID_WORKER', raising=False)
+    assert ids.TimeIds().worker != ids.TimeIds().worker
+
+
+def test_worker_after_fork(monkeypatch):
+    monkeypatch.setenv('ID_WORKER', '7')
+    assert ids.TimeIds().worker == 7
+    # A forked child must not share its parent's ID_WORKER.
+    monkeypatch.setattr(ids, 'forked', True)
+    workers = {ids.TimeIds().worker for _ in range(3)}
+    assert len(workers) == 3
+
+
+def test_first_id_at():
+    start = datetime.now(timezone.utc)
+    _id = ids.TimeIds().new_ids(1)[0]
+    assert ids.first_id_at(start - timedelta(seconds=1)) <= _id
+    assert _id < ids.first_id_at(start + timedelta(seconds=1))
+
+
+def test_sequence_ids(sequence):
+    first = ids.SequenceIds(sequence, BLOCK_SIZE)
+    second = ids.SequenceIds(sequence, BLOCK_SIZE)
+    made = first.new_ids(2) + second.new_ids(1) + first.new_ids(4)
+    assert made[:3] == [ids._format(value) for value in [0, 1, 5]]
+    # The first block only had 3 left, so a new one was claimed.
+    assert made[3:] == [ids._format(value) for value in range(10, 14)]
+
+
+def test_sequence_ids_bulk(sequence):
+    generator = ids.SequenceIds(sequence, BLOCK_SIZE)
+    made = generator.new_ids(BLOCK_SIZE * 3)
+    assert made == sorted(set(made))
+    assert generator.new_ids(1) == [ids._format(BLOCK_SIZE * 3)]
+
+
+def test_use_generator(sequence):
+    old = ids.use_generator(ids.SequenceIds(sequence, BLOCK_SIZE))
+    assert ids.new_ids(2) == [ids._format(0), ids._format(1)]
+    ids.use_generator(old)
@@ -1,12 +1,12 @@
+import threading
+
 import pytest
 import data.journals as jrnls
 import data.users as usrs
 import data.categories as ctgs
+import data.db_connect as dbc
 
-from datetime import datetime
-
-
-FORMAT = "%Y-%m-%d %H:%M:%S"
+from datetime import datetime, timedelta
 
 
 @pytest.fixture(scope='module')
@@ -58,8 +58,7 @@ def temp_journal(temp_category):
 
 def test_get_test_timestamp():
     timestamp = jrnls._get_test_timestamp()
-    assert isinstance(timestamp, str)
-    assert isinstance(datetime.strptime(timestamp, FORMAT), datetime)
+    assert isinstance(timestamp, datetime)
 
 
 def test_get_journal_id():
@@ -121,11 +120,11 @@ def test_get_modified(temp_journal):
         - get_journals() returns a dict with at least 1 journal
         - each journal key is a valid journal_id (str)
         - each journal is a dict with the following members:
-            - TIMESTAMP (str/valid timestamp)
+            - TIMESTAMP (datetime)
             - TITLE (str)
             - PROMPT (str)
             - CONTENT (str)
-            - MODIFIED (str/valid timestamp)
+            - MODIFIED (datetime)
 """
 def test_get_journals(temp_journal):
     journals = jrnls.get_journals()
@@ -147,15 +146,13 @@ def test_get_journals(temp_journal):
 
         assert journal[jrnls.JOURNAL_ID] == key
 
-        assert isinstance(jrnls.get_timestamp(journal), str)
+        assert isinstance(jrnls.get_timestamp(journal), datetime)
         assert isinstance(jrnls.get_title(journal), str)
         assert isinstance(jrnls.get_prompt(journal), str)
         assert isinstance(jrnls.get_content(journal), str)
-        assert isinstance(jrnls.get_modified(journal), str)
+        assert isinstance(jrnls.get_modified(journal), datetime)
 
-        assert isinstance(datetime.strptime(journal[jrnls.TIMESTAMP], FORMAT), datetime)
-        assert isinstance(datetime.strptime(journal[jrnls.MODIFIED], FORMAT), datetime)
-        assert datetime.strptime(journal[jrnls.TIMESTAMP], FORMAT) <= datetime.strptime(journal[jrnls.MODIFIED], FORMAT)
+        assert jrnls.get_timestamp(journal) <= jrnls.get_modified(journal)
         
     assert jrnls.exists(temp_journal)
 
@@ -238,8 +235,11 @@ def test_add_dup_journal_id(temp_journal):
     category_id = jrnls.get_category(jrnls.get_journal(journal_id))
         
     # attempting to add journal again
-    with pytest.raises(ValueError):
+    with pytest.raises(ValueError, match='Duplicate journal'):
         jrnls.add_journal(journal_id, ADD_TITLE, ADD_PROMPT1, ADD_CONTENT, user_id, category_id)
+    # The category still counts the journal once.
+    category = ctgs.get_category(category_id)
+    assert ctgs.get_journal_count(category) == 1
 
 
 def test_add_journal_without_title_or_content(temp_user, temp_category):
@@ -367,6 +367,63 @@ def test_update_journal_partially(temp_journal):
     assert jrnls.get_category(updated_journal) == prev_category
 
 
+def test_update_journal_move_category(temp_user, temp_journal):
+    journal_id = temp_journal
+    prev_category = jrnls.get_category(jrnls.get_journal(journal_id))
+    new_category = ctgs._get_category_id()
+    ctgs.add_category(new_category, ctgs._get_category_name(), temp_user)
+    update_data = {jrnls.TITLE: UPDATED_TITLE, jrnls.CATEGORY: new_category}
+    assert jrnls.update_journal(journal_id, update_data)
+    assert ctgs.get_journal_count(ctgs.get_category(prev_category)) == 0
+    moved_to = ctgs.get_category(new_category)
+    assert ctgs.get_journal_count(moved_to) == 1
+    assert ctgs.get_last_modified(moved_to) \
+        == jrnls.get_modified(jrnls.get_journal(journal_id))
+    moved = jrnls.get_category_journals(new_category)
+    assert list(moved) == [journal_id]
+    assert jrnls.get_title(moved[journal_id]) == UPDATED_TITLE
+    # Moving it to where it already is changes no count.
+    assert jrnls.update_journal(journal_id, {jrnls.CATEGORY: new_category})
+    assert ctgs.get_journal_count(ctgs.get_category(new_category)) == 1
+    jrnls.del_journal(journal_id)
+    assert ctgs.get_journal_count(ctgs.get_category(new_category)) == 0
+    ctgs.del_category(new_category)
+
+
+def test_move_filter(temp_journal):
+    prev_category = jrnls.get_category(jrnls.get_journal(temp_journal))
+    # A journal another request has moved already does not match.
+    result = dbc.update_doc(jrnls.JOURNALS_COLLECT,
+                            jrnls._move_filter(temp_journal, "elsewhere"),
+                            {jrnls.TITLE: UPDATED_TITLE})
+    assert not result.matched_count
+    result = dbc.update_doc(jrnls.JOURNALS_COLLECT,
+                            jrnls._move_filter(temp_journal, prev_category),
+                            {jrnls.TITLE: UPDATED_TITLE})
+    assert result.matched_count
+
+
+def test_add_journals_to_one_category_at_once(temp_user, temp_category):
+    journal_ids = [jrnls._get_journal_id() for _ in range(8)]
+
+    def add(journal_id):
+        jrnls.add_journal(journal_id, journal_id, f"Prompt {journal_id}",
+                          "Content", temp_user, temp_category)
+
+    threads = [threading.Thread(target=add, args=(journal_id,))
+               for journal_id in journal_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Every add was counted.
+    category = ctgs.get_category(temp_category)
+    assert ctgs.get_journal_count(category) == len(journal_ids)
+    for journal_id in journal_ids:
+        jrnls.del_journal(journal_id)
+    assert ctgs.get_journal_count(ctgs.get_category(temp_category)) == 0
+
+
 def test_update_journal_nonexistent_journal():
     journal_id = jrnls._get_journal_id()
     update_data = {jrnls.TITLE: UPDATED_TITLE, jrnls.PROMPT: UPDATED_PROMPT, jrnls.CONTENT: UPDATED_CONTENT}
@@ -387,3 +444,81 @@ def test_update_journal_nothing_to_update(temp_journal):
     update_data = {}
     with pytest.raises(ValueError):
         jrnls.update_journal(journal_id, update_data)
+
+
+def test_get_journals_summary(temp_journal):
+    journals = jrnls.get_journals(jrnls.SUMMARY_FIELDS)
+    journal = journals[temp_journal]
+    assert set(journal) == set(jrnls.SUMMARY_FIELDS)
+    assert jrnls.CONTENT not in journal
+
+
+def test_iter_user_journals(temp_user, temp_journal):
+    journal_ids = [journal[jrnls.JOURNAL_ID]
+                   for journal in jrnls.iter_user_journals(temp_user)]
+    assert journal_ids == [temp_journal]
+
+
+def test_search_journals(temp_user, temp_journal):
+    found = jrnls.search_journals("FIXTURE", temp_user)
+    assert temp_journal in found
+    assert jrnls.search_journals("fixtures", temp_user) == {}
+    assert jrnls.search_journals("fixture", "no such user") == {}
+
+
+def test_iter_category_journals(temp_category, temp_journal):
+    journals = list(jrnls.iter_category_journals(temp_category,
+                                                 jrnls.SUMMARY_FIELDS))
+    assert len(journals) == 1
+    assert jrnls.CONTENT not in journals[0]
+
+
+def test_add_journals(temp_user, temp_category):
+    jrnl1_id = jrnls._get_journal_id()
+    jrnl2_id = jrnls._get_journal_id()
+    report = jrnls.add_journals([
+        {jrnls.JOURNAL_ID: jrnl1_id, jrnls.TITLE: "Bulk 1",
+         jrnls.PROMPT: ADD_PROMPT0, jrnls.CONTENT: "", jrnls.USER: temp_user,
+         jrnls.CATEGORY: temp_category},
+        {jrnls.JOURNAL_ID: jrnl2_id, jrnls.TITLE: NON_STRING,
+         jrnls.PROMPT: ADD_PROMPT1, jrnls.CONTENT: "", jrnls.USER: temp_user,
+         jrnls.CATEGORY: temp_category},
+        {jrnls.JOURNAL_ID: jrnl1_id, jrnls.TITLE: "Bulk 1 again",
+         jrnls.PROMPT: ADD_PROMPT1, jrnls.CONTENT: "", jrnls.USER: temp_user,
+         jrnls.CATEGORY: temp_category},
+    ])
+    assert report[dbc.INSERTED] == 1
+    assert [error[dbc.ITEM_INDEX] for error in report[dbc.ERRORS]] == [1, 2]
+    assert jrnls.exists(jrnl1_id)
+    assert not jrnls.exists(jrnl2_id)
+    category = ctgs.get_category(temp_category)
+    assert ctgs.get_journal_count(category) == 1
+    jrnls.del_journal(jrnl1_id)
+
+
+def test_get_user_journals_between(temp_user, temp_category):
+    week_start = datetime(2024, 5, 6)
+    journal_ids = [jrnls._get_journal_id() for _ in range(3)]
+    for days, journal_id in zip([-1, 1, 3], journal_ids):
+        jrnls.add_journal(journal_id, "", ADD_PROMPT0, "", temp_user,
+                          temp_category)
+        dbc.update_doc(jrnls.JOURNALS_COLLECT, {jrnls.JOURNAL_ID: journal_id},
+                       {jrnls.MODIFIED: week_start + timedelta(days=days)})
+    this_week = jrnls.get_user_journals_between(
+        temp_user, week_start, week_start + timedelta(days=7))
+    assert list(this_week) == [journal_ids[2], journal_ids[1]]
+    latest = jrnls.get_user_journals_between(temp_user, limit=1)
+    assert list(latest) == [journal_ids[2]]
+    with pytest.raises(ValueError):
+        jrnls.get_user_journals_between(temp_user, field=jrnls.TITLE)
+    for journal_id in journal_ids:
+        jrnls.del_journal(journal_id)
+
+
+def test_native_dates_update():
+    journal = {jrnls.TIMESTAMP: "2024-05-06 07:08:09",
+               jrnls.MODIFIED: datetime(2024, 5, 7)}
+    assert jrnls._native_dates_update(journal) \
+        == {'$set': {jrnls.TIMESTAMP: datetime(2024, 5, 6, 7, 8, 9)}}
+    assert jrnls._native_dates_update({jrnls.TIMESTAMP: "not a date"}) \
+        is None
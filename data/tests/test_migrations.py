@@ -0,0 +1,88 @@
+import pytest
+
+import data.db_connect as dbc
+import data.migrations as mgr
+
+TEST_COLLECT = 'test_migrations'
+TEST_VERSION = 1000
+KEY = 'key'
+NAME = 'name'
+DOCS = 7
+BATCH_SIZE = 3
+
+
+def _upper_name(doc):
+    if doc[NAME] != doc[NAME].upper():
+        return {'$set': {NAME: doc[NAME].upper()}}
+    return None
+
+
+@pytest.fixture(scope='function')
+def migration(monkeypatch):
+    dbc.connect_db()
+    monkeypatch.setattr(mgr, 'MIGRATION_BATCH_SIZE', BATCH_SIZE)
+    monkeypatch.setattr(mgr, 'migrations', {})
+    mgr.register_migration(TEST_VERSION, 'upper_names', TEST_COLLECT, KEY,
+                           _upper_name)
+    dbc.insert_many(TEST_COLLECT, [{KEY: str(i), NAME: f'name {i}'}
+                                   for i in range(DOCS)])
+    yield mgr.migrations[TEST_VERSION]
+    dbc.delete_many(TEST_COLLECT, {})
+    dbc.delete_many(mgr.MIGRATIONS_COLLECT, {mgr.VERSION: TEST_VERSION})
+
+
+def _names():
+    return sorted(doc[NAME] for doc in dbc.fetch_many(TEST_COLLECT))
+
+
+def test_register_migration_twice():
+    with pytest.raises(ValueError):
+        mgr.register_migration(1, 'another', TEST_COLLECT, KEY, _upper_name)
+
+
+def test_dry_run(migration):
+    [report] = mgr.run(dry_run=True, pause=0)
+    assert report[mgr.STATE] == mgr.DRY_RUN
+    assert report[mgr.CHANGED] == DOCS
+    assert _names() == sorted(f'name {i}' for i in range(DOCS))
+    assert mgr.get_status()[0][mgr.STATE] == mgr.PENDING
+
+
+def test_resume(migration):
+    [report] = mgr.run(max_batches=1, pause=0)
+    assert report[mgr.STATE] == mgr.RUNNING
+    assert report[mgr.SCANNED] == BATCH_SIZE
+    assert report[mgr.LAST_KEY] == str(BATCH_SIZE - 1)
+    assert mgr.get_status() == [report]
+    [report] = mgr.run(pause=0)
+    assert report[mgr.STATE] == mgr.DONE
+    assert report[mgr.SCANNED] == report[mgr.CHANGED] == DOCS
+    assert _names() == sorted(f'NAME {i}' for i in range(DOCS))
+    assert mgr.run(pause=0) == [report]
+
+
+def test_conflict(migration):
+    def race(doc):
+        # The API changes the doc after the migration has read it.
+        if doc[KEY] == '0':
+            dbc.update_doc(TEST_COLLECT, {KEY: '0'}, {NAME: 'new name'})
+        return _upper_name(doc)
+    migration[mgr.TRANSFORM] = race
+    [report] = mgr.run(pause=0)
+    assert report[mgr.CONFLICTS] == 1
+    assert report[mgr.CHANGED] == DOCS - 1
+    assert dbc.fetch_one(TEST_COLLECT, {KEY: '0'})[NAME] == 'new name'
+
+
+def test_batch_guard(migration):
+    def upper_names(docs):
+        # The API changes a field the guard does not check.
+        dbc.update_doc(TEST_COLLECT, {KEY: '0'}, {'count': 1})
+        return [_upper_name(doc) for doc in docs]
+    migration[mgr.TRANSFORM] = upper_names
+    migration[mgr.BATCH] = True
+    migration[mgr.GUARD] = [NAME]
+    [report] = mgr.run(pause=0)
+    assert report[mgr.CONFLICTS] == 0
+    assert report[mgr.CHANGED] == DOCS
+    assert _names() == sorted(f'NAME {i}' for i in range(DOCS))
@@ -0,0 +1,58 @@
+import pytest
+
+import data.db_connect as dbc
+import data.engines.base as base
+import data.query_audit as qa
+
+SHAPE = 'users {"user_id": "?"}'
+
+
+def test_regressions():
+    report = {SHAPE: {base.INDEX: None, base.DOCS_EXAMINED: 20,
+                      base.RETURNED: 1,
+                      qa.FLAGS: [qa.COLLSCAN, qa.EXAMINED_RATIO]}}
+    accepted = {SHAPE: {qa.INDEXES: [],
+                        qa.FLAGS: [qa.COLLSCAN, qa.EXAMINED_RATIO]}}
+    assert qa.regressions(report, accepted) == []
+    accepted[SHAPE][qa.FLAGS] = [qa.COLLSCAN]
+    ret = qa.regressions(report, accepted)
+    assert len(ret) == 1
+    assert qa.EXAMINED_RATIO in ret[0]
+
+
+def test_regressions_index():
+    report = {SHAPE: {base.INDEX: 'email_1', base.DOCS_EXAMINED: 1,
+                      base.RETURNED: 1, qa.FLAGS: []}}
+    accepted = {SHAPE: {qa.INDEXES: ['user_id_1', 'email_1'],
+                        qa.FLAGS: []}}
+    assert qa.regressions(report, accepted) == []
+    accepted[SHAPE][qa.INDEXES] = ['user_id_1']
+    assert 'uses email_1, not user_id_1' in qa.regressions(report,
+                                                            accepted)[0]
+    report[SHAPE][base.INDEX] = None
+    assert 'uses no index' in qa.regressions(report, accepted)[0]
+
+
+def test_regressions_no_baseline():
+    report = {SHAPE: {base.INDEX: 'user_id_1', base.DOCS_EXAMINED: 1,
+                      base.RETURNED: 1, qa.FLAGS: []}}
+    assert qa.regressions(report, {}) == [f'{SHAPE}: not in the baseline']
+
+
+def test_save_plans(tmp_path):
+    path = str(tmp_path / 'plans.json')
+    assert qa.load_plans(path) == {}
+    report = {SHAPE: {base.INDEX: None, qa.FLAGS: [qa.COLLSCAN]}}
+    qa.save_plans(report, dbc.MEMORY_ENGINE, path)
+    assert qa.load_plans(path) == {
+        dbc.MEMORY_ENGINE: {SHAPE: {qa.INDEXES: [],
+                                    qa.FLAGS: [qa.COLLSCAN]}}}
+
+
+def test_no_plan_regressions():
+    accepted = qa.load_plans().get(dbc.engine_name(), {})
+    try:
+        report = qa.audit()
+    except NotImplementedError:
+        pytest.skip('This engine can not explain its queries.')
+    assert qa.regressions(report, accepted) == []
@@ -1,6 +1,8 @@
+import data.db_connect as dbc
 import data.users as usrs
 import pytest
 import random
+import threading
 from datetime import datetime
 
 FORMAT = "%Y-%m-%d"
@@ -158,8 +160,40 @@ def test_add_duplicate_user(temp_user):
     user_id = temp_user
         
     # attempting to add user again
-    with pytest.raises(ValueError):
-        usrs.add_user(user_id, ADD_FIRST_NAME, ADD_LAST_NAME, ADD_DOB, ADD_EMAIL, ADD_PASSWORD)
+    with pytest.raises(ValueError, match='This user is already registered'):
+        usrs.add_user(user_id, ADD_FIRST_NAME, ADD_LAST_NAME, ADD_DOB,
+                      'other' + ADD_EMAIL, ADD_PASSWORD)
+
+
+def test_add_user_normalises_email():
+    user_id = usrs._get_user_id()
+    usrs.add_user(user_id, ADD_FIRST_NAME, ADD_LAST_NAME, ADD_DOB,
+                  ' Mixed.Case@Example.com ', ADD_PASSWORD)
+    assert usrs.get_email(usrs.get_user(user_id)) == 'mixed.case@example.com'
+    assert usrs.get_user('MIXED.CASE@example.com')[usrs.USER_ID] == user_id
+    # The dot is not a wildcard.
+    assert usrs.get_user('mixedxcase@example.com') is None
+    usrs.del_user(user_id)
+
+
+def test_email_filter():
+    # An equality, so the unique email index serves it.
+    assert usrs._email_filter(' A@B.com ') == {usrs.EMAIL: 'a@b.com'}
+
+
+def test_normalise_email_update():
+    assert usrs._normalise_email_update({usrs.EMAIL: 'A@B.com'}) \
+        == {'$set': {usrs.EMAIL: 'a@b.com'}}
+    assert usrs._normalise_email_update({usrs.EMAIL: 'a@b.com'}) is None
+
+
+def test_normalise_email_updates_case_duplicates(temp_user):
+    taken = usrs.get_email(usrs.get_user(temp_user))
+    users = [{usrs.USER_ID: '1', usrs.EMAIL: 'Dup@X.com'},
+             {usrs.USER_ID: '2', usrs.EMAIL: 'dup@X.COM'},
+             {usrs.USER_ID: '3', usrs.EMAIL: taken.upper()}]
+    assert usrs._normalise_email_updates(users) == [
+        {'$set': {usrs.EMAIL: 'dup@x.com'}}, None, None]
 
 
 def test_add_user_with_duplicate_email(temp_user):
@@ -168,8 +202,32 @@ def test_add_user_with_duplicate_email(temp_user):
     user_id = usrs._get_user_id()
 
     # attempting to add user again
-    with pytest.raises(ValueError):
-        usrs.add_user(user_id, ADD_FIRST_NAME, ADD_LAST_NAME, ADD_DOB, email, ADD_PASSWORD)
+    with pytest.raises(ValueError, match='under this email'):
+        usrs.add_user(user_id, ADD_FIRST_NAME, ADD_LAST_NAME, ADD_DOB,
+                      email.upper(), ADD_PASSWORD)
+
+
+def test_add_user_with_same_email_at_once():
+    user_ids = [usrs._get_user_id() for _ in range(4)]
+    errors = []
+
+    def add(user_id):
+        try:
+            usrs.add_user(user_id, ADD_FIRST_NAME, ADD_LAST_NAME, ADD_DOB,
+                          ADD_EMAIL, ADD_PASSWORD)
+        except ValueError as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=add, args=(user_id,))
+               for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == len(user_ids) - 1
+    for user_id in user_ids:
+        if usrs.exists(user_id):
+            usrs.del_user(user_id)
 
 
 def test_add_user_invalid_id_length():
@@ -177,6 +235,16 @@ def test_add_user_invalid_id_length():
         usrs.add_user("1", ADD_FIRST_NAME, ADD_LAST_NAME, ADD_DOB, ADD_EMAIL, ADD_PASSWORD)
 
 
+def test_add_user_legacy_id_length():
+    user_id = '1234567890'
+    if usrs.exists(user_id):
+        usrs.del_user(user_id)
+    usrs.add_user(user_id, ADD_FIRST_NAME, ADD_LAST_NAME, ADD_DOB,
+                  ADD_EMAIL, ADD_PASSWORD)
+    assert usrs.exists(user_id)
+    usrs.del_user(user_id)
+
+
 def test_add_user_short_first_name():
     with pytest.raises(ValueError):
         usrs.add_user(usrs._get_user_id(), "J", ADD_LAST_NAME, ADD_DOB, ADD_EMAIL, ADD_PASSWORD)
@@ -246,7 +314,7 @@ def test_update_user(temp_user):
     assert usrs.get_first_name(updated_user) == UPDATED_FIRST_NAME
     assert usrs.get_last_name(updated_user) == UPDATED_LAST_NAME
     assert usrs.get_dob(updated_user) == UPDATED_DOB
-    assert usrs.get_email(updated_user) == UPDATED_EMAIL
+    assert usrs.get_email(updated_user) == UPDATED_EMAIL.lower()
     assert usrs.get_password(updated_user) == UPDATED_PASSWORD
 
 
@@ -277,8 +345,43 @@ def test_update_user_nonexistent_user():
         usrs.update_user(user_id, update_data)
 
 
+def test_update_user_to_taken_email(temp_user):
+    user_id = usrs._get_user_id()
+    usrs.add_user(user_id, ADD_FIRST_NAME, ADD_LAST_NAME, ADD_DOB,
+                  UPDATED_EMAIL, ADD_PASSWORD)
+    with pytest.raises(ValueError, match='under this email'):
+        usrs.update_user(temp_user, {usrs.EMAIL: UPDATED_EMAIL})
+    usrs.del_user(user_id)
+
+
 def test_update_user_nothing_to_update(temp_user):
     user_id = temp_user
     update_data = {}
     with pytest.raises(ValueError):
         usrs.update_user(user_id, update_data)
+
+
+def test_get_users_summary(temp_user):
+    users = usrs.get_users(usrs.SUMMARY_FIELDS)
+    user = users[temp_user]
+    assert set(user) == set(usrs.SUMMARY_FIELDS)
+    assert usrs.PASSWORD not in user
+
+
+def test_iter_users(temp_user):
+    user_ids = [user[usrs.USER_ID] for user in usrs.iter_users([usrs.USER_ID])]
+    assert temp_user in user_ids
+
+
+def test_add_users():
+    good = usrs.get_test_user()
+    good[usrs.EMAIL] = "bulkemail@gmail.com"
+    bad = usrs.get_test_user()
+    bad[usrs.FIRST_NAME] = "J"
+    dup = dict(good, **{usrs.USER_ID: usrs._get_user_id()})
+    report = usrs.add_users([good, bad, dup])
+    assert report[dbc.INSERTED] == 1
+    assert [error[dbc.ITEM_INDEX] for error in report[dbc.ERRORS]] == [1, 2]
+    assert usrs.exists(good[usrs.USER_ID])
+    assert not usrs.exists(bad[usrs.USER_ID])
+    usrs.del_user(good[usrs.USER_ID])
@@ -1,11 +1,14 @@
 """
 This module interfaces to our user data.
 """
+import logging
 import re
 import data.db_connect as dbc
-import random
+import data.ids as ids
+import data.migrations as mgr
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
 
 USERS_COLLECT = 'users'
 USER_ID = 'user_id'
@@ -17,8 +20,10 @@ PASSWORD = 'password'
 
 FORMAT = "%Y-%m-%d"
 
-USER_ID_LEN = 10
-USER_BIG_NUM = 1000000000
+USER_ID_LEN = ids.ID_LEN
+# Users stored before ids.py keep their 10 digit ids.
+LEGACY_USER_ID_LEN = 10
+USER_ID_LENS = (LEGACY_USER_ID_LEN, USER_ID_LEN)
 
 MOCK_ID = '0' * USER_ID_LEN
 
@@ -27,6 +32,19 @@ MIN_USER_NAME_LEN = 2
 MIN_USER_EMAIL_LEN = 8
 MIN_USER_PSWD_LEN = 8
 
+# Fields for list views; leaves out the password.
+SUMMARY_FIELDS = [USER_ID, FIRST_NAME, LAST_NAME, EMAIL]
+
+# Unique, so the insert itself turns away a user_id or email in use.
+INDEXES = [
+    dbc.index(USER_ID, unique=True),
+    dbc.index(EMAIL, unique=True),
+]
+dbc.register_indexes(USERS_COLLECT, INDEXES)
+dbc.register_shard_key(USERS_COLLECT, USER_ID)
+
+NORMALISE_EMAILS = 1
+
 # users = {
 #     1234567890: {
 #         FIRST_NAME: "Emma",
@@ -39,10 +57,55 @@ MIN_USER_PSWD_LEN = 8
 
 
 def _get_user_id():
-    _id = random.randint(0, USER_BIG_NUM)
-    _id = str(_id)
-    _id = _id.rjust(USER_ID_LEN, '0')
-    return _id
+    return ids.new_id()
+
+
+def normalise_email(email: str) -> str:
+    """
+    Emails are stored trimmed and lowercased.
+    """
+    return email.strip().lower()
+
+
+def _normalise_email_update(user: dict) -> dict:
+    email = user.get(EMAIL)
+    if isinstance(email, str) and email != normalise_email(email):
+        return {'$set': {EMAIL: normalise_email(email)}}
+    return None
+
+
+def _normalise_email_updates(users: list) -> list:
+    """
+    Normalise the emails of a batch of users.
+    The first user to hold an email in its normalised form keeps it; a
+    user whose email only differs from it by case is left as it is and
+    logged, to be merged by hand, as the unique email index would reject
+    the update and stop the migrations.
+    """
+    emails = [normalise_email(user[EMAIL])
+              if isinstance(user.get(EMAIL), str) else None
+              for user in users]
+    held = {user[EMAIL]: user[USER_ID]
+            for user in dbc.fetch_many(USERS_COLLECT,
+                                       {EMAIL: {'$in': list(filter(None,
+                                                                   emails))}},
+                                       [USER_ID, EMAIL])}
+    ret = []
+    for user, email in zip(users, emails):
+        update = _normalise_email_update(user)
+        if email is not None:
+            holder = held.setdefault(email, user[USER_ID])
+            if update and holder != user[USER_ID]:
+                logger.warning('Not normalising the email of user %s: '
+                               'user %s already has %s.', user[USER_ID],
+                               holder, email)
+                update = None
+        ret.append(update)
+    return ret
+
+
+mgr.register_migration(NORMALISE_EMAILS, 'normalise_emails', USERS_COLLECT,
+                       USER_ID, _normalise_email_updates, batch=True)
 
 
 def get_test_user():
@@ -56,19 +119,39 @@ def get_test_user():
     return test_user
 
 
-def get_users() -> dict:
+def get_users(fields: list = None) -> dict:
     dbc.connect_db()
-    return dbc.fetch_all_as_dict(USER_ID, USERS_COLLECT)
+    return dbc.fetch_all_as_dict(USER_ID, USERS_COLLECT, fields=fields,
+                                 read_pref=dbc.LIST_READ_PREF)
 
 
-def add_user(user_id: str, first_name: str, last_name: str,
-             dob: str, email: str, password: str):
+def iter_users(fields: list = None):
+    """
+    Yield every user without loading them all at once.
+    """
+    dbc.connect_db()
+    return dbc.iter_docs(USERS_COLLECT, fields=fields,
+                         read_pref=dbc.LIST_READ_PREF)
+
 
-    if exists(user_id):
-        raise ValueError("This user is already registered.")
+def iter_users_json(fields: list = None):
+    """
+    Yield get_users() as JSON object members, straight from the BSON.
+    """
+    dbc.connect_db()
+    return dbc.iter_json_items(USER_ID, USERS_COLLECT, fields=fields,
+                               read_pref=dbc.LIST_READ_PREF)
 
-    if len(user_id) != USER_ID_LEN:
-        raise ValueError(f'User id must be {USER_ID_LEN} characters.')
+
+def _make_user_entry(user_id: str, first_name: str, last_name: str,
+                     dob: str, email: str, password: str) -> dict:
+    """
+    Validate a new user's fields and build the doc to store.
+    Raises ValueError on the first invalid field.
+    """
+    if len(user_id) not in USER_ID_LENS:
+        raise ValueError(f'User id must be {USER_ID_LEN} characters '
+                         f'(or {LEGACY_USER_ID_LEN} for older users).')
 
     if len(first_name) < MIN_USER_NAME_LEN:
         raise ValueError(f'First name must be at least '
@@ -78,6 +161,7 @@ def add_user(user_id: str, first_name: str, last_name: str,
         raise ValueError(f'Last name must be at least '
                          f'{MIN_USER_NAME_LEN} characters.')
 
+    email = normalise_email(email)
     if not re.match(r"[^@]+@[^@]+\.[^@]+", email):
         raise ValueError('Invalid email address.')
 
@@ -96,17 +180,6 @@ def add_user(user_id: str, first_name: str, last_name: str,
         raise ValueError(f'Email must be at least '
                          f'{MIN_USER_EMAIL_LEN} characters.')
 
-    lowercase_email = email.lower()
-
-    # Check for duplicate Email
-    existing_email = dbc.fetch_one(USERS_COLLECT, {EMAIL:
-                                                   {'$regex':
-                                                    f'^{lowercase_email}$',
-                                                    '$options': 'i'}})
-
-    if existing_email:
-        raise ValueError("A user is already registered under this email.")
-
     if len(password) < MIN_USER_PSWD_LEN:
         raise ValueError('Password must be at least 8 characters long.')
 
@@ -121,34 +194,105 @@ def add_user(user_id: str, first_name: str, last_name: str,
     user_entry[DOB] = dob
     user_entry[EMAIL] = email
     user_entry[PASSWORD] = password
+    return user_entry
+
+
+def _duplicate_user(err, user_id: str) -> ValueError:
+    """
+    The error to raise for a DuplicateKeyError on the users indexes.
+    """
+    fields = dbc.duplicate_fields(err)
+    if EMAIL in fields or (not fields and not exists(user_id)):
+        return ValueError("A user is already registered under this email.")
+    return ids.IdTaken("This user is already registered.")
+
+
+def add_user(user_id: str, first_name: str, last_name: str,
+             dob: str, email: str, password: str):
+    user_entry = _make_user_entry(user_id, first_name, last_name,
+                                  dob, email, password)
     dbc.connect_db()
-    _id = dbc.insert_one(USERS_COLLECT, user_entry)
+    try:
+        _id = dbc.insert_one(USERS_COLLECT, user_entry)
+    except dbc.DuplicateKeyError as err:
+        raise _duplicate_user(err, user_id) from err
     return _id is not None
 
 
-def get_user(identifier: str) -> dict:
+def add_users(users: list) -> dict:
+    """
+    Add many users with one duplicate lookup and one insert round trip.
+
+    Args:
+    users (list): Dicts with USER_ID, FIRST_NAME, LAST_NAME, DOB,
+                  EMAIL and PASSWORD.
+
+    Returns:
+    dict: A dbc bulk write report; ERRORS holds an entry for every user
+          that was not added, with ITEM_INDEX its position in users.
+    """
     dbc.connect_db()
+    user_ids = [user.get(USER_ID) for user in users]
+    emails = [normalise_email(user.get(EMAIL, '')) for user in users]
+    existing = dbc.fetch_many(USERS_COLLECT,
+                              {'$or': [{USER_ID: {'$in': user_ids}},
+                                       {EMAIL: {'$in': emails}}]},
+                              [USER_ID, EMAIL])
+    taken_ids = {user[USER_ID] for user in existing}
+    taken_emails = {normalise_email(user[EMAIL]) for user in existing}
+
+    def make_entry(user):
+        if user.get(USER_ID) in taken_ids:
+            raise ValueError("This user is already registered.")
+        entry = _make_user_entry(user[USER_ID], user[FIRST_NAME],
+                                 user[LAST_NAME], user[DOB],
+                                 user[EMAIL], user[PASSWORD])
+        if entry[EMAIL] in taken_emails:
+            raise ValueError("A user is already registered "
+                             "under this email.")
+        taken_ids.add(entry[USER_ID])
+        taken_emails.add(entry[EMAIL])
+        return entry
+
+    return dbc.insert_many_checked(USERS_COLLECT, users, make_entry)
+
+
+def _email_filter(email: str) -> dict:
+    """
+    Match an email address whatever its case, as they are stored
+    normalised; the unique email index serves it.
+    """
+    return {EMAIL: normalise_email(email)}
+
+
+def _identifier_filter(identifier: str) -> dict:
+    """
+    A user can be looked up by user_id or by email.
+    """
     if identifier.isdigit():
-        return dbc.fetch_one(USERS_COLLECT, {USER_ID: identifier})
+        return {USER_ID: identifier}
     elif re.match(r"[^@]+@[^@]+\.[^@]+", identifier):
-        lowercase_email = identifier.lower()
-        return dbc.fetch_one(USERS_COLLECT, {EMAIL:
-                                             {'$regex':
-                                              f'^{lowercase_email}$',
-                                              '$options': 'i'}})
+        return _email_filter(identifier)
     else:
         raise ValueError("Invalid identifier. Use 'user_id' or 'email'.")
 
 
+def get_user(identifier: str, fields: list = None) -> dict:
+    dbc.connect_db()
+    return dbc.fetch_one(USERS_COLLECT, _identifier_filter(identifier),
+                         fields)
+
+
 def exists(user_id: str) -> bool:
-    return get_user(user_id) is not None
+    return get_user(user_id, [USER_ID]) is not None
 
 
 def del_user(user_id: str):
-    if exists(user_id):
-        return dbc.del_one(USERS_COLLECT, {USER_ID: user_id})
-    else:
+    dbc.connect_db()
+    result = dbc.del_one(USERS_COLLECT, {USER_ID: user_id})
+    if not result.deleted_count:
         raise ValueError(f'Delete failure: {user_id} not in database.')
+    return result
 
 
 def get_first_name(user: dict):
@@ -171,6 +315,22 @@ def get_password(user: dict):
     return user.get(PASSWORD)
 
 
+def _get_update_data(user_data: dict) -> dict:
+    """
+    Pick out the fields of user_data that may be updated.
+    """
+    if not user_data:
+        raise ValueError("Update failure: No valid fields to update.")
+
+    update_data = {}
+    for key in [FIRST_NAME, LAST_NAME, DOB, EMAIL, PASSWORD]:
+        if key in user_data:
+            update_data[key] = user_data[key]
+    if isinstance(update_data.get(EMAIL), str):
+        update_data[EMAIL] = normalise_email(update_data[EMAIL])
+    return update_data
+
+
 def update_user(user_id: str, user_data: dict) -> bool:
     """
     Updates a user's information.
@@ -182,17 +342,15 @@ def update_user(user_id: str, user_data: dict) -> bool:
     Returns:
     bool: True if the update was successful, False otherwise.
     """
-    if not exists(user_id):
-        raise ValueError(f"Update failure: {user_id} not in database.")
-
-    if not user_data:
-        raise ValueError("Update failure: No valid fields to update.")
-
-    update_data = {}
-    for key in [FIRST_NAME, LAST_NAME, DOB, EMAIL, PASSWORD]:
-        if key in user_data:
-            update_data[key] = user_data[key]
-
+    update_data = _get_update_data(user_data)
     dbc.connect_db()
-    dbc.update_doc(USERS_COLLECT, {USER_ID: user_id}, update_data)
+    try:
+        result = dbc.update_doc(USERS_COLLECT, {USER_ID: user_id},
+                                update_data)
+    except dbc.DuplicateKeyError as err:
+        # The email is the only unique field an update can change.
+        raise ValueError("A user is already registered "
+                         "under this email.") from err
+    if not result.matched_count:
+        raise ValueError(f"Update failure: {user_id} not in database.")
     return True
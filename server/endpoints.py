@@ -5,12 +5,17 @@ The endpoint called `endpoints` will return all available endpoints.
 
 # import datetime as dt
 # from urllib import request
-from flask import Flask, request
+import json
+import os
+
+from flask import Flask, Response, request, stream_with_context
 from http import HTTPStatus
 from flask_restx import Resource, Api, fields
 import werkzeug.exceptions as wz
 from flask_cors import CORS
 
+import data.db_connect as dbc
+import data.ids as ids
 import data.users as usrs
 import data.journals as journals
 import data.categories as categories
@@ -18,6 +23,8 @@ import forms.SignUp_form as SignUp
 
 
 app = Flask(__name__)
+# The dates in our docs go out as dbc.DATETIME_FORMAT text.
+app.config['RESTX_JSON'] = {'default': dbc.json_default}
 api = Api(app)
 # CORS(app)
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -43,6 +50,200 @@ HELLO_RESP = 'hello'
 SIGNUP = 'signup'
 FORM = 'form'
 SIGNUP_FORM = 'signup_form'
+FIELDS = 'fields'
+SUMMARY = 'summary'
+FIELDS_SEP = ','
+EXPAND = 'expand'
+EXPAND_JOURNALS = 'journals'
+
+
+list_parser = api.parser()
+list_parser.add_argument(FIELDS, type=str, location='args',
+                         help='Comma-separated fields to return, '
+                              f'or "{SUMMARY}" for the list view fields.')
+list_parser.add_argument(EXPAND, type=str, location='args',
+                         help=f'"{EXPAND_JOURNALS}" to add each category\'s '
+                              '{journal_id: title} map.')
+
+
+def get_fields(summary_fields: list) -> list:
+    """
+    Read the fields a list request asked for.
+    Returns None (whole documents) when the request does not say.
+    """
+    requested = request.args.get(FIELDS)
+    if not requested:
+        return None
+    if requested == SUMMARY:
+        return summary_fields
+    return [field.strip() for field in requested.split(FIELDS_SEP)
+            if field.strip()]
+
+
+def expand_journals(data: dict) -> dict:
+    """
+    Add the journal titles to a dict of categories if the request asked
+    for them with EXPAND; categories only store their journal count.
+    """
+    if request.args.get(EXPAND) != EXPAND_JOURNALS:
+        return data
+    return categories.expand_journals(data)
+
+
+def add_with_new_id(new_id, add, *args):
+    """
+    Call add(an id from new_id(), *args) and return the id and what add
+    returned. A taken id is retried once with a fresh one.
+    """
+    _id = new_id()
+    try:
+        return _id, add(_id, *args)
+    except ids.IdTaken:
+        _id = new_id()
+        return _id, add(_id, *args)
+
+
+# With RAW_LISTS set to "1" the whole-collection lists are streamed
+# straight from the database's BSON, without building their docs.
+RAW_LISTS = os.environ.get('RAW_LISTS', '0') == '1'
+
+
+def stream_list(title: str, items) -> Response:
+    """
+    Stream a {TYPE, TITLE, DATA} list response whose DATA object is made
+    of the JSON members in items.
+    The first member is read before answering, so a database error
+    still gets its proper status.
+    """
+    items = iter(items)
+    first = next(items, None)
+
+    def generate():
+        yield json.dumps({TYPE: DATA, TITLE: title})[:-1]
+        yield f', {json.dumps(DATA)}: {{'
+        if first is not None:
+            yield first
+            for item in items:
+                yield ', ' + item
+        yield '}}\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+# How long a request may spend waiting on the database, in seconds:
+# REQUEST_DEADLINE, unless ENDPOINT_DEADLINES has one for its
+# (method, endpoint), as DB_OP_BUDGETS is keyed. Set them with e.g.
+# ENDPOINT_DEADLINES="GET users=30,POST journals=5".
+# 0 means no deadline.
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', 10))
+
+
+def parse_deadlines(setting: str) -> dict:
+    """
+    Parse a setting like "GET users=30" into {(method, endpoint): seconds}.
+    """
+    deadlines = {}
+    for name, seconds in dbc.parse_durations(setting).items():
+        method, _, endpoint = name.partition(' ')
+        if not endpoint:
+            raise ValueError(f'Bad endpoint deadline {name!r}: '
+                             'expected "METHOD endpoint=seconds".')
+        deadlines[(method.upper(), endpoint.strip())] = seconds
+    return deadlines
+
+
+ENDPOINT_DEADLINES = {
+    # the whole-collection lists
+    ('GET', 'users'): 30,
+    ('GET', 'category'): 30,
+    ('GET', 'journals'): 30,
+    **parse_deadlines(os.environ.get('ENDPOINT_DEADLINES', '')),
+}
+
+
+def get_deadline(method: str, endpoint: str):
+    seconds = ENDPOINT_DEADLINES.get((method, endpoint), REQUEST_DEADLINE)
+    return seconds if seconds > 0 else None
+
+
+# The most database operations one request to an endpoint may run,
+# keyed on (method, endpoint). The tests fail when a request goes over.
+# In debug and testing mode, or with DB_OPS_HEADERS set to "1", every
+# response says how many it ran in DB_OPS_HEADER.
+DB_OPS_HEADER = 'X-DB-Operations'
+DB_OPS_HEADERS = os.environ.get('DB_OPS_HEADERS', '0') == '1'
+DB_OP_BUDGETS = {
+    ('GET', 'hello_world'): 0,
+    ('GET', 'endpoints'): 0,
+    ('GET', 'main_menu'): 0,
+    ('GET', 'main_menu_2'): 0,
+    ('GET', 'sign_up_form'): 0,
+    ('GET', 'users'): 1,
+    ('POST', 'users'): 1,
+    ('GET', 'get_user'): 1,
+    ('PUT', 'update_user'): 1,
+    ('DELETE', 'del_user'): 1,
+    # One more for the category lists with ?expand=journals.
+    ('GET', 'category'): 2,
+    ('POST', 'category'): 3,
+    ('GET', 'get_category'): 2,
+    ('PUT', 'update_category'): 1,
+    ('DELETE', 'del_category'): 2,
+    ('GET', 'journals'): 1,
+    ('POST', 'journals'): 4,
+    ('GET', 'get_journals'): 1,
+    ('PUT', 'update_journal'): 4,
+    ('DELETE', 'del_journal'): 3,
+}
+
+
+def get_db_op_budget(method: str, endpoint: str):
+    return DB_OP_BUDGETS.get((method, endpoint))
+
+
+@app.before_request
+def start_deadline():
+    dbc.set_deadline(get_deadline(request.method, request.endpoint))
+    # Reads may fall back on their last good result during an outage.
+    dbc.set_allow_stale(request.method == 'GET')
+    dbc.start_op_log()
+
+
+@app.after_request
+def count_db_ops(response):
+    ops = dbc.get_op_log()
+    if DB_OPS_HEADERS or app.debug or app.testing:
+        response.headers[DB_OPS_HEADER] = str(len(ops))
+    budget = get_db_op_budget(request.method, request.endpoint)
+    if budget is not None and len(ops) > budget:
+        app.logger.warning('%s %s ran %d database operations, over its '
+                           'budget of %d: %s', request.method,
+                           request.endpoint, len(ops), budget, ops)
+    return response
+
+
+@app.teardown_request
+def end_deadline(exc):
+    dbc.set_deadline(None)
+    dbc.set_allow_stale(False)
+    dbc.stop_op_log()
+
+
+@api.errorhandler(dbc.DeadlineExceeded)
+def deadline_exceeded(err):
+    """
+    The database could not answer in time: fail fast and let the client
+    retry, rather than hold the worker.
+    """
+    return {'message': f'{str(err)}'}, HTTPStatus.SERVICE_UNAVAILABLE
+
+
+@api.errorhandler(dbc.CircuitOpenError)
+def circuit_open(err):
+    """
+    The database is out: fail fast instead of waiting on it.
+    """
+    return {'message': f'{str(err)}'}, HTTPStatus.SERVICE_UNAVAILABLE
 
 
 @api.route(HELLO_EP)
@@ -154,14 +355,18 @@ class Users(Resource):
         - fetching a list of all users
         - adding a user
     """
+    @api.expect(list_parser)
     def get(self):
         """
         This method returns all users.
         """
+        if RAW_LISTS:
+            return stream_list('Current Users', usrs.iter_users_json(
+                get_fields(usrs.SUMMARY_FIELDS)))
         return {
             TYPE: DATA,
             TITLE: 'Current Users',
-            DATA: usrs.get_users(),
+            DATA: usrs.get_users(get_fields(usrs.SUMMARY_FIELDS)),
         }
 
     @api.expect(user_fields)
@@ -171,15 +376,15 @@ class Users(Resource):
         """
         Add a user.
         """
-        user_id = usrs._get_user_id()
         first_name = request.json[usrs.FIRST_NAME]
         last_name = request.json[usrs.LAST_NAME]
         dob = request.json[usrs.DOB]
         email = request.json[usrs.EMAIL]
         password = request.json[usrs.PASSWORD]
         try:
-            new_id = usrs.add_user(user_id, first_name, last_name,
-                                   dob, email, password)
+            user_id, new_id = add_with_new_id(
+                usrs._get_user_id, usrs.add_user, first_name, last_name,
+                dob, email, password)
             if new_id is None:
                 raise wz.ServiceUnavailable('We have a technical problem.')
             return {f'New user has been added; with {USER_ID}': user_id}
@@ -226,13 +431,15 @@ class GetCategory(Resource):
     This class supports:
         - retrieving categories for a user
     """
+    @api.expect(list_parser)
     @api.response(HTTPStatus.OK, 'Success')
     @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
     def get(self, user_id):
         """
         This method returns all categories for a user.
         """
-        data = categories.get_user_categories(user_id)
+        data = expand_journals(categories.get_user_categories(
+            user_id, get_fields(categories.SUMMARY_FIELDS)))
         if data:
             return {
                 TYPE: DATA,
@@ -293,14 +500,20 @@ class Category(Resource):
         - fetching a list of all users
         - adding a user
     """
+    @api.expect(list_parser)
     def get(self):
         """
         This method returns all categories.
         """
+        if RAW_LISTS and EXPAND not in request.args:
+            return stream_list('Current Categories',
+                               categories.iter_categories_json(
+                                   get_fields(categories.SUMMARY_FIELDS)))
         return {
             TYPE: DATA,
             TITLE: 'Current Categories',
-            DATA: categories.get_categories(),
+            DATA: expand_journals(categories.get_categories(
+                get_fields(categories.SUMMARY_FIELDS))),
         }
 
     @api.expect(category_post_fields)
@@ -310,15 +523,15 @@ class Category(Resource):
         """
         Add a category.
         """
-        category_id = categories._get_category_id()
         category_name = request.json[categories.CATEGORY_NAME]
         user_id = request.json[categories.USER]
         if not usrs.exists(user_id):
             raise wz.NotAcceptable("Please input a user ID that exists.")
 
         try:
-            new_id = categories.add_category(category_id, category_name,
-                                             user_id)
+            category_id, new_id = add_with_new_id(
+                categories._get_category_id, categories.add_category,
+                category_name, user_id)
             if new_id is None:
                 raise wz.ServiceUnavailable('We have a technical problem.')
             return {f'New category added; with {CATEGORY_ID}': category_id}
@@ -350,14 +563,19 @@ class Journals(Resource):
         - fetching a list of all journals
         - adding a journal
     """
+    @api.expect(list_parser)
     def get(self):
         """
         This method returns all journals.
         """
+        if RAW_LISTS:
+            return stream_list('All Journals', journals.iter_journals_json(
+                get_fields(journals.SUMMARY_FIELDS)))
         return {
             TYPE: DATA,
             TITLE: 'All Journals',
-            DATA: journals.get_journals(),
+            DATA: journals.get_journals(
+                get_fields(journals.SUMMARY_FIELDS)),
         }
 
     @api.expect(journal_post_fields)
@@ -367,7 +585,6 @@ class Journals(Resource):
         """
         This method adds a journal entry.
         """
-        journal_id = journals._get_journal_id()
         title = request.json[journals.TITLE]
         prompt = request.json[journals.PROMPT]
         content = request.json[journals.CONTENT]
@@ -380,8 +597,9 @@ class Journals(Resource):
             raise wz.NotAcceptable("Please input a category ID that exists.")
 
         try:
-            ret = journals.add_journal(journal_id, title, prompt, content,
-                                       user_id, category_id)
+            journal_id, ret = add_with_new_id(
+                journals._get_journal_id, journals.add_journal, title,
+                prompt, content, user_id, category_id)
             if ret is None:
                 raise wz.ServiceUnavailable('We have a technical problem.')
             return {JOURNAL_ID: journal_id}
@@ -436,13 +654,15 @@ class GetJournals(Resource):
     This class supports:
         - retrieving journals for a category
     """
+    @api.expect(list_parser)
     @api.response(HTTPStatus.OK, 'Success')
     @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
     def get(self, category_id):
         """
         This method returns all journals for a category.
         """
-        data = journals.get_category_journals(category_id)
+        data = journals.get_category_journals(
+            category_id, get_fields(journals.SUMMARY_FIELDS))
         if data:
             return {
                 TYPE: DATA,
@@ -3,6 +3,8 @@ import pytest
 import data.categories as categories
 import data.users as usrs
 import data.journals as jrnls
+import data.ids as ids
+from datetime import datetime
 from unittest.mock import patch
 from http.client import (
     BAD_REQUEST,
@@ -42,6 +44,28 @@ def test_users_add(mock_add):
     assert resp.status_code == OK
 
 
+def test_add_with_new_id():
+    made = iter(['1', '2', '3'])
+    tried = []
+
+    def add(_id):
+        tried.append(_id)
+        if _id == '1':
+            raise ids.IdTaken('taken')
+        return True
+
+    assert ep.add_with_new_id(lambda: next(made), add) == ('2', True)
+    assert tried == ['1', '2']
+
+
+def test_add_with_new_id_taken_twice():
+    def add(_id):
+        raise ids.IdTaken('taken')
+
+    with pytest.raises(ids.IdTaken):
+        ep.add_with_new_id(lambda: '1', add)
+
+
 @patch('data.users.add_user', side_effect=ValueError(), autospec=True)
 def test_users_bad_add(mock_add):
     """
@@ -273,6 +297,17 @@ def test_get_category_journals_success(mock_get_category_journals):
     assert ep.DATA in resp_json
 
 
+@patch('data.journals.get_category_journals', autospec=True)
+def test_get_category_journals_dates(mock_get_category_journals):
+    modified = datetime(2024, 1, 2, 3, 4, 5)
+    mock_get_category_journals.return_value = {
+        jrnls.MOCK_ID: {jrnls.MODIFIED: modified}}
+    resp = TEST_CLIENT.get(f'{ep.JOURNALS_EP}/12345678')
+    assert resp.status_code == OK
+    journal = resp.get_json()[ep.DATA][jrnls.MOCK_ID]
+    assert journal[jrnls.MODIFIED] == '2024-01-02 03:04:05'
+
+
 @patch('data.journals.get_category_journals', return_value=None, autospec=True)
 def test_get_category_journals_not_found(mock_get_category_journals):
     CATEGORY_ID= "12345678"
@@ -355,4 +390,174 @@ def test_get_signup_form():
     resp = TEST_CLIENT.get(signup_url)
     resp_json = resp.get_json()
     assert ep.SIGNUP_FORM in resp_json
-    assert isinstance(resp_json, dict)
\ No newline at end of file
+    assert isinstance(resp_json, dict)
+
+@patch('data.journals.get_journals', return_value={}, autospec=True)
+def test_list_journals_summary(mock_get_journals):
+    resp = TEST_CLIENT.get(f'{ep.JOURNALS_EP}?{ep.FIELDS}={ep.SUMMARY}')
+    assert resp.status_code == OK
+    mock_get_journals.assert_called_once_with(jrnls.SUMMARY_FIELDS)
+
+
+@patch('data.categories.expand_journals', autospec=True)
+@patch('data.categories.get_categories', return_value={}, autospec=True)
+def test_list_categories_expand_journals(mock_get_categories, mock_expand):
+    mock_expand.return_value = {'1': {categories.JOURNALS: {}}}
+    resp = TEST_CLIENT.get(f'{ep.CATEGORIES_EP}?{ep.EXPAND}='
+                           f'{ep.EXPAND_JOURNALS}')
+    assert resp.status_code == OK
+    mock_expand.assert_called_once_with({})
+    assert resp.get_json()[ep.DATA] == mock_expand.return_value
+
+
+@patch('data.categories.expand_journals', autospec=True)
+@patch('data.categories.get_categories', return_value={}, autospec=True)
+def test_list_categories_not_expanded(mock_get_categories, mock_expand):
+    resp = TEST_CLIENT.get(ep.CATEGORIES_EP)
+    assert resp.status_code == OK
+    mock_expand.assert_not_called()
+
+
+@patch('data.users.get_users', return_value={}, autospec=True)
+def test_list_users_fields(mock_get_users):
+    resp = TEST_CLIENT.get(f'{ep.USERS_EP}?{ep.FIELDS}='
+                           f'{usrs.FIRST_NAME},{usrs.EMAIL}')
+    assert resp.status_code == OK
+    mock_get_users.assert_called_once_with([usrs.FIRST_NAME, usrs.EMAIL])
+
+
+@patch('data.categories.get_categories', return_value={}, autospec=True)
+def test_list_categories_all_fields(mock_get_categories):
+    resp = TEST_CLIENT.get(ep.CATEGORIES_EP)
+    assert resp.status_code == OK
+    mock_get_categories.assert_called_once_with(None)
+
+
+@patch('data.users.get_users', autospec=True,
+       side_effect=ep.dbc.DeadlineExceeded('find on users ran out of time.'))
+def test_list_users_deadline_exceeded(mock_get):
+    resp = TEST_CLIENT.get(ep.USERS_EP)
+    assert resp.status_code == SERVICE_UNAVAILABLE
+
+
+def test_request_deadline():
+    seen = []
+
+    def get_users(fields=None):
+        seen.append(ep.dbc.remaining_time())
+        return {}
+
+    with patch('data.users.get_users', side_effect=get_users):
+        TEST_CLIENT.get(ep.USERS_EP)
+    assert 0 < seen[0] <= ep.ENDPOINT_DEADLINES[('GET', 'users')]
+    assert ep.dbc.remaining_time() is None
+
+
+def test_get_deadline():
+    # The long deadline is for the list, not for adding one.
+    assert ep.get_deadline('GET', 'category') == 30
+    assert ep.get_deadline('POST', 'category') == ep.REQUEST_DEADLINE
+    assert ep.parse_deadlines('post journals=5') == {('POST', 'journals'): 5}
+    with pytest.raises(ValueError):
+        ep.parse_deadlines('journals=5')
+
+
+@patch('data.users.get_users', autospec=True,
+       side_effect=ep.dbc.CircuitOpenError('The database is unavailable.'))
+def test_list_users_circuit_open(mock_get):
+    resp = TEST_CLIENT.get(ep.USERS_EP)
+    assert resp.status_code == SERVICE_UNAVAILABLE
+
+
+@pytest.mark.parametrize('endpoint', [ep.USERS_EP, ep.CATEGORIES_EP,
+                                      ep.JOURNALS_EP])
+def test_raw_lists(endpoint, monkeypatch):
+    for query in ['', f'?{ep.FIELDS}={ep.SUMMARY}']:
+        expected = TEST_CLIENT.get(endpoint + query).get_json()
+        monkeypatch.setattr(ep, 'RAW_LISTS', True)
+        resp = TEST_CLIENT.get(endpoint + query)
+        monkeypatch.setattr(ep, 'RAW_LISTS', False)
+        assert resp.status_code == OK
+        assert resp.get_json() == expected
+
+
+# The Flask and Swagger UI endpoints that are not ours.
+FRAMEWORK_ENDPOINTS = ['static', 'specs', 'doc', 'root', 'restx_doc.static']
+
+
+def test_every_endpoint_has_a_db_op_budget():
+    for rule in ep.app.url_map.iter_rules():
+        if rule.endpoint in FRAMEWORK_ENDPOINTS:
+            continue
+        for method in rule.methods - {'HEAD', 'OPTIONS'}:
+            assert ep.get_db_op_budget(method, rule.endpoint) is not None, \
+                f'{method} {rule.rule} needs an entry in DB_OP_BUDGETS'
+
+
+def within_budget(resp):
+    """
+    Check resp came from a request that kept to its endpoint's budget of
+    database operations, and pass it on.
+    """
+    ops = int(resp.headers[ep.DB_OPS_HEADER])
+    endpoint, _ = ep.app.url_map.bind('').match(resp.request.path,
+                                                resp.request.method)
+    budget = ep.get_db_op_budget(resp.request.method, endpoint)
+    assert ops <= budget, (f'{resp.request.method} {resp.request.path} ran '
+                           f'{ops} database operations; its budget is '
+                           f'{budget}')
+    return resp
+
+
+def test_db_ops_header_off_in_production():
+    assert ep.DB_OPS_HEADER not in TEST_CLIENT.get(ep.HELLO_EP).headers
+
+
+def test_db_op_budgets(monkeypatch):
+    monkeypatch.setattr(ep, 'DB_OPS_HEADERS', True)
+    ep.dbc.connect_db()  # index creation is not any request's cost
+    for path in [ep.HELLO_EP, '/endpoints', f'/{ep.MAIN_MENU}',
+                 f'/{ep.SIGNUP}/{ep.FORM}']:
+        within_budget(TEST_CLIENT.get(path))
+    user = usrs.get_test_user()
+    user[usrs.EMAIL] = 'budget@example.com'
+    resp = within_budget(TEST_CLIENT.post(ep.USERS_EP, json=user))
+    user_id = list(resp.get_json().values())[0]
+    resp = within_budget(TEST_CLIENT.post(ep.CATEGORIES_EP, json={
+        categories.CATEGORY_NAME: 'Budget', categories.USER: user_id}))
+    category_id = list(resp.get_json().values())[0]
+    resp = within_budget(TEST_CLIENT.post(ep.CATEGORIES_EP, json={
+        categories.CATEGORY_NAME: 'Other', categories.USER: user_id}))
+    other_id = list(resp.get_json().values())[0]
+    resp = within_budget(TEST_CLIENT.post(ep.JOURNALS_EP, json={
+        jrnls.TITLE: 'Budget', jrnls.PROMPT: jrnls.TEST_PROMPT,
+        jrnls.CONTENT: 'Content', jrnls.USER: user_id,
+        jrnls.CATEGORY: category_id}))
+    assert resp.status_code == OK
+    journal_id = resp.get_json()[ep.JOURNAL_ID]
+    for path in [ep.USERS_EP, f'{ep.USERS_EP}/{user_id}',
+                 f'{ep.USERS_EP}/{user[usrs.EMAIL]}', ep.CATEGORIES_EP,
+                 f'{ep.CATEGORIES_EP}/{user_id}', ep.JOURNALS_EP,
+                 f'{ep.JOURNALS_EP}/{category_id}',
+                 f'{ep.CATEGORIES_EP}?{ep.EXPAND}={ep.EXPAND_JOURNALS}',
+                 f'{ep.CATEGORIES_EP}/{user_id}'
+                 f'?{ep.EXPAND}={ep.EXPAND_JOURNALS}']:
+        assert within_budget(TEST_CLIENT.get(path)).status_code == OK
+    within_budget(TEST_CLIENT.put(f'{ep.USERS_EP}/{user_id}',
+                                  json={usrs.FIRST_NAME: 'Budget'}))
+    within_budget(TEST_CLIENT.put(f'{ep.CATEGORIES_EP}/{category_id}',
+                                  json={categories.CATEGORY_NAME: 'Spent'}))
+    within_budget(TEST_CLIENT.put(f'{ep.JOURNALS_EP}/{journal_id}',
+                                  json={jrnls.TITLE: 'Spent',
+                                        jrnls.CATEGORY: category_id}))
+    # Moving it counts it out of one category and into the other.
+    resp = within_budget(TEST_CLIENT.put(f'{ep.JOURNALS_EP}/{journal_id}',
+                                         json={jrnls.CATEGORY: other_id}))
+    assert resp.status_code == OK
+    assert categories.get_journal_count(
+        categories.get_category(other_id)) == 1
+    for path in [f'{ep.DEL_JOURNAL_EP}/{journal_id}',
+                 f'{ep.DEL_CATEGORY_EP}/{category_id}',
+                 f'{ep.DEL_CATEGORY_EP}/{other_id}',
+                 f'{ep.DEL_USER_EP}/{user_id}']:
+        assert within_budget(TEST_CLIENT.delete(path)).status_code == OK